@@ -4,19 +4,36 @@ Facilitates storage of Charm data.
 Functions:
 
     add_word(word, part)
-    recover_data()
+    add_part(word, part)
+    define(word, defn)
+    add_key(word, key, count)
+    associate(words)
+    record(operation, word, argument)
+    recover_data(background, interactive)
+    announce()
     recover_user_data()
+    describe() -> str
     recover_words()
     save()
-    store_contents() -> list
+    compact()
+    refuse()
+    export_words(file, since)
+    unsaved() -> int
+    pending() -> int
 
 Variables:
 
     version
+    release
     savek
     greeting
     alpha
     book
+    storage
+    key_window
+    lock
+    saving
+    announced
 
 Authors:
 
@@ -24,13 +41,20 @@ Authors:
 """
 
 
-import os.path as path
+import threading
+import src.python.fuzzy as fuzzy
+import src.python.indexes as indexes
+import src.python.scanner as scanner
+import src.python.stats as stats
+import src.python.suggest as suggest
 from src.python.data import *
-from src.python.listener import post_query
+from src.python.storage import Storage, FileStorage, write_atomic
+from src.python.vocabulary import Vocabulary
 
 
 # The user-specific version, save key, and greeting
 version: str = ""
+release: str = ""
 savek: str = ""
 greeting: str = ""
 
@@ -38,34 +62,190 @@ greeting: str = ""
 alpha: list = []
 
 # The user-specific book of words
-book: dict = {}
+book: Vocabulary = Vocabulary()
 
+# The backend that the book and user data are saved in
+storage: Storage = FileStorage("data")
 
-def add_word(word: str, part: Part) -> None:
+# The number of following words in a line that each word is associated with
+key_window: int = 8
+
+# Serializes mutations of the book and saves when several sessions share it
+lock = threading.RLock()
+
+# Serializes saves, so that mutations are persisted in the order they were made
+saving = threading.Lock()
+
+# Whether the version has been announced since the data was last recovered
+announced: bool = False
+
+
+def add_word(word: str, part: Part = None) -> None:
     """
     Add a word to the book.
-    A new Word is created using a provided string and part of speech and added to the dictionary of all known words.
+    A new Word is created using a provided string and part of speech, if any, and added to the dictionary of all known
+    words. If another session has learned the word in the meantime, the part of speech is added to its Word instead.
+    """
+
+    # Like every mutation, wait for the words to be recovered before taking the lock that they are recovered under
+    book.wait()
+    with lock:
+        existing = book.get(word)
+        if existing is not None:
+            if part is not None:
+                add_part(existing, part)
+            return
+
+        index = 0 if part is None else part.indx()
+        book.add(Word(word, [index]))
+        record("add_word", word, str(index))
+        if stats.enabled:
+            stats.count("learned")
+        fuzzy.learn(book.normalize(word))
+        if part is not None:
+            suggest.learn(word, part)
+            indexes.add_part(book.normalize(word), part)
+
+
+def add_part(word: Word, part: Part) -> None:
+    """
+    Assign a stored Word to a new part of speech and record the change.
+    """
+
+    book.wait()
+    with lock:
+        # Statistics only count each part of a word once, as they do when collected from the book
+        learned = not word.has_part(part)
+        word.add_part(part)
+        record("add_part", word.word, str(part.indx()))
+        if learned:
+            suggest.learn(word.word, part)
+        indexes.add_part(book.normalize(word.word), part)
+
+
+def define(word: Word, defn: str) -> None:
+    """
+    Define a stored Word and record the change.
     """
 
-    word = Word(word, [part.indx()])
-    book[hash(word)] = word
+    book.wait()
+    with lock:
+        indexes.define(book.normalize(word.word), word.defn, defn)
+        word.define(defn)
+        record("define", word.word, defn)
 
 
-def recover_data() -> None:
+def add_key(word: Word, key: str, count: int = 1) -> None:
+    """
+    Add a key to a stored Word, or increment its count, and record the change.
+    The resulting count is recorded rather than the increment so that replaying the journal is idempotent.
+    """
+
+    book.wait()
+    with lock:
+        word.add_key(key, count)
+        record("add_key", word.word, key + ":" + str(word.keys.get(key)))
+
+
+def associate(words: list) -> None:
+    """
+    Counts the co-occurrences of Words that appear in the same line as keys of each other.
+    Each Word is only counted once per line, and only associated with the key_window Words that follow it, so long
+    lines cost time in proportion to their length. The line is recorded as a single mutation, which is replayed by
+    associating its Words again in the same way.
+
+    :param words: The Words of a line, in order
+    """
+
+    distinct = list({id(word): word for word in words}.values())
+    if len(distinct) < 2:
+        return
+
+    book.wait()
+    with lock:
+        book.associate(distinct, key_window)
+        record("associate", " ".join(book.normalize(word.word) for word in distinct), str(key_window))
+
+
+def record(operation: str, word: str, argument: str) -> None:
+    """
+    Records a mutation of the book to be persisted on the next save (see the Changeset class).
+
+    :param operation: The name of the mutation; one of add_word, add_part, define, add_key or associate
+    :param word: The word string of the mutated Word, or the keys of the associated Words separated by spaces
+    :param argument: The part index, definition, key count or association window of the mutation
+    """
+
+    changeset.record(operation, word, argument)
+
+
+def recover_data(background: bool = False, interactive: bool = True) -> None:
     """
     Recovers all saved data.
     This function exists because the order of execution for the separate data recovery functions matters.
     The word recovery is a prerequisite of the userdata recovery.
+
+    In the background, the user data is recovered first and the words are recovered on another thread, so that Charm can
+    greet the user immediately; the version is completed and announced once the words have been recovered, by the
+    thread that reads input (see the announce function).
+
+    Commands that do not interact with the user, such as analyzing corpora, do not announce the version.
+
+    :param background: Whether to recover the words on a background thread
+    :param interactive: Whether the version is announced, as it is to users
     """
 
-    recover_words()
+    global announced
+
+    def load():
+        started = stats.start()
+        recover_words()
+        stats.stop("recover_words", started)
+
+    announced = not interactive
+
+    if not background:
+        load()
+
+    started = stats.start()
     recover_user_data()
+    stats.stop("recover_user_data", started)
+
+    if background:
+        book.load(load)
+    else:
+        announce()
+
+
+def announce() -> None:
+    """
+    Announces the version once the words have been recovered, unless it has already been announced.
+    While the words are recovered in the background this does nothing, so the thread that reads input calls it between
+    lines, and the announcement never interrupts a line that is being entered.
+
+    :raises Exception: The error that recovering the words in the background failed with, if it failed
+    """
+
+    global version, announced
+
+    # The listener imports this module, so it is imported once both have been initialized
+    from src.python.listener import post_query
+
+    if announced or not book.ready.is_set():
+        return
+
+    announced = True
+    book.wait()
+
+    if release != "":
+        # The number of words may not have been known when the user data was recovered
+        version = describe()
     post_query("Connected to Charm interactive", version, mode='v')
 
 
 def recover_user_data() -> None:
     """
-    Recovers user data from the user_data file.
+    Recovers user data from the storage.
 
     LINES:
     ========= ==============
@@ -73,108 +253,166 @@ def recover_user_data() -> None:
     1         Version
     2         Save Key
     3         Greeting
+    4         Bigrams
     ========= ==============
     """
 
-    global alpha, version, savek, greeting
-
-    if path.exists("data/user_data"):
-        userdata = open("data/user_data").read()
-
-        userdata = userdata.split('\n')
+    global alpha, version, release, savek, greeting
+
+    userdata = storage.read_user_data()
+
+    for line in range(len(userdata)):
+        sections = userdata[line].rstrip("\n").split(",")
+        if line == 0:
+            # Alphabet is stored in the first line, and decides which characters belong in words
+            alpha = sections[0]
+            scanner.use_alphabet(alpha)
+        elif 1 < len(sections):
+            if line == 1:
+                # Version is stored in the second line
+                release = sections[1][:-2]
+                version = describe()
+            elif line == 2:
+                # Save key is stored in the third line
+                savek = sections[1]
+            elif line == 3:
+                # Greeting is stored in the fourth line
+                greeting = sections[1]
+            elif line == 4:
+                # How often parts of speech follow each other is stored in the fifth line (see the suggest module)
+                suggest.parse_bigrams(sections[1])
+
+
+def describe() -> str:
+    """
+    Formats the version from the release, the number of known words and the alphabet.
+    """
 
-        for line in range(len(userdata)):
-            sections = userdata[line].split(",")
-            if line == 0:
-                # Alphabet is stored in the first line
-                alpha = sections[0]
-            elif 1 < len(sections):
-                if line == 1:
-                    # Version is stored in the second line
-                    version = sections[1][:-2] + str(len(book)) + "-"
-                    end = len(alpha) - 1
-                    # Append last three characters in alphabet to displayed version
-                    version += alpha[end - 4] + alpha[end - 2] + alpha[end]
-                elif line == 2:
-                    # Save key is stored in the third line
-                    savek = sections[1]
-                elif line == 3:
-                    # Greeting is stored in the fourth line
-                    greeting = sections[1]
+    end = len(alpha) - 1
+    # Append last three characters in alphabet to displayed version
+    return release + str(len(book)) + "-" + alpha[end - 4] + alpha[end - 2] + alpha[end]
 
 
 def recover_words() -> None:
     """
-    Parses each line in the 'words' file as a Word.
+    Opens the stored words as the base of the book.
+    Replaying the saved mutations does not change the book, so they are not tracked as changes on this thread, while
+    changes made on other threads still are. The lock is held while the words are recovered, so that Words which have
+    already been loaded are not read by other threads while the journal is still being replayed.
     """
 
-    dest = "data/words"
-
-    if path.exists(dest):
-        # If the file exists, open it and parse
-        word_file = open(dest)
-        for line in word_file:
-            # Attempt to parse a Word from the current line
-            word = parse_line(line)
-            if word is not None:
-                # Store Word if it has been parsed successfully
-                book[hash(word)] = word
-    else:
-        # Create the file if it is missing
-        file = open(dest, "w+")
-        file.close()
+    with lock:
+        changeset.enabled = False
+        try:
+            storage.recover(book)
+        finally:
+            changeset.enabled = True
 
 
 def save():
     """
     Saves all stored word and user data.
+    Only the mutations made since the last save are persisted. They are staged at once, with copies of whatever the
+    storage reads from the book, so other threads can keep changing the book while they are written; the lock is only
+    held again while the storage updates the book with what was written. The mutations stay in the changeset until they
+    have been written, so a failed save loses none of them.
+
+    :raises RuntimeError: If the words could not be recovered, as saving part of the book could overwrite the rest
     """
 
     global savek, greeting
 
-    # First clear the words data file
-    open("data/words", "w").close()
-    words = open("data/words", "r+")
-    words.truncate(0)
+    refuse()
+
+    with saving:
+        with lock:
+            # Collect the contents of the user data before replacing it
+            data = storage.read_user_data()
 
-    # Write each formatted Word into a separate line in the empty file
-    for word in book.values():
-        words.write(word.format())
-    words.close()
+            if 4 <= len(data):
+                # Overwrite the third and fourth lines of the data file with the new save key and greeting values
+                # Only updated if not an empty string
+                if savek != "":
+                    data[2] = "save," + savek + "\n"
+                if greeting != "":
+                    data[3] = "greeting," + greeting + "\n"
+                # Parts of neighbouring words are only counted from processed lines, so they are kept with the user data
+                data[3] = data[3].rstrip("\n") + "\n"
+                data[4:] = ["bigrams," + suggest.format_bigrams() + "\n"]
 
-    # Collect the contents of the user data file before erasing it
-    data = store_contents("data/user_data", create=True)
+            revision = changeset.revision
+            staged = storage.stage(book, [mutation[1:] for mutation in changeset.mutations])
 
-    if 4 <= len(data):
-        # Overwrite the third and fourth lines of the data file with the new save key and greeting values
-        # Only updated if not an empty string
-        if savek != "":
-            data[2] = "save," + savek + "\n"
-        if greeting != "":
-            data[3] = "greeting," + greeting + "\n"
+        started = stats.start()
+        written = storage.save(book, staged, data, lock)
 
-    # Open the data file and write its new contents
-    userdata = open("data/user_data", "r+")
-    for entry in data:
-        userdata.write(entry)
+        with lock:
+            changeset.persisted(revision)
 
+        if stats.enabled:
+            stats.stop("save", started)
+            stats.count("saves")
+            stats.count("save_bytes", written)
 
-def store_contents(file: str, create: bool = False) -> list:
+
+def compact() -> None:
     """
-    Reads the contents of a file into a list.
-    Each entry in the list represents a line in the provided file, if it exists.
+    Persists every known Word, so that no saved mutations need to be replayed on recovery.
 
-    :param file: The path of the file to read
-    :param create: Should the file be created if it does not exist
-    :return: A list containing the contents of the file
+    :raises RuntimeError: If the words could not be recovered, as saving part of the book could overwrite the rest
     """
 
-    if not path.exists(file):
-        if create:
-            open(file, "w+").close()
-        return []
-    else:
-        lines = []
-        for line in open(file):
-            lines.append(line)
-        return lines
+    refuse()
+
+    with saving, lock:
+        written = storage.compact(book)
+        changeset.persisted()
+
+        if stats.enabled:
+            stats.count("save_bytes", written)
+
+
+def refuse() -> None:
+    """
+    Refuses to save a book whose words could not be recovered.
+    Saves wait for the words to be recovered in the background first, as saving part of the book could lose the rest.
+    """
+
+    book.ready.wait()
+    if book.error is not None:
+        raise RuntimeError("the words could not be recovered, so they are not saved") from book.error
+
+
+def export_words(file: str = "data/words", since: int = None) -> None:
+    """
+    Writes every known Word into a text words file, which can be imported into empty storage.
+    Only the unsaved Words changed after a revision are written if one is given, which can be merged into another book
+    with the importer.
+
+    :param file: The path of the words file to write
+    :param since: The revision after which changed Words are written, if any (see the Changeset class)
+    """
+
+    if since is None:
+        write_atomic(file, (word.format() for word in book.words()))
+        return
+
+    with lock:
+        words = changeset.since(since)
+    write_atomic(file, (word.format() for word in words))
+
+
+def unsaved() -> int:
+    """
+    Provides the number of Words with changes that have not been saved.
+    """
+
+    return len(changeset)
+
+
+def pending() -> int:
+    """
+    Provides the number of mutations that have not been saved.
+    """
+
+    return len(changeset.mutations)
@@ -0,0 +1,299 @@
+"""
+Learns word statistics offline from large text corpora.
+
+Corpus files are streamed line by line through the same tokenizer and normalization as input lines, counting how often
+each word appears and how often each pair of words appears in the same line, with the same window as associate. Files
+are analyzed in a pool of worker processes. Each worker keeps at most spill_after counts in memory; whenever it holds
+more, they are sorted and spilled into a run file, so memory stays bounded however large the corpus is. The runs of
+every worker are then merged in a single streaming pass, which sums the counts of each word and pair, and either adds
+the pair counts to the keys of the known Words in the book or writes every count into a report.
+
+Only the pair counts of known words are learned, as the book keeps no word frequencies and no unknown words; the
+counts of every word, known or unknown, are only written into reports. The pair counts are learned in batches of
+flush_after Words, and the book is compacted after each batch so that the Words can be dropped from memory again.
+Memory then stays bounded however many words the book knows, while each batch rewrites the snapshot, so larger
+batches make fewer rewrites.
+
+REPORT:
+========= =========================================================================================
+known     KEY, COUNT; a known word and the number of times it appeared
+unknown   KEY, COUNT; an unknown word and the number of times it appeared
+pair      KEY, OTHER, COUNT; the number of lines in which OTHER followed or preceded KEY within the window
+========= =========================================================================================
+
+Fields are separated with tabs, and lines are in key order.
+
+Functions:
+
+    analyze(files, workers, report, directory) -> tuple
+    count_file(file, directory, window) -> tuple
+    spill(counts, directory) -> str
+    read_run(run)
+    merge_runs(runs, directory) -> list
+    totals(runs)
+    learn(merged) -> int
+    flush(keys)
+    write_report(merged, file) -> int
+
+Variables:
+
+    spill_after
+    fan_in
+    flush_after
+
+Authors:
+
+    Samuel Henderson
+"""
+
+import heapq
+import multiprocessing
+import os
+import shutil
+import tempfile
+from collections import Counter
+import src.python.accessor as acc
+from src.python.scanner import tokenize
+
+
+# The number of distinct counts a worker holds in memory before spilling them into a run
+spill_after: int = 1000000
+
+# The number of runs merged at once; more runs are first merged into fewer, larger runs
+fan_in: int = 64
+
+# The number of Words whose pair counts are learned before the book is compacted and they are dropped from memory
+flush_after: int = 100000
+
+
+def analyze(files: list, workers: int = 1, report: str = None, directory: str = None) -> tuple:
+    """
+    Analyzes corpus files and learns the pair counts into the book, or writes every count into a report.
+    The book is compacted as the counts are learned (see the learn function).
+
+    :param files: The paths of the corpus files
+    :param workers: The number of processes to analyze with; 1 analyzes in this process
+    :param report: The path of the report to write instead of learning, if any
+    :param directory: The directory runs are spilled into; a temporary directory by default
+    :return: A (lines, tokens, counts) tuple of the lines and tokens analyzed and the counts learned or reported
+    """
+
+    directory = tempfile.mkdtemp(prefix="charm-", dir=directory)
+
+    try:
+        jobs = [(file, directory, acc.key_window) for file in files]
+
+        if workers <= 1 or len(files) <= 1:
+            results = [count_file(*job) for job in jobs]
+        else:
+            with multiprocessing.Pool(min(workers, len(files))) as pool:
+                results = pool.starmap(count_file, jobs)
+
+        runs = [run for result in results for run in result[0]]
+        lines = sum(result[1] for result in results)
+        tokens = sum(result[2] for result in results)
+
+        merged = totals(merge_runs(runs, directory))
+
+        if report is not None:
+            return lines, tokens, write_report(merged, report)
+
+        with acc.lock:
+            learned = learn(merged)
+        return lines, tokens, learned
+    finally:
+        shutil.rmtree(directory, ignore_errors=True)
+
+
+def count_file(file: str, directory: str, window: int) -> tuple:
+    """
+    Counts the words and pairs of words in each line of a file, spilling the counts into runs whenever they grow too
+    many.
+
+    Words are counted as 'w\\tKEY' entries, and each pair in both directions as 'p\\tKEY\\tOTHER' entries. Keys never
+    contain tabs, as the tokenizer splits lines on whitespace.
+
+    :param file: The path of the corpus file
+    :param directory: The directory to spill runs into
+    :param window: The number of following words in a line that each word is paired with
+    :return: A (runs, lines, tokens) tuple of the paths of the runs and the lines and tokens counted
+    """
+
+    normalize = acc.book.normalize
+    counts = Counter()
+    runs = []
+    lines = 0
+    tokens = 0
+
+    with open(file, encoding='utf-8', errors='replace') as stream:
+        for line in stream:
+            keys = [normalize(token) for token in tokenize(line)]
+            lines += 1
+            tokens += len(keys)
+
+            entries = ["w\t" + key for key in keys]
+
+            # Each word is only paired once per line, with the words within the window before and after it
+            distinct = list(dict.fromkeys(keys))
+            for index, key in enumerate(distinct):
+                prefix = "p\t" + key + "\t"
+                entries.extend(prefix + other for other in distinct[max(0, index - window):index])
+                entries.extend(prefix + other for other in distinct[index + 1:index + 1 + window])
+
+            # Counting a whole line at once is much faster than incrementing each entry
+            counts.update(entries)
+
+            if spill_after <= len(counts):
+                runs.append(spill(counts, directory))
+                counts = Counter()
+
+    if 0 < len(counts):
+        runs.append(spill(counts, directory))
+
+    return runs, lines, tokens
+
+
+def spill(counts, directory: str) -> str:
+    """
+    Writes counts into a new run file in entry order.
+
+    :param counts: A dictionary of entries to counts, or an iterable of (entry, count) tuples already in entry order
+    :return: The path of the run
+    """
+
+    descriptor, run = tempfile.mkstemp(suffix=".run", dir=directory)
+
+    if isinstance(counts, dict):
+        # Sorting the entries alone is much faster than sorting (entry, count) tuples
+        lines = (entry + "\t" + str(counts[entry]) + "\n" for entry in sorted(counts))
+    else:
+        lines = (entry + "\t" + str(count) + "\n" for entry, count in counts)
+
+    with open(descriptor, "w", encoding='utf-8') as out:
+        out.writelines(lines)
+
+    return run
+
+
+def read_run(run: str):
+    """
+    Yields the (entry, count) tuples of a run in order.
+    """
+
+    with open(run, encoding='utf-8') as stream:
+        for line in stream:
+            entry, count = line[:-1].rsplit("\t", 1)
+            yield entry, int(count)
+
+
+def merge_runs(runs: list, directory: str) -> list:
+    """
+    Merges runs into at most fan_in runs, so that they can be merged without opening too many files at once.
+
+    :return: The paths of the remaining runs
+    """
+
+    while fan_in < len(runs):
+        merged = []
+        for start in range(0, len(runs), fan_in):
+            group = runs[start:start + fan_in]
+            merged.append(spill(totals(group), directory))
+            for run in group:
+                os.remove(run)
+        runs = merged
+
+    return runs
+
+
+def totals(runs: list):
+    """
+    Merges runs and yields each entry once with the sum of its counts, in entry order.
+    """
+
+    entry = None
+    total = 0
+
+    for current, count in heapq.merge(*[read_run(run) for run in runs], key=lambda item: item[0]):
+        if current != entry:
+            if entry is not None:
+                yield entry, total
+            entry = current
+            total = 0
+        total += count
+
+    if entry is not None:
+        yield entry, total
+
+
+def learn(merged) -> int:
+    """
+    Adds the merged pair counts to the keys of the known Words in the book.
+    Pairs of unknown words are skipped, as only known Words are associated with each other, and the counts of words are
+    skipped, as the book has nowhere to keep them; they are only written into reports.
+
+    Every flush_after Words, the book is compacted and the Words are released from memory, so looking up every known
+    Word does not hold the whole book in memory. The book is compacted once more after the last batch.
+
+    :return: The number of pair counts learned
+    """
+
+    book = acc.book
+    learned = 0
+    current = None
+    word = None
+    batch = []
+
+    for entry, count in merged:
+        if entry[0] != "p":
+            continue
+
+        kind, key, other = entry.split("\t")
+
+        # The pairs of each word are consecutive, so each Word is only looked up once
+        if key != current:
+            if flush_after <= len(batch):
+                flush(batch)
+                batch = []
+
+            current = key
+            word = book.get(key)
+            if word is not None:
+                batch.append(key)
+
+        if word is not None and book.knows(other):
+            word.add_key(other, count)
+            learned += 1
+
+    flush(batch)
+    return learned
+
+
+def flush(keys: list) -> None:
+    """
+    Compacts the book and releases the Words of a batch from memory.
+    """
+
+    acc.compact()
+    acc.book.release(keys)
+
+
+def write_report(merged, file: str) -> int:
+    """
+    Writes every merged count into a report, marking each word as known or unknown.
+
+    :return: The number of counts written
+    """
+
+    book = acc.book
+    written = 0
+
+    with open(file, "w", encoding='utf-8') as out:
+        for entry, count in merged:
+            kind, rest = entry.split("\t", 1)
+            if kind == "p":
+                out.write("pair\t" + rest + "\t" + str(count) + "\n")
+            else:
+                out.write(("known" if book.knows(rest) else "unknown") + "\t" + rest + "\t" + str(count) + "\n")
+            written += 1
+
+    return written
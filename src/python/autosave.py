@@ -0,0 +1,159 @@
+"""
+Saves the book automatically on a background thread.
+
+A save is made once after_changes mutations are pending, once the oldest pending mutation has waited interval seconds,
+when a save is requested, and when Charm exits or is terminated. The scheduler only checks how many mutations are
+pending every tick seconds, so making mutations costs nothing more while it runs. Bursts of mutations are coalesced:
+once enough are pending, the save waits until no mutation has been made for a tick, unless the interval runs out first.
+
+Saves take the pending mutations at once and write them without holding the lock of the book, so input is not held up
+while they are flushed to disk. A save that is interrupted, even by a kill, leaves the saved data intact; the journal
+ignores an incomplete final entry and every other file is replaced by renaming.
+
+Setting after_changes or interval to 0 turns saving by that measure off, so the book can be saved only after a number
+of changes, or only after an interval.
+
+Functions:
+
+    start(changes, seconds)
+    request()
+    stop()
+    terminate(signum, frame)
+
+Variables:
+
+    after_changes
+    interval
+    tick
+    thread
+
+Authors:
+
+    Samuel Henderson
+"""
+
+import atexit
+import signal
+import sys
+import threading
+import time
+import src.python.accessor as acc
+
+
+# The number of pending mutations after which a save is made
+after_changes: int = 100
+
+# The number of seconds a pending mutation waits at most before it is saved
+interval: float = 60.0
+
+# The number of seconds between checks of the pending mutations
+tick: float = 0.5
+
+# The thread saves are made on, while the scheduler is running
+thread: threading.Thread = None
+
+# Set to stop the scheduler
+stopping = threading.Event()
+
+# Set to save as soon as possible
+requested = threading.Event()
+
+
+def start(changes: int = None, seconds: float = None) -> None:
+    """
+    Starts saving the book in the background, and saves it once more on exit or termination.
+    Termination is only handled when the scheduler is started on the main thread.
+
+    :param changes: The number of pending mutations after which a save is made, if not after_changes; 0 for none
+    :param seconds: The number of seconds a pending mutation waits at most, if not interval; 0 for no limit
+    """
+
+    global after_changes, interval, thread
+
+    if thread is not None:
+        return
+
+    after_changes = after_changes if changes is None else changes
+    interval = interval if seconds is None else seconds
+
+    stopping.clear()
+    thread = threading.Thread(target=run, name="autosave", daemon=True)
+    thread.start()
+
+    atexit.register(stop)
+    if threading.current_thread() is threading.main_thread():
+        signal.signal(signal.SIGTERM, terminate)
+
+
+def run() -> None:
+    """
+    Checks the pending mutations every tick, and saves them once they are due.
+    """
+
+    oldest = None
+    last = None
+    previous = 0
+
+    while not stopping.wait(tick):
+        count = acc.pending()
+        now = time.monotonic()
+
+        if count == 0:
+            # There is nothing to save
+            requested.clear()
+            oldest = None
+            previous = 0
+            continue
+
+        if oldest is None:
+            oldest = now
+        if count != previous:
+            # The burst is still going on
+            previous = count
+            last = now
+
+        quiet = tick <= now - last
+        if requested.is_set() or (0 < after_changes <= count and quiet) or 0 < interval <= now - oldest:
+            requested.clear()
+            try:
+                acc.save()
+            except Exception as error:
+                # The mutations are kept, and saving is tried again once they are due
+                # Any failure is reported rather than ending the thread, which would stop every later save
+                print("Could not save: " + type(error).__name__ + ": " + str(error), file=sys.stderr)
+            oldest = None
+            previous = 0
+
+
+def request() -> None:
+    """
+    Requests a save on the background thread, without waiting for it.
+    """
+
+    requested.set()
+
+
+def stop() -> None:
+    """
+    Stops the scheduler, waiting for a save in progress, and saves any mutations that are still pending.
+    """
+
+    global thread
+
+    if thread is None:
+        return
+
+    stopping.set()
+    thread.join()
+    thread = None
+
+    if 0 < acc.pending():
+        acc.save()
+
+
+def terminate(signum, frame) -> None:
+    """
+    Exits when Charm is terminated, so that the pending mutations are saved on exit.
+    """
+
+    sys.exit(128 + signum)
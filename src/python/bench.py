@@ -0,0 +1,1235 @@
+"""
+Measures the performance of Charm.
+
+The suite generates synthetic data files of several sizes and times recovering, looking up, learning and saving words
+with them. Its results can be written into a JSON report and compared against the report of an earlier run, failing
+when any time has grown beyond a threshold.
+
+Functions:
+
+    memory(count) -> float
+    lexicon(count, seed) -> list
+    suggestions(count) -> dict
+    phrase_index(count, length) -> dict
+    typos(count) -> dict
+    derived_indexes(count) -> dict
+    corpus(count, files, workers) -> dict
+    importing(count) -> dict
+    tokenizing(megabytes) -> dict
+    similarity(count, queries) -> dict
+    loading(megabytes, counts) -> dict
+    kill_saves(kills, seed) -> dict
+    kill_child(root)
+    crash_saves(rounds) -> dict
+    shared_compactions(rounds) -> dict
+    background_changes(rounds) -> dict
+    generate(root, count)
+    suite(sizes, repeats) -> dict
+    compare(report, baseline, threshold) -> list
+    startup(sizes, fast) -> dict
+    imports() -> dict
+
+Authors:
+
+    Samuel Henderson
+"""
+
+import argparse
+import heapq
+import json
+import os
+import os.path as path
+import platform
+import random
+import shutil
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+import tracemalloc
+import src.python.accessor as acc
+import src.python.analyzer as analyzer
+import src.python.fuzzy as fuzzy
+import src.python.indexes as indexes
+import src.python.listener as ltr
+import src.python.loader as loader
+import src.python.phrases as phrases
+import src.python.scanner as scanner
+import src.python.suggest as suggest
+from src.python.data import *
+from src.python.storage import DERIVED, FileStorage, ProfileStorage
+from src.python.vocabulary import Vocabulary
+
+
+# Suffixes that mostly mark a part of speech in synthetic lexicons
+ENDINGS = {
+    Part.NOUN: ["tion", "ness", "ment", "er", "ity"],
+    Part.VERB: ["ize", "ate", "ify", "en"],
+    Part.ADJC: ["ous", "ful", "ive", "able", "al"],
+    Part.ADVB: ["ly"],
+}
+
+
+def memory(count: int = 1000000) -> float:
+    """
+    Measures the memory held by Words with two parts of speech and an empty definition.
+    The word strings themselves are allocated before measuring, as they are the same for any representation of a Word.
+
+    :param count: The number of Words to build
+    :return: The number of bytes allocated per Word, including its reference in a list
+    """
+
+    strings = ['w%07d' % index for index in range(count)]
+
+    tracemalloc.start()
+    words = [Word(string, [1, 3]) for string in strings]
+    allocated = tracemalloc.get_traced_memory()[0]
+    tracemalloc.stop()
+
+    del words
+    return allocated / count
+
+
+def lexicon(count: int, seed: int = 0) -> list:
+    """
+    Generates a synthetic lexicon whose parts of speech mostly follow their suffixes.
+    One in ten words is assigned a random part of speech regardless of its suffix.
+
+    :return: A list of (word, Part) tuples
+    """
+
+    generator = random.Random(seed)
+    letters = "abcdefghijklmnopqrstuvwxyz"
+    parts = list(ENDINGS)
+    out = []
+
+    for index in range(count):
+        part = generator.choice(parts)
+        stem = "".join(generator.choice(letters) for _ in range(generator.randint(3, 7)))
+        word = stem + generator.choice(ENDINGS[part])
+
+        if generator.random() < 0.1:
+            part = generator.choice(by_index[1:])
+        out.append((word, part))
+
+    return out
+
+
+def suggestions(count: int = 100000) -> dict:
+    """
+    Measures the accuracy and latency of part of speech suggestions.
+    Suggestions are trained incrementally on nine in ten words of a synthetic lexicon and tested on the rest.
+
+    :param count: The number of words in the lexicon
+    :return: The accuracy of all suggestions, the share and accuracy of those above the acceptance threshold, and the
+             mean microseconds taken to learn a word and to make a suggestion
+    """
+
+    words = lexicon(count)
+    split = count * 9 // 10
+
+    suggest.trained = True
+    start = time.perf_counter()
+    for word, part in words[:split]:
+        suggest.learn(word, part)
+    learning = (time.perf_counter() - start) / split
+
+    correct = accepted = accepted_correct = 0
+    start = time.perf_counter()
+    for word, part in words[split:]:
+        guess, confidence = suggest.best(word)
+        correct += guess is part
+        if suggest.threshold <= confidence:
+            accepted += 1
+            accepted_correct += guess is part
+    tests = count - split
+    suggesting = (time.perf_counter() - start) / tests
+
+    return {
+        "accuracy": correct / tests,
+        "accepted": accepted / tests,
+        "accepted_accuracy": accepted_correct / accepted if accepted else 0.0,
+        "learn_us": learning * 1e6,
+        "suggest_us": suggesting * 1e6,
+    }
+
+
+def phrase_index(count: int = 100000, length: int = 10) -> dict:
+    """
+    Measures the throughput, memory and queries of the phrase index.
+    Lines are drawn from a vocabulary of ten thousand words. Queries count, look for and continue phrases of the lines,
+    every one of which must be found, as the index never undercounts.
+
+    :param count: The number of lines to record
+    :param length: The number of words in each line
+    :return: The lines recorded per second, the bytes held by the index, the number of Phrases counted exactly, the
+             microseconds taken by each query and the fraction of recorded phrases found
+    """
+
+    generator = random.Random(0)
+    vocabulary = ['w%d' % index for index in range(10000)]
+
+    lines = [[generator.choice(vocabulary) for _ in range(length)] for _ in range(count)]
+
+    start = time.perf_counter()
+    for line in lines:
+        phrases.record(line)
+    elapsed = time.perf_counter() - start
+
+    # The word strings are shared with the lines, so only the containers are counted
+    held = sys.getsizeof(phrases.sketch) + sys.getsizeof(phrases.table) + sys.getsizeof(phrases.followers)
+    for phrase in phrases.table:
+        held += sys.getsizeof(phrase) + sys.getsizeof(phrase.words)
+    for counts in phrases.followers.values():
+        held += sys.getsizeof(counts)
+
+    samples = []
+    for line in generator.choices(lines, k=1000):
+        start = generator.randrange(length)
+        samples.append(line[start:start + generator.randint(1, phrases.max_length)])
+
+    start = time.perf_counter()
+    found = sum(1 for sample in samples if phrases.seen(sample) and 0 < phrases.count(sample))
+    for sample in samples:
+        phrases.continuations(sample)
+    queried = time.perf_counter() - start
+
+    return {
+        "lines_per_second": count / elapsed,
+        "bytes": held,
+        "phrases": len(phrases.table),
+        "query_us": queried / (3 * len(samples)) * 1e6,
+        "recall": found / len(samples),
+    }
+
+
+def typos(count: int = 1000000) -> dict:
+    """
+    Measures the typo index over the words of a synthetic lexicon.
+    Each query replaces one character of a known word.
+
+    :param count: The number of words in the lexicon
+    :return: The seconds taken to build the index, the mean microseconds taken by a query, and the share of queries
+             that found the word they were made from
+    """
+
+    generator = random.Random(0)
+    words = list(dict.fromkeys(word for word, part in lexicon(count)))
+
+    start = time.perf_counter()
+    fuzzy.build(words)
+    building = time.perf_counter() - start
+
+    queries = []
+    for word in generator.sample(words, min(10000, len(words))):
+        index = generator.randrange(len(word))
+        queries.append((word[:index] + "#" + word[index + 1:], word))
+
+    found = 0
+    start = time.perf_counter()
+    for query, word in queries:
+        found += word in fuzzy.matches(query)
+    querying = (time.perf_counter() - start) / len(queries)
+
+    return {
+        "build_seconds": building,
+        "query_us": querying * 1e6,
+        "recall": found / len(queries),
+    }
+
+
+def derived_indexes(count: int = 1000000) -> dict:
+    """
+    Measures loading the indexes derived from a snapshot against building them from the book, with a synthetic book
+    whose words are defined with five other words.
+
+    :param count: The number of words in the lexicon
+    :return: The seconds taken to recover the book with its indexes, to recover it without them and then build them,
+             and to compact the book with and without deriving them
+    """
+
+    root = tempfile.mkdtemp(prefix="charm-bench-")
+    try:
+        generate(root, count)
+        words = list(dict(lexicon(count)).items())
+        generator = random.Random(count)
+
+        with open(path.join(root, "words"), "w") as out:
+            for word, part in words:
+                defn = " ".join(other for other, _ in generator.choices(words, k=5))
+                out.write(word + "," + str(part.indx()) + "," + defn + ",\n")
+
+        reset(root)
+        acc.recover_words()
+
+        def build() -> None:
+            suggest.train(acc.book.words())
+            fuzzy.build(acc.book.keys())
+            indexes.build(acc.book.words(), acc.book.normalize)
+
+        reset(root)
+        loaded = timed(acc.recover_words) + timed(build)
+
+        derived = FileStorage.derived
+        FileStorage.derived = lambda storage, generation: [(module, path.join(root, "missing")) for module in DERIVED]
+        try:
+            reset(root)
+            built = timed(acc.recover_words) + timed(build)
+        finally:
+            FileStorage.derived = derived
+
+        compact = timed(acc.compact)
+
+        builders = FileStorage.builders
+        FileStorage.builders = lambda storage, book, words: []
+        try:
+            plain = timed(acc.compact)
+        finally:
+            FileStorage.builders = builders
+
+        return {"load_seconds": loaded, "build_seconds": built, "compact_seconds": compact, "plain_seconds": plain}
+    finally:
+        if acc.book.base is not None:
+            acc.book.base.close()
+        shutil.rmtree(root)
+
+
+def corpus(count: int = 100000, files: int = 2, workers: int = 1) -> dict:
+    """
+    Measures the corpus analyzer over synthetic text files.
+    Lines of twelve words are drawn from a synthetic lexicon of fifty thousand words.
+
+    :param count: The number of lines in each file
+    :param files: The number of files
+    :param workers: The number of processes to count with
+    :return: The words counted per second, the seconds taken to merge the runs, the number of runs and merged counts,
+             and the peak bytes traced while counting a single file
+    """
+
+    generator = random.Random(0)
+    words = [word for word, part in lexicon(50000)]
+    directory = tempfile.mkdtemp(prefix="charm-bench-")
+
+    try:
+        paths = []
+        for index in range(files):
+            paths.append(path.join(directory, "corpus%d.txt" % index))
+            with open(paths[-1], "w") as out:
+                for _ in range(count):
+                    out.write(" ".join(generator.choice(words) for _ in range(12)) + "\n")
+
+        jobs = [(file, directory, acc.key_window) for file in paths]
+
+        start = time.perf_counter()
+        if workers <= 1:
+            results = [analyzer.count_file(*job) for job in jobs]
+        else:
+            import multiprocessing
+
+            with multiprocessing.Pool(workers) as pool:
+                results = pool.starmap(analyzer.count_file, jobs)
+        counting = time.perf_counter() - start
+
+        runs = [run for result in results for run in result[0]]
+
+        start = time.perf_counter()
+        merged = sum(1 for _ in analyzer.totals(analyzer.merge_runs(runs, directory)))
+        merging = time.perf_counter() - start
+
+        tracemalloc.start()
+        for run in analyzer.count_file(paths[0], directory, acc.key_window)[0]:
+            os.remove(run)
+        peak = tracemalloc.get_traced_memory()[1]
+        tracemalloc.stop()
+    finally:
+        shutil.rmtree(directory, ignore_errors=True)
+
+    return {
+        "words_per_second": sum(result[2] for result in results) / counting,
+        "merge_seconds": merging,
+        "runs": len(runs),
+        "counts": merged,
+        "peak_bytes": peak,
+    }
+
+
+def importing(count: int = 300000) -> dict:
+    """
+    Measures importing a synthetic word list into a book of a thousand words, with records of a synthetic lexicon that
+    are each defined and given three keys.
+
+    :param count: The number of records in the word list
+    :return: The records merged per second, and the most Words held in memory at once, before a compaction
+    """
+
+    import src.python.importer as importer
+
+    root = tempfile.mkdtemp(prefix="charm-bench-")
+    try:
+        generate(root, 1000)
+        words = [word for word, part in lexicon(count, seed=1)]
+        generator = random.Random(count)
+
+        with open(path.join(root, "list.csv"), "w") as out:
+            for index, word in enumerate(words):
+                keys = " ".join(other + ":" + str(generator.randint(1, 9)) for other in generator.choices(words, k=3))
+                out.write(word + ",1,defined as record " + str(index) + "," + keys + "\n")
+
+        reset(root)
+        acc.recover_words()
+
+        flush = analyzer.flush
+        held = [0]
+
+        def counted(keys: list) -> None:
+            held[0] = max(held[0], len(acc.book.entries))
+            flush(keys)
+
+        analyzer.flush = counted
+        try:
+            start = time.perf_counter()
+            merged, skipped, errors = importer.import_files([path.join(root, "list.csv")])
+            elapsed = time.perf_counter() - start
+        finally:
+            analyzer.flush = flush
+
+        return {"words_per_second": merged / elapsed, "held": held[0]}
+    finally:
+        if acc.book.base is not None:
+            acc.book.base.close()
+        shutil.rmtree(root)
+
+
+def tokenizing(megabytes: int = 16) -> dict:
+    """
+    Measures the cost of tokenizing input with the translation table of the default alphabet.
+    Lines of twelve words are drawn from a synthetic lexicon, with punctuation after a fifth of the words.
+
+    :param megabytes: The amount of input to tokenize
+    :return: The milliseconds taken to tokenize a megabyte, and to split a megabyte on whitespace alone for comparison
+    """
+
+    generator = random.Random(0)
+    words = [word for word, part in lexicon(10000)]
+    marks = [",", ".", "?", "!", ";", ":"]
+
+    lines = []
+    size = 0
+    while size < megabytes * 1e6:
+        line = " ".join(word + (generator.choice(marks) if generator.random() < 0.2 else "")
+                        for word in generator.sample(words, 12))
+        lines.append(line)
+        size += len(line) + 1
+
+    start = time.perf_counter()
+    for line in lines:
+        scanner.tokenize(line)
+    tokenized = time.perf_counter() - start
+
+    start = time.perf_counter()
+    for line in lines:
+        line.split()
+    split = time.perf_counter() - start
+
+    return {
+        "tokenize_ms_per_mb": tokenized * 1e3 * 1e6 / size,
+        "split_ms_per_mb": split * 1e3 * 1e6 / size,
+    }
+
+
+def similarity(count: int = 100000, queries: int = 100) -> dict:
+    """
+    Measures building word features and finding similar words with them, against comparing the keys of every Word in
+    Python. Each word of a synthetic lexicon is counted with twenty random words.
+
+    :param count: The number of words in the lexicon
+    :param queries: The number of words to find similar words for
+    :return: The seconds taken to build the features, and the milliseconds taken to answer a query with them and by
+             comparing keys in Python
+    """
+
+    import math
+    import src.python.features as features
+
+    generator = random.Random(0)
+    book = Vocabulary()
+    words = list(dict.fromkeys(word for word, part in lexicon(count)))
+
+    for word in words:
+        book.add(Word(word, [generator.randint(1, 9)]))
+    for word in words:
+        obj = book.get(word)
+        for _ in range(20):
+            obj.add_key(generator.choice(words), generator.randint(1, 5))
+
+    start = time.perf_counter()
+    table = features.build(book)
+    building = time.perf_counter() - start
+
+    keys = generator.sample(words, queries)
+    start = time.perf_counter()
+    table.neighbours(keys, 10)
+    batched = (time.perf_counter() - start) / queries
+
+    # Compare keys in Python for a few queries, as it is far slower
+    vectors = {word: dict(book.get(word).keys.items()) for word in words}
+    norms = {word: math.sqrt(sum(count * count for count in vector.values())) for word, vector in vectors.items()}
+    sample = keys[:max(1, queries // 20)]
+    start = time.perf_counter()
+    for key in sample:
+        query = vectors[key]
+        scores = {other: sum(count * query.get(ident, 0) for ident, count in vector.items())
+                  / (norms[key] * norms[other]) for other, vector in vectors.items() if other != key}
+        heapq.nlargest(10, scores.items(), key=lambda item: item[1])
+    python = (time.perf_counter() - start) / len(sample)
+
+    return {
+        "build_seconds": building,
+        "query_ms": batched * 1e3,
+        "python_query_ms": python * 1e3,
+    }
+
+
+def loading(megabytes: int = 256, counts: list = None) -> dict:
+    """
+    Measures loading a synthetic words file serially and with several numbers of worker processes.
+    Every word has a definition and up to twelve keys, which mostly are the most common words of the lexicon.
+
+    :param megabytes: The size of the words file
+    :param counts: The numbers of processes to load with; 1 loads serially
+    :return: A dictionary of each number of processes to the seconds taken to load the file
+    """
+
+    generator = random.Random(0)
+    words = list(dict.fromkeys(word for word, part in lexicon(200000)))
+    directory = tempfile.mkdtemp(prefix="charm-bench-")
+    file = path.join(directory, "words")
+
+    try:
+        with open(file, "w") as out:
+            size = 0
+            while size < megabytes * 1e6:
+                word = generator.choice(words)
+                keys = " ".join(words[int(len(words) ** generator.random()) - 1] + ":" + str(generator.randint(1, 9))
+                                for _ in range(generator.randint(0, 12)))
+                line = "%s,%d,a definition of %s,%s\n" % (word, generator.randint(1, 9), word, keys)
+                out.write(line)
+                size += len(line)
+
+        times = {}
+        for count in counts or [1, 2, 4]:
+            # Every load starts from an empty book with no interned keys
+            symbols.clear()
+            interned.clear()
+
+            book = Vocabulary()
+            start = time.perf_counter()
+            loader.load(book, file, count)
+            times[count] = time.perf_counter() - start
+            del book
+    finally:
+        shutil.rmtree(directory, ignore_errors=True)
+
+    return times
+
+
+def kill_round(index: int) -> None:
+    """
+    Makes the mutations of one round of the kill test: learning a word, associating it with earlier ones and sometimes
+    defining one, through the accessor as the listener would.
+    """
+
+    acc.add_word("k%d" % index, Part.NOUN)
+    acc.associate([acc.book.get("k%d" % other) for other in (index, index // 2, index // 3, index % 7)])
+    if index % 5 == 0:
+        acc.define(acc.book.get("k%d" % (index // 5)), "round %d" % index)
+
+
+def kill_child(root: str) -> None:
+    """
+    Recovers the book in a directory and runs kill rounds after the rounds it holds, saving after each and printing its
+    index once it is saved, until the process is killed. The journal is compacted every few rounds, so that kills land
+    in every part of a save.
+    """
+
+    acc.book = Vocabulary()
+    acc.storage = FileStorage(root, compact_after=25)
+    acc.recover_words()
+
+    index = 0
+    while acc.book.get("k%d" % index) is not None:
+        index += 1
+
+    while True:
+        kill_round(index)
+        acc.save()
+        print(index, flush=True)
+        index += 1
+
+
+def kill_saves(kills: int = 20, seed: int = 0) -> dict:
+    """
+    Kills a process that keeps learning and saving words at random moments, and checks after each kill that the book
+    it left behind recovers to exactly the state of some round, and to no round before the last it reported as saved.
+    The expected state of each round is made by running the same rounds on an empty book that is never saved.
+
+    :param kills: The number of times to kill the process
+    :param seed: The seed of the random delays before each kill
+    :return: A dictionary with the number of kills, the rounds saved and a list of the kills whose recovery failed
+    """
+
+    generator = random.Random(seed)
+    root = tempfile.mkdtemp()
+    failures = []
+    saved = -1
+    rounds = 0
+
+    try:
+        with open(path.join(root, "user_data"), "w") as out:
+            out.write(" ".join("abcdefghijklmnopqrstuvwxyz") + "\nversion,0.1.0-0.0-\nsave,save\ngreeting,hello\n")
+        open(path.join(root, "words"), "w").close()
+
+        for kill in range(kills):
+            child = subprocess.Popen(command("-m", "src.python.bench", "--kill-child", root), env=environment(),
+                                     cwd=environment()["PYTHONPATH"], stdout=subprocess.PIPE, text=True)
+            time.sleep(generator.uniform(0.3, 1.0))
+            child.kill()
+            reported = child.communicate()[0].split()
+            if reported:
+                saved = max(saved, int(reported[-1]))
+
+            # Recover as Charm would on its next start
+            book = Vocabulary()
+            FileStorage(root).recover(book)
+            rounds = 0
+            while book.get("k%d" % rounds) is not None:
+                rounds += 1
+
+            expected = simulate_rounds(rounds)
+            if rounds <= saved or any(describe_word(book.get(key)) != state for key, state in expected.items()):
+                failures.append(kill)
+
+            if book.base is not None:
+                book.base.close()
+    finally:
+        shutil.rmtree(root, ignore_errors=True)
+
+    return {"kills": kills, "rounds": rounds, "failures": failures}
+
+
+class Interrupted(BaseException):
+    """
+    Stands in for a kill at a chosen point of a save.
+    """
+
+
+def crash_saves(rounds: int = 60) -> dict:
+    """
+    Interrupts saves at every flush to disk and file replacement they make, one point at a time, as a kill at that
+    point would, and checks that the book recovers to exactly the state of the last round that was saved, or of the
+    round whose save was interrupted. Unlike kill_saves, every point is reached, including those between the steps of a
+    compaction.
+
+    :param rounds: The number of kill rounds to run, saving after each
+    :return: A dictionary with the number of points interrupted and a list of the points whose recovery failed
+    """
+
+    replace, fsync = os.replace, os.fsync
+    failures = []
+    target = 1
+
+    while True:
+        root = tempfile.mkdtemp()
+        operations = [0]
+
+        def counted(function):
+            def run(*args, **kwargs):
+                operations[0] += 1
+                if operations[0] == target:
+                    raise Interrupted
+                return function(*args, **kwargs)
+            return run
+
+        try:
+            with open(path.join(root, "user_data"), "w") as out:
+                out.write(" ".join("abcdefghijklmnopqrstuvwxyz") + "\nversion,0.1.0-0.0-\nsave,save\ngreeting,hello\n")
+            open(path.join(root, "words"), "w").close()
+
+            book, storage = acc.book, acc.storage
+            acc.book = Vocabulary()
+            acc.storage = FileStorage(root, compact_after=25)
+            acc.recover_words()
+
+            saved = -1
+            os.replace, os.fsync = counted(replace), counted(fsync)
+            try:
+                for index in range(rounds):
+                    kill_round(index)
+                    acc.save()
+                    saved = index
+            except Interrupted:
+                pass
+            finally:
+                os.replace, os.fsync = replace, fsync
+                changeset.persisted()
+                if acc.book.base is not None:
+                    acc.book.base.close()
+                acc.book, acc.storage = book, storage
+
+            if saved == rounds - 1:
+                # Every point has been interrupted
+                return {"points": target - 1, "failures": failures}
+
+            recovered = Vocabulary()
+            FileStorage(root).recover(recovered)
+            count = 0
+            while recovered.get("k%d" % count) is not None:
+                count += 1
+
+            expected = simulate_rounds(count)
+            if count not in (saved + 1, saved + 2) or \
+                    any(describe_word(recovered.get(key)) != state for key, state in expected.items()):
+                failures.append(target)
+
+            if recovered.base is not None:
+                recovered.base.close()
+        finally:
+            shutil.rmtree(root, ignore_errors=True)
+
+        target += 1
+
+
+def shared_compactions(rounds: int = 10) -> dict:
+    """
+    Compacts a profile and then the shared book it reads, round after round, as separate processes using them would,
+    and checks that the profile reads back every definition it saved. The definitions are not ASCII, so one read from
+    the wrong file is either wrong or cannot be decoded.
+
+    :param rounds: The number of rounds
+    :return: A dictionary with the number of definitions read back and a list of the keys read back wrong
+    """
+
+    root = tempfile.mkdtemp(prefix="charm-bench-")
+    book, storage = acc.book, acc.storage
+    expected = {}
+    checked = 0
+    failures = []
+
+    def use(opened) -> None:
+        # Each storage is opened as a new process would open it
+        if acc.book.base is not None:
+            acc.book.base.close()
+        acc.book = Vocabulary()
+        acc.storage = opened
+        changeset.persisted()
+        acc.recover_words()
+
+    try:
+        words = generate(root, 1000)
+        shared = words[:rounds]
+
+        for index in range(rounds):
+            use(FileStorage(root))
+            # Every shared definition is replaced by one of another length, so all of them move in the file
+            for word in shared:
+                acc.define(acc.book.get(word), "partagé %d pour %s" % (index, word) + "é" * index)
+            acc.compact()
+
+            use(ProfileStorage("bench", root))
+            # The profile changes a Word with a shared definition without defining it, and defines another
+            changed = acc.book.get(shared[index])
+            acc.add_part(changed, next(part for part in by_index[1:] if not changed.has_part(part)))
+            expected[changed.word] = changed.defn
+            defined = acc.book.get(words[rounds + index])
+            expected[defined.word] = "défini %d pour %s" % (index, defined.word)
+            acc.define(defined, expected[defined.word])
+            acc.compact()
+
+            try:
+                use(ProfileStorage("bench", root))
+                failures.extend(key for key, defn in expected.items() if acc.book.get(key).defn != defn)
+            except UnicodeDecodeError:
+                # Recovering the profile reads definitions too, and stops at the first that cannot be decoded
+                failures.extend(expected)
+            checked += len(expected)
+    finally:
+        if acc.book.base is not None:
+            acc.book.base.close()
+        acc.book, acc.storage = book, storage
+        changeset.persisted()
+        shutil.rmtree(root, ignore_errors=True)
+
+    return {"checked": checked, "failures": failures}
+
+
+def background_changes(rounds: int = 10) -> dict:
+    """
+    Recovers the book in the background, as 'charm.py --fast-start' does, and defines a Word that the journal has
+    already replayed while the rest of the journal is held up, round after round; then checks that every definition was
+    saved, as the changes made while the book is recovered must not be mistaken for the replay.
+
+    :param rounds: The number of rounds
+    :return: A dictionary with the number of definitions read back and a list of the keys read back wrong
+    """
+
+    root = tempfile.mkdtemp(prefix="charm-bench-")
+    book, storage = acc.book, acc.storage
+    expected = {}
+    failures = []
+
+    def held(apply, target: str, replayed):
+        def run(opened_book, operation: str, word: str, argument: str) -> None:
+            apply(opened_book, operation, word, argument)
+            if word == target:
+                replayed.set()
+                # Hold up the rest of the replay, as a long journal would
+                time.sleep(0.05)
+        return run
+
+    try:
+        words = generate(root, 1000)
+
+        for index in range(rounds):
+            reset(root)
+            acc.recover_words()
+            acc.define(acc.book.get(words[index]), "journal %d" % index)
+            acc.save()
+
+            reset(root)
+            replayed = threading.Event()
+            acc.storage.apply = held(acc.storage.apply, words[index], replayed)
+            acc.book.load(acc.recover_words)
+            replayed.wait()
+
+            expected[words[index]] = "background %d" % index
+            acc.define(acc.book.get(words[index]), expected[words[index]])
+            acc.book.wait()
+            acc.save()
+
+        reset(root)
+        acc.recover_words()
+        failures = [key for key, defn in expected.items() if acc.book.get(key).defn != defn]
+    finally:
+        acc.book.wait()
+        if acc.book.base is not None:
+            acc.book.base.close()
+        acc.book, acc.storage = book, storage
+        changeset.persisted()
+        shutil.rmtree(root, ignore_errors=True)
+
+    return {"checked": len(expected), "failures": failures}
+
+
+def simulate_rounds(rounds: int) -> dict:
+    """
+    Runs kill rounds on an empty book that is never saved.
+
+    :return: The state of each Word afterwards (see describe_word), by key
+    """
+
+    book, storage = acc.book, acc.storage
+    acc.book = Vocabulary()
+
+    try:
+        for index in range(rounds):
+            kill_round(index)
+        return {key: describe_word(word) for key, word in acc.book.entries.items()}
+    finally:
+        changeset.persisted()
+        acc.book, acc.storage = book, storage
+
+
+def describe_word(word: Word) -> tuple:
+    """
+    Provides the parts, definition and key counts of a Word, which do not depend on the order keys were interned in.
+    """
+
+    if word is None:
+        return None
+    return word.mask, word.defn, dict(word.keys.items()) if word.keys is not None else {}
+
+
+def generate(root: str, count: int) -> list:
+    """
+    Writes a synthetic words file and user data file.
+
+    :param root: The directory to write data/words and data/user_data into
+    :param count: The number of words to write
+    :return: The distinct words written
+    """
+
+    parts = dict(lexicon(count))
+
+    with open(path.join(root, "words"), "w") as out:
+        for word, part in parts.items():
+            out.write(word + "," + str(part.indx()) + ",,\n")
+
+    with open(path.join(root, "user_data"), "w") as out:
+        out.write(" ".join("abcdefghijklmnopqrstuvwxyz") + "\n")
+        out.write("version,0.1.0-0.0-\n")
+        out.write("save,save\n")
+        out.write("greeting,hello\n")
+
+    return list(parts)
+
+
+def reset(root: str) -> None:
+    """
+    Replaces the book and storage, as though Charm had just started with data in a directory.
+    """
+
+    acc.book = Vocabulary()
+    acc.storage = FileStorage(root, compact_after=sys.maxsize)
+    changeset.persisted()
+
+
+def best(measure, repeats: int) -> float:
+    """
+    Provides the shortest of several measurements, which is the least disturbed by other work on the machine.
+    """
+
+    return min(measure() for _ in range(repeats))
+
+
+def timed(function, *args) -> float:
+    start = time.perf_counter()
+    function(*args)
+    return time.perf_counter() - start
+
+
+def suite(sizes: list, repeats: int = 3) -> dict:
+    """
+    Times recovering, looking up, learning and saving words with synthetic data of several sizes.
+    Every time is in seconds; add_word is timed per word and unknown_words per line.
+
+    METRICS:
+    ================= =========================================================================================
+    recover_words     importing the text words file into an empty book
+    recover_snapshot  opening the snapshot and replaying an empty journal
+    recover_user_data reading the user data
+    unknown_words     finding the first unknown word of a line of 1000 words, one in ten unknown
+    add_word          learning a new word
+    prefixed          finding the first 20 words with a two-letter prefix, once the words of the lines are looked up
+    save              journaling 500 learned words and replacing the user data
+    compact           writing every word into a new snapshot
+    ================= =========================================================================================
+
+    :param sizes: The numbers of words to generate
+    :param repeats: The number of times each measurement is repeated; the shortest time is reported
+    :return: The times of each metric, by size
+    """
+
+    results = {}
+
+    for size in sizes:
+        root = tempfile.mkdtemp(prefix="charm-bench-")
+        try:
+            words = generate(root, size)
+            generator = random.Random(size)
+            times = {}
+
+            def recover() -> float:
+                reset(root)
+                return timed(acc.recover_words)
+
+            times["recover_words"] = best(recover, repeats)
+            times["compact"] = best(lambda: timed(acc.compact), repeats)
+            times["recover_snapshot"] = best(recover, repeats)
+            times["recover_user_data"] = best(lambda: timed(acc.recover_user_data), repeats)
+
+            lines = []
+            for _ in range(20):
+                line = generator.choices(words, k=1000)
+                for index in range(0, len(line), 10):
+                    line[index] = "unknown%d" % generator.randrange(size)
+                generator.shuffle(line)
+                lines.append(line)
+
+            def lookup() -> float:
+                return timed(lambda: [ltr.unknown_words(line) for line in lines]) / len(lines)
+
+            times["unknown_words"] = best(lookup, repeats)
+
+            # The lines have materialized their words, so both the prefix tree and the snapshot are walked
+            prefixes = sorted({word[:2] for word in words})
+
+            def prefixed() -> float:
+                return timed(lambda: [acc.book.prefixed(prefix, 20) for prefix in prefixes]) / len(prefixes)
+
+            times["prefixed"] = best(prefixed, repeats)
+
+            learned = iter(range(sys.maxsize))
+
+            def learn() -> float:
+                batch = ["learned%d" % next(learned) for _ in range(500)]
+                return timed(lambda: [acc.add_word(word, Part.NOUN) for word in batch]) / len(batch)
+
+            def save() -> float:
+                learn()
+                return timed(acc.save)
+
+            times["add_word"] = best(learn, repeats)
+            changeset.persisted()
+            times["save"] = best(save, repeats)
+
+            results[str(size)] = times
+        finally:
+            if acc.book.base is not None:
+                acc.book.base.close()
+            shutil.rmtree(root)
+
+    return results
+
+
+def compare(report: dict, baseline: dict, threshold: float) -> list:
+    """
+    Compares the times of a report against those of a baseline report.
+    Only the metrics and sizes present in both reports are compared.
+
+    :param threshold: The fraction by which a time may grow before it is a regression
+    :return: A list of (size, metric, baseline time, time) tuples for each regression
+    """
+
+    regressions = []
+
+    for size, times in report["results"].items():
+        previous = baseline["results"].get(size, {})
+        for metric, seconds in times.items():
+            if metric in previous and previous[metric] * (1 + threshold) < seconds:
+                regressions.append((size, metric, previous[metric], seconds))
+
+    return regressions
+
+
+def run_suite(options: argparse.Namespace) -> int:
+    """
+    Runs the suite, writes and compares its report as requested and prints the results.
+
+    :return: The exit status; 1 if any time regressed beyond the threshold
+    """
+
+    report = {
+        "python": platform.python_version(),
+        "platform": platform.platform(),
+        "repeats": options.repeats,
+        "results": suite(options.sizes, options.repeats),
+    }
+
+    for size, times in report["results"].items():
+        for metric, seconds in times.items():
+            print("%9s %-18s %12.3f ms" % (size, metric, seconds * 1e3))
+
+    if options.report is not None:
+        with open(options.report, "w") as out:
+            json.dump(report, out, indent=2)
+
+    if options.baseline is None:
+        return 0
+
+    with open(options.baseline) as source:
+        regressions = compare(report, json.load(source), options.threshold)
+
+    for size, metric, previous, seconds in regressions:
+        print("regression: %s %s took %.3f ms, up from %.3f ms (+%.0f%%)"
+              % (size, metric, seconds * 1e3, previous * 1e3, (seconds / previous - 1) * 100))
+
+    return 1 if regressions else 0
+
+
+def command(*args) -> list:
+    """
+    Provides the command line that runs this Python interpreter with arguments.
+    """
+
+    return [sys.executable] + list(args)
+
+
+def environment() -> dict:
+    """
+    Provides the environment that Charm is run in, with the repository importable.
+    """
+
+    root = path.dirname(path.dirname(path.dirname(path.abspath(__file__))))
+    return dict(os.environ, PYTHONPATH=root)
+
+
+def startup(sizes: list, fast: bool = True) -> dict:
+    """
+    Measures the time from starting Charm on the console to its first line of output, with text words files of several
+    sizes.
+
+    :param sizes: The numbers of words to generate
+    :param fast: Whether to start with the words loaded in the background
+    :return: The seconds taken to print the first line, by size
+    """
+
+    charm = path.join(path.dirname(path.abspath(__file__)), "charm.py")
+    results = {}
+
+    for size in sizes:
+        root = tempfile.mkdtemp(prefix="charm-bench-")
+        try:
+            generate(root, size)
+
+            start = time.perf_counter()
+            process = subprocess.Popen(command("-u", charm, "--data", root) + (["--fast-start"] if fast else []),
+                                       stdin=subprocess.PIPE, stdout=subprocess.PIPE, env=environment(), text=True)
+            process.stdout.readline()
+            results[str(size)] = time.perf_counter() - start
+
+            process.communicate("x\n")
+        finally:
+            shutil.rmtree(root)
+
+    return results
+
+
+def imports() -> dict:
+    """
+    Measures the time taken to import Charm with -X importtime.
+
+    :return: The cumulative microseconds taken to import each module, slowest first
+    """
+
+    process = subprocess.run(command("-X", "importtime", "-c", "import src.python.charm"), env=environment(),
+                             stderr=subprocess.PIPE, stdout=subprocess.DEVNULL, text=True, check=True)
+
+    modules = {}
+    for line in process.stderr.splitlines():
+        if not line.startswith("import time:") or "cumulative" in line:
+            continue
+        own, cumulative, module = line[len("import time:"):].split("|")
+        modules[module.strip()] = int(cumulative)
+
+    return dict(sorted(modules.items(), key=lambda item: -item[1]))
+
+
+def main(args: list) -> None:
+    parser = argparse.ArgumentParser(prog="bench", description="Charm benchmarks")
+    parser.add_argument("--words", type=int, default=1000000, help="the number of words to measure")
+    parser.add_argument("--suggest", type=int, metavar="WORDS", help="measure suggestions over a synthetic lexicon")
+    parser.add_argument("--phrases", type=int, metavar="LINES", help="measure the phrase index over synthetic lines")
+    parser.add_argument("--typos", type=int, metavar="WORDS", help="measure the typo index over a synthetic lexicon")
+    parser.add_argument("--indexes", type=int, metavar="WORDS",
+                        help="measure loading the indexes written with a snapshot against building them from the book")
+    parser.add_argument("--corpus", type=int, metavar="LINES",
+                        help="measure the corpus analyzer over synthetic files of LINES lines")
+    parser.add_argument("--workers", type=int, default=1, help="the number of processes the corpus analyzer uses")
+    parser.add_argument("--spill-after", type=int, default=analyzer.spill_after, metavar="N",
+                        help="the number of counts the corpus analyzer holds before spilling them")
+    parser.add_argument("--import", type=int, metavar="RECORDS", dest="records",
+                        help="measure importing a synthetic word list of RECORDS records")
+    parser.add_argument("--flush-after", type=int, metavar="N",
+                        help="the number of Words the importer merges before compacting the book")
+    parser.add_argument("--tokenize", type=int, metavar="MB", help="measure tokenizing MB megabytes of input")
+    parser.add_argument("--similar", type=int, metavar="WORDS",
+                        help="measure word features and similarity queries over a synthetic lexicon; needs NumPy")
+    parser.add_argument("--load", type=int, metavar="MB",
+                        help="measure loading a synthetic words file of MB megabytes with each number of --processes")
+    parser.add_argument("--processes", type=int, nargs="+", default=[1, 2, 4], metavar="N",
+                        help="the numbers of processes --load loads with; 1 loads serially")
+    parser.add_argument("--kill-save", type=int, metavar="KILLS",
+                        help="kill a process that keeps saving KILLS times, and check that every kill recovers")
+    parser.add_argument("--kill-child", metavar="DIR", help=argparse.SUPPRESS)
+    parser.add_argument("--profiles", type=int, metavar="ROUNDS",
+                        help="check that a profile keeps its definitions while the shared book is compacted")
+    parser.add_argument("--background", type=int, metavar="ROUNDS",
+                        help="check that changes made while the words are recovered in the background are saved")
+    parser.add_argument("--suite", action="store_true", help="time loading, lookups, learning and saving")
+    parser.add_argument("--startup", action="store_true",
+                        help="time the imports and the first line printed, with and without --fast-start")
+    parser.add_argument("--sizes", type=int, nargs="+", default=[1000, 100000, 1000000], metavar="WORDS",
+                        help="the numbers of words the suite generates data with")
+    parser.add_argument("--repeats", type=int, default=3, help="the number of times the suite repeats each timing")
+    parser.add_argument("--report", metavar="FILE", help="write the results of the suite into the JSON file FILE")
+    parser.add_argument("--baseline", metavar="FILE", help="compare the results of the suite against a JSON report")
+    parser.add_argument("--threshold", type=float, default=0.2,
+                        help="the fraction a time may grow by before it is reported as a regression")
+    options = parser.parse_args(args)
+
+    if options.suite:
+        sys.exit(run_suite(options))
+    elif options.kill_child is not None:
+        kill_child(options.kill_child)
+    elif options.kill_save is not None:
+        result = kill_saves(options.kill_save)
+        print("kill-save: %d kills, %d rounds saved, %d recoveries lost or changed saved rounds"
+              % (result["kills"], result["rounds"], len(result["failures"])))
+        crashes = crash_saves()
+        print("kill-save: %d points of saves interrupted, %d recoveries lost or changed saved rounds"
+              % (crashes["points"], len(crashes["failures"])))
+        if result["failures"] or crashes["failures"]:
+            sys.exit(1)
+    elif options.profiles is not None:
+        result = shared_compactions(options.profiles)
+        print("profiles: %d definitions read back after compacting the shared book, %d wrong"
+              % (result["checked"], len(result["failures"])))
+        if result["failures"]:
+            sys.exit(1)
+    elif options.background is not None:
+        result = background_changes(options.background)
+        print("background: %d definitions made while the words were recovered, %d lost"
+              % (result["checked"], len(result["failures"])))
+        if result["failures"]:
+            sys.exit(1)
+    elif options.startup:
+        for module, cumulative in list(imports().items())[:10]:
+            print("import: %-28s %8.1f ms" % (module, cumulative / 1e3))
+        fast, slow = startup(options.sizes), startup(options.sizes, fast=False)
+        for size in fast:
+            print("startup: %9s words, first line after %.3f s (%.3f s without --fast-start)"
+                  % (size, fast[size], slow[size]))
+    elif options.load is not None:
+        times = loading(options.load, options.processes)
+        if loader.processors() < max(options.processes):
+            # Loads are never given more processes than there are processors
+            print("load: only %d processors are available; larger counts load with that many" % loader.processors())
+        for count, seconds in times.items():
+            print("load: %3d processes, %.1f s (%.2fx)" % (count, seconds, times[options.processes[0]] / seconds))
+    elif options.similar is not None:
+        result = similarity(options.similar)
+        print("similar: built in %.2f s, %.2f ms/query batched (%.1f ms/query comparing keys in Python)"
+              % (result["build_seconds"], result["query_ms"], result["python_query_ms"]))
+    elif options.tokenize is not None:
+        result = tokenizing(options.tokenize)
+        print("tokenize: %.1f ms/MB (%.1f ms/MB splitting on whitespace alone)"
+              % (result["tokenize_ms_per_mb"], result["split_ms_per_mb"]))
+    elif options.corpus is not None:
+        analyzer.spill_after = options.spill_after
+        result = corpus(options.corpus, max(2, options.workers), options.workers)
+        print("corpus: %.0f words/s counting, merged %d runs into %d counts in %.1f s, %.1f MB peak per file"
+              % (result["words_per_second"], result["runs"], result["counts"], result["merge_seconds"],
+                 result["peak_bytes"] / 1e6))
+    elif options.records is not None:
+        import src.python.importer as importer
+
+        importer.flush_after = options.flush_after or importer.flush_after
+        result = importing(options.records)
+        print("import: %.0f words/s, at most %d Words held in memory, compacting every %d Words"
+              % (result["words_per_second"], result["held"], importer.flush_after))
+    elif options.typos is not None:
+        result = typos(options.typos)
+        print("typos: built in %.1f s, %.1f us/query, %.1f%% found"
+              % (result["build_seconds"], result["query_us"], result["recall"] * 100))
+    elif options.indexes is not None:
+        result = derived_indexes(options.indexes)
+        print("indexes: recovered and ready in %.2f s loading them (%.2f s building them), compacted in %.2f s "
+              "deriving them (%.2f s without)" % (result["load_seconds"], result["build_seconds"],
+                                                  result["compact_seconds"], result["plain_seconds"]))
+    elif options.phrases is not None:
+        result = phrase_index(options.phrases)
+        print("phrases: %.0f lines/s, %.1f MB for %d exact phrases, %.1f us/query, %.1f%% of recorded phrases found"
+              % (result["lines_per_second"], result["bytes"] / 1e6, result["phrases"], result["query_us"],
+                 result["recall"] * 100))
+    elif options.suggest is not None:
+        result = suggestions(options.suggest)
+        print("suggest: %.1f%% accurate, %.1f%% accepted at %.2f (%.1f%% accurate), %.1f us/learn, %.1f us/suggestion"
+              % (result["accuracy"] * 100, result["accepted"] * 100, suggest.threshold,
+                 result["accepted_accuracy"] * 100, result["learn_us"], result["suggest_us"]))
+    else:
+        print("memory: %.1f bytes/word at %d words" % (memory(options.words), options.words))
+
+
+if __name__ == '__main__':
+    main(sys.argv[1:])
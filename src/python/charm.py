@@ -1,16 +1,238 @@
+import argparse
+import atexit
+import sys
+import time
 import src.python.accessor as acc
+import src.python.autosave as autosave
 import src.python.listener as ltr
+import src.python.stats as stats
+from src.python.storage import FileStorage, ProfileStorage, SQLiteStorage
 
 
-def init():
-    acc.recover_data()
+def init(background: bool = False):
+    acc.recover_data(background)
     greet_user()
 
 
 def greet_user() -> None:
     print(acc.greeting)
     ltr.wait()
+    ltr.warn_unsaved()
+
+
+def batch(source: str, answers: str = None) -> None:
+    """
+    Processes every line of a file without user interaction and reports the throughput.
+
+    :param source: The path of the file to process, or '-' to process the standard input
+    :param answers: The path of a file that answers prompts line by line, if any
+    """
+
+    acc.recover_data()
+
+    ltr.stream = sys.stdin if source == '-' else open(source)
+    if answers is not None:
+        ltr.answers = open(answers)
+
+    count = 0
+    start = time.perf_counter()
+
+    try:
+        for line in ltr.lines():
+            ltr.process_input(line)
+            count += 1
+    except EOFError:
+        # The answers were exhausted while a prompt was waiting
+        ltr.post_query("Ran out of answers")
+    finally:
+        # Report even when the exit command ends the batch early
+        elapsed = time.perf_counter() - start
+        rate = count / elapsed if elapsed > 0 else 0.0
+        ltr.post_query("Processed " + str(count) + " lines", "%.1f lines/s" % rate, mode='v')
+        ltr.warn_unsaved()
+
+
+def parse_args(args: list) -> argparse.Namespace:
+    parser = argparse.ArgumentParser(prog="charm", description="Charm interactive console")
+    parser.add_argument("--batch", metavar="FILE", help="process the lines of FILE ('-' for stdin) and exit")
+    parser.add_argument("--answers", metavar="FILE", help="answer prompts from the lines of FILE in batch mode")
+    parser.add_argument("--export", metavar="FILE", help="write every known word into the text words file FILE")
+    parser.add_argument("--storage", choices=["file", "sqlite"], default="file", help="the backend to store data in")
+    parser.add_argument("--data", metavar="DIR", default="data", help="the directory data is stored in")
+    parser.add_argument("--user", metavar="NAME",
+                        help="use the profile NAME, which keeps its changes over the shared book in DIR/users/NAME")
+    parser.add_argument("--serve", metavar="[HOST:]PORT", help="serve sessions over TCP instead of the console")
+    parser.add_argument("--socket", metavar="PATH", help="serve sessions over a Unix socket instead of the console")
+    parser.add_argument("--load-workers", type=int, metavar="N",
+                        help="parse a large data/words file in N processes when there is no snapshot to load")
+    parser.add_argument("--fast-start", action="store_true",
+                        help="greet immediately and load the words in the background")
+    parser.add_argument("--autosave", type=int, metavar="N",
+                        help="save in the background once N changes are pending (0 for never), and on exit")
+    parser.add_argument("--autosave-interval", type=float, metavar="SECONDS",
+                        help="save in the background once a change has been pending for SECONDS (0 for no limit), "
+                             "and on exit")
+    parser.add_argument("--stats", action="store_true", help="collect statistics, shown by the 'stats' command")
+    parser.add_argument("--stats-file", metavar="FILE",
+                        help="collect statistics and write them into FILE on exit; as JSON if FILE ends with .json, "
+                             "or as Prometheus text otherwise")
+
+    commands = parser.add_subparsers(dest="command")
+
+    importer = commands.add_parser("import", help="merge words from word lists into the book")
+    importer.add_argument("files", nargs="+", metavar="FILE", help="a csv, tsv or jsonl word list")
+    importer.add_argument("--format", choices=["csv", "tsv", "jsonl"], help="the format of every FILE")
+    importer.add_argument("--workers", type=int, default=1, help="the number of processes to parse with")
+
+    analyzer = commands.add_parser("analyze", help="learn how often words appear together from text corpora")
+    analyzer.add_argument("files", nargs="+", metavar="CORPUS", help="a text file")
+    analyzer.add_argument("--workers", type=int, default=1, help="the number of processes to analyze with")
+    analyzer.add_argument("--report", metavar="FILE",
+                          help="write the counts of every word and pair into FILE instead of learning them")
+    analyzer.add_argument("--spill-after", type=int, metavar="N",
+                          help="the number of counts each process holds in memory before spilling them to disk")
+    analyzer.add_argument("--temp", metavar="DIR", help="the directory counts are spilled into")
+    analyzer.add_argument("--flush-after", type=int, metavar="N",
+                          help="the number of words learned before the book is compacted and they are released")
+
+    similar = commands.add_parser("similar", help="find the words most often counted with the same words, with NumPy")
+    similar.add_argument("words", nargs="*", metavar="WORD", help="a word to find similar words for")
+    similar.add_argument("-n", type=int, default=10, help="the number of similar words to find for each WORD")
+    similar.add_argument("--parts", action="store_true", help="count the words assigned to each part of speech")
+    similar.add_argument("--save", metavar="FILE", help="write the word features into the NumPy .npz file FILE")
+
+    return parser.parse_args(args)
+
+
+def configure(kind: str, root: str, user: str = None) -> None:
+    """
+    Selects the backend that the book and user data are stored in.
+
+    :param kind: The kind of backend; 'file' or 'sqlite'
+    :param root: The directory data is stored in
+    :param user: The name of the user profile to use, if any; only file storage has profiles
+    :raises ValueError: If the user profile cannot be used
+    """
+
+    if user is not None:
+        if kind != "file":
+            raise ValueError("user profiles are only supported with file storage")
+        acc.storage = ProfileStorage(user, root)
+    elif kind == "sqlite":
+        acc.storage = SQLiteStorage(root=root)
+    else:
+        acc.storage = FileStorage(root)
+
+
+def import_words(files: list, form: str = None, workers: int = 1) -> None:
+    """
+    Merges words from word lists into the book and reports the throughput.
+    """
+
+    import src.python.importer as importer
+
+    acc.recover_data(interactive=False)
+
+    start = time.perf_counter()
+    count, skipped, errors = importer.import_files(files, form, workers)
+    elapsed = time.perf_counter() - start
+
+    ltr.post_query("Imported " + str(count) + " words", "%.1f words/s" % (count / elapsed if elapsed > 0 else 0.0),
+                   mode='v')
+
+    if 0 < skipped:
+        ltr.post_query("Skipped " + str(skipped) + " malformed lines")
+        for file, line, error in errors:
+            ltr.post_query("Skipped line " + str(line) + " of " + file, error, mode='v')
+
+
+def analyze_corpus(files: list, workers: int = 1, report: str = None, temp: str = None) -> None:
+    """
+    Analyzes text corpora, learning the counts into the book or writing them into a report, and reports the throughput.
+    """
+
+    import src.python.analyzer as analyzer
+
+    acc.recover_data(interactive=False)
+
+    start = time.perf_counter()
+    lines, tokens, counts = analyzer.analyze(files, workers, report, temp)
+    elapsed = time.perf_counter() - start
+
+    ltr.post_query("Analyzed " + str(lines) + " lines and " + str(tokens) + " words",
+                   ("reported " if report is not None else "learned ") + str(counts) + " counts, "
+                   + "%.1f words/s" % (tokens / elapsed if elapsed > 0 else 0.0), mode='v')
+
+
+def find_similar(words: list, n: int = 10, parts: bool = False, save: str = None) -> None:
+    """
+    Builds the features of every known word and reports the words most similar to each word.
+
+    :raises ImportError: If NumPy is not installed
+    """
+
+    import src.python.features as features
+
+    acc.recover_data(interactive=False)
+
+    start = time.perf_counter()
+    with acc.lock:
+        table = features.build(acc.book)
+    elapsed = time.perf_counter() - start
+    ltr.post_query("Built the features of " + str(len(table)) + " words", "%.2f s" % elapsed, mode='v')
+
+    for word, found in zip(words, table.neighbours([acc.book.normalize(word) for word in words], n)):
+        ltr.post_query(word, ", ".join("%s %.3f" % pair for pair in found) or "no similar words", mode='v')
+
+    if parts:
+        for part, count in table.part_counts().items():
+            ltr.post_query(str(part), str(count), mode='v')
+
+    if save is not None:
+        table.save(save)
 
 
 if __name__ == '__main__':
-    init()
+    options = parse_args(sys.argv[1:])
+    try:
+        configure(options.storage, options.data, options.user)
+    except ValueError as error:
+        sys.exit("charm: " + str(error))
+    if options.load_workers is not None:
+        import src.python.loader as loader
+
+        loader.workers = options.load_workers
+    if options.stats or options.stats_file is not None:
+        stats.enable()
+    if options.stats_file is not None:
+        atexit.register(stats.dump, options.stats_file)
+    if options.autosave is not None or options.autosave_interval is not None:
+        autosave.start(options.autosave, options.autosave_interval)
+    if options.command == "import":
+        import_words(options.files, options.format, options.workers)
+    elif options.command == "analyze":
+        import src.python.analyzer as analyzer
+
+        analyzer.spill_after = options.spill_after or analyzer.spill_after
+        analyzer.flush_after = options.flush_after or analyzer.flush_after
+        analyze_corpus(options.files, options.workers, options.report, options.temp)
+    elif options.command == "similar":
+        try:
+            find_similar(options.words, options.n, options.parts, options.save)
+        except ImportError as error:
+            sys.exit("charm: " + str(error))
+    elif options.serve is not None or options.socket is not None:
+        import src.python.server as server
+
+        if options.socket is not None:
+            server.serve(path=options.socket)
+        else:
+            host, port = options.serve.rpartition(":")[::2]
+            server.serve(host or "127.0.0.1", int(port))
+    elif options.export is not None:
+        acc.recover_data(interactive=False)
+        acc.export_words(options.export)
+    elif options.batch is not None:
+        batch(options.batch, options.answers)
+    else:
+        init(options.fast_start)
@@ -4,7 +4,9 @@ Contains classes and parsing functions relevant to data storage.
 Classes:
 
     Part
+    Keys
     Word
+    Changeset
     Phrase
 
 Functions:
@@ -13,6 +15,19 @@ Functions:
     parts()
     names()
     get_part(index)
+    intern(key) -> int
+    intern_keys(keys) -> array
+    symbol(ident) -> str
+    roll(code, word) -> int
+
+Variables:
+
+    by_index
+    by_name
+    symbols
+    interned
+    key_limit
+    changeset
 
 Authors:
 
@@ -20,7 +35,23 @@ Authors:
 """
 
 import enum
-from dataclasses import dataclass
+import heapq
+import operator
+import threading
+from array import array
+from bisect import bisect_left
+from itertools import compress, repeat
+import src.python.definitions as definitions
+
+
+# The key strings that have been interned, indexed by their ids
+symbols: list = []
+
+# The id of each interned key string
+interned: dict = {}
+
+# The maximum number of keys counted for a single Word
+key_limit: int = 1024
 
 
 class Part(enum.Enum):
@@ -56,6 +87,8 @@ class Part(enum.Enum):
             The returned value is always inclusively between 1 and 9.
         name() -> str:
             Provides the name attached to the enumerated part of speech on which it is called.
+        bit() -> int:
+            Provides the bit that represents the enumerated part of speech in a Word's mask of parts.
 
     """
 
@@ -71,12 +104,6 @@ class Part(enum.Enum):
     INTJ = ("interjection", 8)
     DETE = ("determiner", 9)
 
-    def __hash__(self):
-        return hash(self.name())
-
-    def __eq__(self, other):
-        return self.name() == other.name() and self.indx() == other.indx()
-
     def __str__(self):
         return self.value[0]
 
@@ -86,46 +113,205 @@ class Part(enum.Enum):
     def name(self) -> str:
         return self.value[0]
 
+    def bit(self) -> int:
+        return 1 << (self.value[1] - 1)
+
+
+# Each enumerated Part at the position of its index; position 0 is unused
+by_index: tuple = (None,) + tuple(sorted(Part, key=lambda part: part.indx()))
+
+# Each enumerated Part, keyed by its name
+by_name: dict = {part.name(): part for part in Part}
+
+
+class Keys:
+    """
+    A compact, bounded set of key counts.
+
+    Keys are interned as integer ids and stored with their counts in two parallel arrays sorted by id. Once a Keys holds
+    key_limit entries, a new key replaces the entry with the lowest count and inherits that count, so the strongest keys
+    are kept while memory stays bounded.
+
+    Attributes:
+
+        ids : array
+            The sorted ids of the counted keys.
+        counts : array
+            The count of each key, in the same order as the ids.
+
+    Functions:
+
+        add(key, count):
+            Increments the count of a key.
+        get(key) -> int:
+            Provides the count of a key.
+        set(key, count):
+            Replaces the count of a key.
+        items():
+            Yields each key string and its count.
+        top(n) -> list:
+            Provides the n keys with the highest counts.
+        weakest() -> int:
+            Provides the position of the key with the lowest count.
+
+    """
+
+    __slots__ = ('ids', 'counts')
+
+    def __init__(self):
+        self.ids = array('I')
+        self.counts = array('I')
+
+    def __len__(self):
+        return len(self.ids)
+
+    def __contains__(self, key):
+        return self.find(key) != -1
+
+    def find(self, key: str) -> int:
+        """
+        Provides the position of a key in the arrays, or -1 if it is not counted.
+        """
+
+        ident = interned.get(key)
+        if ident is None:
+            return -1
+
+        index = bisect_left(self.ids, ident)
+        if index < len(self.ids) and self.ids[index] == ident:
+            return index
+        return -1
+
+    def add(self, key: str, count: int = 1) -> None:
+        """
+        Increments the count of a key, evicting the weakest key if there is no room for a new one.
+        """
+
+        index = self.find(key)
+        if index != -1:
+            self.counts[index] += count
+            return
+
+        if key_limit <= len(self.ids):
+            # Replace the weakest key; its count is inherited so that the new count is never an underestimate
+            weakest = self.weakest()
+            count += self.counts[weakest]
+            del self.ids[weakest]
+            del self.counts[weakest]
+
+        self.insert(intern(key), count)
+
+    def set(self, key: str, count: int) -> None:
+        """
+        Replaces the count of a key.
+        """
+
+        index = self.find(key)
+        if index != -1:
+            self.counts[index] = count
+        elif len(self.ids) < key_limit:
+            self.insert(intern(key), count)
+
+    def weakest(self) -> int:
+        """
+        Provides the position of the key with the lowest count.
+        Ties go to the first key in string order rather than in order of id, as ids depend on the order keys were
+        interned in, which differs between processes; replaying the journal then evicts the same keys as the live book.
+        """
+
+        lowest = min(self.counts)
+        weakest = self.counts.index(lowest)
+
+        if 1 < self.counts.count(lowest):
+            tied = [index for index, count in enumerate(self.counts) if count == lowest]
+            weakest = min(tied, key=lambda index: symbols[self.ids[index]])
+
+        return weakest
+
+    def insert(self, ident: int, count: int) -> None:
+        index = bisect_left(self.ids, ident)
+        self.ids.insert(index, ident)
+        self.counts.insert(index, count)
+
+    def get(self, key: str) -> int:
+        index = self.find(key)
+        return 0 if index == -1 else self.counts[index]
+
+    def items(self):
+        for ident, count in zip(self.ids, self.counts):
+            yield symbols[ident], count
+
+    def top(self, n: int) -> list:
+        """
+        Provides the n keys with the highest counts, strongest first.
+
+        :return: A list of (key, count) tuples
+        """
+
+        best = heapq.nlargest(n, zip(self.counts, self.ids))
+        return [(symbols[ident], count) for count, ident in best]
+
 
-@dataclass
 class Word:
     """
     A class representing a word.
 
+    Words are slotted, and their parts of speech are stored as a bitmask of Part bits with the index of the Part they
+    were first assigned to, so that large books stay compact.
+
     Attributes:
 
-        keys : dict
-            The unique keys associated with their word.
-            All key-value pairs inserted into this field should follow the model: (K: str, V: int), where
-            the value attached to a key represents the number of times it has been added.
+        keys : Keys
+            The unique keys associated with their word, or None if no keys have been added.
+            The count attached to a key represents the number of times it has been added.
         word : str
             The word string of a Word.
+        mask : int
+            The bits (see Part.bit) of the parts of speech that a Word has been assigned to.
+        top : int
+            The index of the first Part a Word was assigned to, or 0 if it has no parts.
         parts : list
-            A list of the parts of speech (see the Part class) that a Word has been assigned to.
+            A list of the parts of speech (see the Part class) that a Word has been assigned to, with the first Part
+            it was assigned to leading.
         defn : str
-            The definition of a Word.
+            The definition of a Word, read from the definitions file if the Word refers to it there.
+        text : str or int
+            The definition of a Word, or the handle of its definition in the definitions file (see the definitions
+            module).
+        revision : int
+            The revision of the last change to a Word (see the Changeset class), or 0 if it has not been changed since
+            it was loaded.
 
     Functions:
 
         top_part() -> int:
             Provides the enumerated index of the first Part a Word was assigned to.
-        parts() -> str:
-            Produces a string containing all Part indices separated by a space.
+        has_part(part) -> bool:
+            Checks whether a Word has been assigned to a part of speech.
         add_part(part):
             Assigns a Word to a new part of speech.
         add_key(key):
-            Adds a new key to the dictionary of stored keys, or increments the value attached to it.
+            Adds a new key to the stored keys, or increments the count attached to it.
+        set_key(key, count):
+            Replaces the count attached to a key.
+        top_keys(n) -> list:
+            Provides the keys with the highest counts.
+        format_keys() -> str:
+            Formats the keys of a Word as 'KEY0:V0 ... KEYN:VN'.
+        load_keys(keys):
+            Loads the counts of keys formatted as 'KEY0:V0 ... KEYN:VN'.
         define(defn):
             Updates the definition (see defn attribute) of a Word.
+        refer(handle):
+            Replaces the definition of a Word with a reference to the same definition in the definitions file.
         format() -> str:
             Provides a formatted string to be inserted as the entry of a Word into the words data file.
+        copy() -> Word:
+            Provides a copy of a Word that later changes to it do not affect.
 
     """
 
-    keys: dict
-    word: str
-    parts: list
-    defn: str = ''
+    __slots__ = ('keys', 'word', 'mask', 'top', 'text', 'revision')
 
     def __init__(self, word: str, indices: list):
         """
@@ -135,14 +321,20 @@ class Word:
         :param indices: The parts of speech that this Word is
         """
 
+        self.keys = None
         self.word = word
-        self.parts = []
+        self.mask = 0
+        self.top = 0
+        self.text = ''
+        self.revision = 0
 
         for index in indices:
             # Parse the list of indices into parts of speech to attach to this Word
-            part = get_part(int(index))
-            if part is not None and not self.parts.__contains__(part):
-                self.parts.append(part)
+            index = int(index)
+            if 0 < index < len(by_index):
+                self.mask |= 1 << (index - 1)
+                if self.top == 0:
+                    self.top = index
 
     def __hash__(self):
         # Hash words only by string so the same word strings will not be split over different Word instances
@@ -156,28 +348,31 @@ class Word:
     def __str__(self):
         return self.word
 
+    @property
+    def parts(self) -> list:
+        if self.top == 0:
+            return []
+
+        out = [by_index[self.top]]
+        for index in range(1, 10):
+            # Follow the first Part with all others in order of their indices
+            if index != self.top and self.mask & (1 << (index - 1)):
+                out.append(by_index[index])
+        return out
+
     def top_part(self) -> int:
         """
         Access the first Part this Word was assigned to
         :return: -1 indicates no parts; 1-9 indicates the index of the Part as defined in its enum entry
         """
 
-        if len(self.parts) < 1:
+        if self.top == 0:
             # No Parts
             return -1
-        return self.parts[0].indx()
-
-    def parts(self) -> str:
-        """
-        Formats the functional parts of speech of this Word into a string, separated with spaces.
-        """
+        return self.top
 
-        # Start with first Part
-        out: str = self.parts[0].value[1]
-        for index in range(1, len(self.parts)):
-            # Append a space and the next Part index
-            out = out + " " + str(self.parts[index].value[1])
-        return out
+    def has_part(self, part: Part) -> bool:
+        return self.mask & part.bit() != 0
 
     def add_part(self, part: Part) -> None:
         """
@@ -185,34 +380,112 @@ class Word:
         Duplicates are ignored.
         """
 
-        if not self.parts.__contains__(part):
-            self.parts.append(part)
+        self.mask |= part.bit()
+        if self.top == 0:
+            self.top = part.indx()
+
+        changeset.touch(self)
 
-    def add_key(self, key: str) -> None:
+    def add_key(self, key: str, count: int = 1) -> None:
         """
-        Add a key string to the dictionary of keys associated with this Word.
-        Adding an existing key will increment its value.
+        Add a key string to the keys associated with this Word.
+        Adding an existing key will increment its count.
 
         :param key: The key to add or increment
+        :param count: The amount to increment by
         """
 
         if self.keys is None:
             # Initialize keys if undefined
-            self.keys = {}
+            self.keys = Keys()
 
-        if self.keys.get(key) is None:
-            # Add first occurrence of the provided key
-            self.keys[key] = 1
-        else:
-            # Increment occurrences of existing keys
-            self.keys[key] = self.keys[key] + 1
+        self.keys.add(key, count)
+        changeset.touch(self)
+
+    def set_key(self, key: str, count: int) -> None:
+        """
+        Replace the count of a key associated with this Word.
+        """
+
+        if self.keys is None:
+            self.keys = Keys()
+
+        self.keys.set(key, count)
+        changeset.touch(self)
+
+    def top_keys(self, n: int) -> list:
+        """
+        Provides the n keys most often associated with this Word, strongest first.
+
+        :return: A list of (key, count) tuples
+        """
+
+        if self.keys is None:
+            return []
+        return self.keys.top(n)
+
+    def format_keys(self) -> str:
+        """
+        Formats the keys of this Word as 'KEY0:V0 ... KEYN:VN'.
+        """
+
+        if self.keys is None:
+            return ''
+        return ' '.join(key + ':' + str(count) for key, count in self.keys.items())
+
+    def load_keys(self, keys: str) -> None:
+        """
+        Loads the counts of keys formatted as 'KEY0:V0 ... KEYN:VN'.
+        Loading keys is not a change, so the Word is not recorded in the changeset.
+        """
+
+        if self.keys is None:
+            self.keys = Keys()
+
+        for entry in keys.split(' '):
+            if entry != '':
+                key, count = entry.rsplit(':', 1)
+                self.keys.set(key, int(count))
+
+    @property
+    def defn(self) -> str:
+        if self.text.__class__ is int:
+            return definitions.read(self)
+        return self.text
 
     def define(self, defn: str) -> None:
         """
         Define this Word.
         """
 
-        self.defn = defn
+        self.text = defn
+        changeset.touch(self)
+
+    def refer(self, handle: int) -> None:
+        """
+        Refers to the definition of this Word in the definitions file, so that its text is no longer held in memory.
+        """
+
+        self.text = handle
+
+    def copy(self):
+        """
+        Provides a copy of this Word, with copies of its keys, that later changes to this Word do not affect.
+        Copying is not a change, so the copy is not recorded in the changeset.
+        """
+
+        other = Word(self.word, ())
+        other.mask = self.mask
+        other.top = self.top
+        other.text = self.text
+        other.revision = self.revision
+
+        if self.keys is not None:
+            other.keys = Keys()
+            other.keys.ids = array('I', self.keys.ids)
+            other.keys.counts = array('I', self.keys.counts)
+
+        return other
 
     def format(self) -> str:
         """
@@ -224,46 +497,197 @@ class Word:
         # Start with the word and top Part
         out: str = self.word + "," + str(self.top_part())
 
-        for index in range(1, len(self.parts)):
+        for part in self.parts[1:]:
             # Add all other Parts followed by a space
-            out = out + " " + str(self.parts[index].indx())
+            out = out + " " + str(part.indx())
 
         if self.defn is not None:
             out = out + "," + self.defn + ","
 
-        # TODO: append keys
+        out = out + self.format_keys()
 
         return out + "\n"
 
 
-@dataclass
+class Changeset:
+    """
+    Tracks the Words that have been changed since they were last persisted.
+
+    Every change to a Word is given the next revision, and the Word is kept in order of its last change until a save
+    persists the change, so saves and exports can find what has changed without going through the whole book.
+    Loading Words is not a change; changes are not tracked on the thread that recovers the book, while changes made on
+    other threads in the meantime still are.
+
+    The mutations that made the changes are recorded with their revisions too, as they are what saves persist: the
+    journal and the database both apply each mutation rather than overwriting whole Words. A single persisted revision
+    retires both the Words and the mutations, so the two cannot disagree about what has been saved.
+
+    Attributes:
+
+        revision : int
+            The revision of the last change.
+        enabled : bool
+            Whether changes made on the current thread are being tracked.
+        words : dict
+            The unsaved Words by identity, in order of their last change.
+        mutations : list
+            The unsaved mutations, as (revision, operation, word, argument) tuples in the order they were made.
+
+    Functions:
+
+        touch(word):
+            Records a change to a Word.
+        record(operation, word, argument):
+            Records the mutation that made the last changes.
+        since(revision) -> list:
+            Provides the unsaved Words changed after a revision.
+        persisted(revision):
+            Records that the changes up to a revision have been persisted.
+
+    """
+
+    def __init__(self):
+        self.revision = 0
+        self.words = {}
+        self.mutations = []
+
+        # The identifiers of the threads whose changes are not tracked
+        self.paused = set()
+
+    def __len__(self):
+        return len(self.words)
+
+    @property
+    def enabled(self) -> bool:
+        return threading.get_ident() not in self.paused
+
+    @enabled.setter
+    def enabled(self, value: bool) -> None:
+        if value:
+            self.paused.discard(threading.get_ident())
+        else:
+            self.paused.add(threading.get_ident())
+
+    def touch(self, word) -> None:
+        if self.paused and threading.get_ident() in self.paused:
+            return
+
+        self.revision += 1
+        word.revision = self.revision
+
+        # Move the Word to the end, so that Words stay in order of their last change
+        self.words.pop(id(word), None)
+        self.words[id(word)] = word
+
+    def record(self, operation: str, word: str, argument: str) -> None:
+        """
+        Records a mutation, which is given its own revision so that it is persisted with the changes made before it.
+        """
+
+        if self.paused and threading.get_ident() in self.paused:
+            return
+
+        self.revision += 1
+        self.mutations.append((self.revision, operation, word, argument))
+
+    def since(self, revision: int = 0) -> list:
+        """
+        Provides the unsaved Words changed after a revision, in order of their last change.
+        Only the Words changed after the revision are visited.
+        """
+
+        out = []
+        for word in reversed(self.words.values()):
+            if word.revision <= revision:
+                break
+            out.append(word)
+
+        out.reverse()
+        return out
+
+    def persisted(self, revision: int = None) -> None:
+        """
+        Records that the changes up to a revision have been persisted; Words changed again since stay unsaved.
+
+        :param revision: The revision of the last persisted change, or None if every change has been persisted
+        """
+
+        if revision is None or self.revision <= revision:
+            self.words.clear()
+            self.mutations.clear()
+            return
+
+        # Mutations are in order of revision
+        count = 0
+        while count < len(self.mutations) and self.mutations[count][0] <= revision:
+            count += 1
+        del self.mutations[:count]
+
+        saved = []
+        for key, word in self.words.items():
+            if revision < word.revision:
+                break
+            saved.append(key)
+
+        for key in saved:
+            del self.words[key]
+
+
 class Phrase:
+    __slots__ = ('words', 'code')
+
     # The ordered list of words that form this Phrase
     words: list
 
-    def __init__(self, words: list):
+    # The polynomial rolling hash of the words (see roll)
+    code: int
+
+    def __init__(self, words: list, code: int = None):
         """
         Initialize this Phrase.
         The list of words that constitutes this Phrase should only be modified during initialization.
 
         :param words: The list of words representative of this Phrase.
+        :param code: The rolling hash of the words, if it has already been computed
         """
         self.words = words
 
+        if code is None:
+            code = 0
+            for word in words:
+                code = roll(code, word)
+        self.code = code
+
+    def __repr__(self):
+        return "Phrase(" + repr(self.words) + ")"
+
     def __hash__(self):
-        code = 0
-        for index in range(len(self.words)):
-            part = self.words[index]
-            code += (hash(part) * index)
-        return code
+        return self.code
 
     def __eq__(self, other):
-        if len(self.words) != len(other.words):
-            return False
-        for index in range(len(self.words)):
-            if self.words[index] != other.words[index]:
-                return False
-        return True
+        if not isinstance(other, Phrase):
+            return NotImplemented
+        # Phrases with different hashes cannot be equal, so their words are rarely compared
+        return self.code == other.code and self.words == other.words
+
+
+# The modulus and base of the polynomial rolling hash of Phrases
+PRIME = (1 << 61) - 1
+BASE = 1000003
+
+
+def roll(code: int, word: str) -> int:
+    """
+    Extends the rolling hash of a Phrase with one more word.
+    The hash of a Phrase extended word by word is the same as the hash of the whole Phrase, so the hashes of all
+    n-grams starting at one position can be computed in a single pass.
+    """
+
+    return (code * BASE + hash(word)) % PRIME
+
+
+# The Words changed since they were last persisted
+changeset: Changeset = Changeset()
 
 
 def parse_line(line: str):
@@ -274,14 +698,24 @@ def parse_line(line: str):
     :return: A new Word, or None when no Word can be parsed
     """
 
-    # Split line by spaces to read more detailed word information
-    line = line.split(',')
+    # Split line by commas to read more detailed word information
+    # The definition may itself contain commas, so only the first two are split
+    line = line.rstrip('\n').split(',', 2)
 
     # Word should be the first value
     word = line[0]
-    indices = line[1].replace('\n', '').split(' ')
+    indices = line[1].split(' ')
 
     obj = Word(word, indices)
+
+    if 2 < len(line):
+        # The definition precedes the final comma, which is followed by the keys
+        rest = line[2].rsplit(',', 1)
+        obj.text = rest[0]
+
+        if 1 < len(rest):
+            obj.load_keys(rest[1])
+
     return obj
 
 
@@ -298,10 +732,7 @@ def names() -> dict:
     Provides a dictionary of the names of each enumerated Part.
     """
 
-    out = {}
-    for part in parts():
-        out[part.name()] = part
-    return out
+    return by_name
 
 
 def get_part(index: int):
@@ -310,6 +741,44 @@ def get_part(index: int):
     Nothing is returned if no enumerated Part has the provided index.
     """
 
-    for part in parts():
-        if index == part.value[1]:
-            return part
+    if 0 < index < len(by_index):
+        return by_index[index]
+    return None
+
+
+def intern(key: str) -> int:
+    """
+    Provides the id of a key string, assigning a new id to strings that have not been interned.
+    """
+
+    ident = interned.get(key)
+    if ident is None:
+        ident = len(symbols)
+        symbols.append(key)
+        interned[key] = ident
+    return ident
+
+
+def intern_keys(keys: list) -> array:
+    """
+    Provides the ids of several distinct key strings at once, interning those that have not been interned in order.
+    """
+
+    # Each key is only looked up once, as looking up many keys is bound by memory rather than by the interpreter
+    found = list(map(interned.get, keys))
+    new = list(compress(keys, map(operator.is_, found, repeat(None))))
+
+    first = len(symbols)
+    interned.update(zip(new, range(first, first + len(new))))
+    symbols.extend(new)
+
+    assigned = iter(range(first, first + len(new)))
+    return array('I', [ident if ident is not None else next(assigned) for ident in found])
+
+
+def symbol(ident: int) -> str:
+    """
+    Provides the key string that was interned with an id.
+    """
+
+    return symbols[ident]
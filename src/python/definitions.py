@@ -0,0 +1,223 @@
+"""
+Keeps definitions out of memory in a side file that is read on demand.
+
+Definitions are written into the definitions file when the book is compacted, and Words then refer to their definition
+by its offset and length in the file instead of holding its text. Each compaction writes the definitions that are still
+referred to into a new file, which replaces the previous file together with the snapshot, so definitions that were
+replaced do not accumulate. Definitions are read through a bounded cache of the most recently read, so memory is
+dominated by the Words themselves rather than by their definitions.
+
+Several definitions files can be open at once, such as a shared file that is only read and a file of a user profile
+that is rewritten. A handle holds the offset of a definition in the bits above 32, the index of its file in the next
+four bits and its length in bytes in the rest, so handles into the first file are plain offsets and lengths.
+
+A Word's handle and the file it refers to are only ever read together under the lock, which is also held while a
+rewritten file is installed and the Words are referred to it, so a definition is never read from a closed file or
+from the wrong one, whichever threads read definitions while the book is compacted.
+
+Classes:
+
+    Rewrite
+
+Functions:
+
+    open_store(*files)
+    close()
+    read(word) -> str
+
+Variables:
+
+    stores
+    capacity
+    hits
+    misses
+
+Authors:
+
+    Samuel Henderson
+"""
+
+import os
+import threading
+from collections import OrderedDict
+import src.python.stats as stats
+
+
+# The descriptors of the open definitions files, by the index handles refer to them with; the last is rewritten
+stores: list = []
+
+# The number of bits that hold the length of a definition in a handle
+LENGTH = 28
+
+# The number of definitions cached
+capacity: int = 1024
+
+# The number of reads answered from and missing the cache
+hits: int = 0
+misses: int = 0
+
+# The most recently read definitions by handle, least recently read first
+cache: OrderedDict = OrderedDict()
+
+# Serializes rewrites and updates of the cache
+lock = threading.Lock()
+
+
+def open_store(*files) -> None:
+    """
+    Opens definitions files and empties the cache.
+    The last file is the one that is rewritten, and is created if it does not exist; the others are only read, and are
+    skipped if they do not exist.
+    """
+
+    close()
+
+    for file in files[:-1]:
+        stores.append(os.open(file, os.O_RDONLY) if os.path.exists(file) else None)
+    stores.append(os.open(files[-1], os.O_RDWR | os.O_CREAT | os.O_APPEND, 0o644))
+
+
+def close() -> None:
+    with lock:
+        for store in stores:
+            if store is not None:
+                os.close(store)
+        stores.clear()
+        cache.clear()
+
+
+def read(word) -> str:
+    """
+    Reads the definition a Word refers to, from the cache if it has been read recently.
+    The handle is read from the Word under the lock, as installing a rewritten file changes it.
+    """
+
+    global hits, misses
+
+    with lock:
+        handle = word.text
+        if handle.__class__ is not int:
+            # The Word has been defined again since it was asked for its definition
+            return handle
+
+        text = cache.get(handle)
+        hit = text is not None
+        if hit:
+            hits += 1
+            cache.move_to_end(handle)
+        else:
+            misses += 1
+            text = os.pread(stores[handle >> LENGTH & 0xF], handle & (1 << LENGTH) - 1, handle >> 32).decode('utf-8')
+            cache[handle] = text
+            if capacity < len(cache):
+                cache.popitem(last=False)
+
+    if stats.enabled:
+        stats.count("definition_hits" if hit else "definition_misses")
+
+    return text
+
+
+class Rewrite:
+    """
+    A new definitions file that the definitions still referred to are written into, and which then replaces the last
+    open definitions file.
+
+    Definitions held in memory are written as they are, and definitions in open files are copied once however many
+    Words refer to them. Definitions in the other open files are copied too, as those files may be replaced by other
+    processes, such as the shared definitions file that a profile reads, and the new file must not depend on them. Words
+    that are not written only have their definitions moved if they are in the file being replaced.
+
+    Attributes:
+
+        file : str
+            The path of the new definitions file.
+        index : int
+            The index of the definitions file that is replaced, which handles into the new file refer to.
+        moved : dict
+            The handle of each copied definition in the new file, by its handle in the replaced file.
+
+    Functions:
+
+        write(text) -> int:
+            Writes a definition, or copies the definition with a handle, into the new file.
+        move(handle) -> int:
+            Copies the definition with a handle into the new file if it is in the file being replaced.
+        flush():
+            Flushes the new file to disk.
+        install():
+            Replaces the last open definitions file with the new file.
+        discard():
+            Closes and removes the new file.
+
+    """
+
+    def __init__(self, file: str):
+        self.file = file
+        self.index = len(stores) - 1
+        self.moved = {}
+        self.size = 0
+        self.out = os.open(file, os.O_RDWR | os.O_CREAT | os.O_TRUNC | os.O_APPEND, 0o644)
+
+    def write(self, text) -> int:
+        """
+        Writes a definition into the new file.
+
+        :param text: The definition, or the handle of a definition in an open definitions file
+        :return: The handle of the definition once the new file is installed, or 0 if there is no definition
+        """
+
+        if text.__class__ is not int:
+            return self.append(text.encode('utf-8')) if text else 0
+
+        if text == 0:
+            return text
+
+        handle = self.moved.get(text)
+        if handle is None:
+            handle = self.append(os.pread(stores[text >> LENGTH & 0xF], text & (1 << LENGTH) - 1, text >> 32))
+            self.moved[text] = handle
+        return handle
+
+    def move(self, handle: int) -> int:
+        """
+        Copies the definition with a handle into the new file if it is in the file being replaced, for a Word that is
+        not written; handles into the other open files are kept, as they remain open.
+
+        :return: The handle of the definition once the new file is installed
+        """
+
+        if handle >> LENGTH & 0xF != self.index:
+            return handle
+        return self.write(handle)
+
+    def append(self, data: bytes) -> int:
+        offset = self.size
+        os.write(self.out, data)
+        self.size += len(data)
+        return offset << 32 | self.index << LENGTH | len(data)
+
+    def flush(self) -> None:
+        os.fsync(self.out)
+
+    def install(self, moved=()) -> None:
+        """
+        Replaces the last open definitions file with the new file. Cached definitions are dropped, as their handles may
+        refer to other definitions in the new file.
+
+        :param moved: (Word, handle) tuples of the Words to refer to their definitions in the new file, which is done
+                      together with the replacement so that no handle is read from the wrong file
+        """
+
+        with lock:
+            os.close(stores[self.index])
+            stores[self.index] = self.out
+            cache.clear()
+
+            for word, handle in moved:
+                word.text = handle
+
+    def discard(self) -> None:
+        os.close(self.out)
+        if os.path.exists(self.file):
+            os.remove(self.file)
@@ -0,0 +1,316 @@
+"""
+Turns the book into NumPy arrays for analytics and similarity queries.
+
+Every known Word becomes a row of three arrays: the bitmask of its parts of speech, the length of its definition and its
+key counts, which form a sparse matrix in compressed sparse row form whose columns are interned keys (see the intern
+function of the data module). The book is only walked once, when the Features are built; queries are then answered
+with array operations over every row at once.
+
+Two words are similar when they have been counted with the same keys, as measured by the cosine of their rows. Similar
+words are found through the columns of the query rows, so a query only visits the rows that share a key with it, and
+queries for many words are answered together.
+
+NumPy is an optional dependency that only this module needs. Importing the module without NumPy raises an ImportError
+that explains how to install it.
+
+Classes:
+
+    Features
+
+Functions:
+
+    build(book) -> Features
+    load(file) -> Features
+
+Variables:
+
+    budget
+
+Authors:
+
+    Samuel Henderson
+"""
+
+try:
+    import numpy as np
+except ImportError as error:
+    raise ImportError("word features require NumPy, which can be installed with 'pip install numpy'") from error
+
+from src.python.data import *
+
+
+# The number of key count products held in memory at once while answering a batch of similarity queries
+budget: int = 1 << 24
+
+
+class Features:
+    """
+    The parts of speech, definition lengths and key counts of every known Word, as NumPy arrays indexed by row.
+
+    Attributes:
+
+        keys : list
+            The key of the Word in each row.
+        rows : dict
+            The row of each key.
+        masks : ndarray
+            The bits (see Part.bit) of the parts of speech of each row, as uint16.
+        lengths : ndarray
+            The length in bytes of the definition of each row, as uint32.
+        indptr : ndarray
+            The start of the key counts of each row in indices and data, followed by their end, as int64.
+        indices : ndarray
+            The interned key id of each key count, as uint32.
+        data : ndarray
+            Each key count, as float64.
+        columns : list
+            The key string of each interned key id.
+
+    Functions:
+
+        membership() -> ndarray:
+            Provides the part membership matrix.
+        part_counts(keys) -> dict:
+            Counts the rows assigned to each part of speech.
+        length_histogram(part, bins) -> tuple:
+            Provides the histogram of the definition lengths of a part of speech.
+        similar(key, n) -> list:
+            Provides the keys of the rows most similar to a row.
+        neighbours(keys, n) -> list:
+            Provides the keys of the rows most similar to each of several rows.
+        save(file):
+            Writes the arrays into an .npz file.
+
+    """
+
+    def __init__(self, keys: list, masks, lengths, indptr, indices, data, columns: list):
+        self.keys = keys
+        self.rows = {key: row for row, key in enumerate(keys)}
+        self.masks = masks
+        self.lengths = lengths
+        self.indptr = indptr
+        self.indices = indices
+        self.data = data
+        self.columns = columns
+
+        # The row of each key count, and the squared length of each row
+        self.owners = np.repeat(np.arange(len(keys)), np.diff(indptr))
+        self.norms = np.sqrt(np.bincount(self.owners, weights=data * data, minlength=len(keys)))
+
+        # The key counts sorted by column, and the reach of each row; only built once a similarity query is made
+        self.transposed = None
+        self.reach = None
+
+    def __len__(self):
+        return len(self.keys)
+
+    def membership(self):
+        """
+        Provides the part membership matrix, with a row for each Word and a column for each Part in order of index.
+
+        :return: A boolean ndarray of shape (rows, parts)
+        """
+
+        return (self.masks[:, None] >> np.arange(len(by_index) - 1, dtype=np.uint16)) & 1 == 1
+
+    def part_counts(self, keys: list = None) -> dict:
+        """
+        Counts the rows assigned to each part of speech.
+
+        :param keys: The keys of the rows to count, or None to count every row
+        :return: A dictionary of each Part to its count, in order of index
+        """
+
+        matrix = self.membership()
+        if keys is not None:
+            matrix = matrix[[self.rows[key] for key in keys if key in self.rows]]
+
+        return dict(zip(by_index[1:], matrix.sum(axis=0).tolist()))
+
+    def length_histogram(self, part: Part = None, bins: int = 10) -> tuple:
+        """
+        Provides the histogram of the definition lengths of the defined rows assigned to a part of speech.
+
+        :param part: The Part of the rows, or None for every defined row
+        :param bins: The number of bins
+        :return: The (counts, edges) tuple of numpy.histogram
+        """
+
+        selected = self.lengths > 0
+        if part is not None:
+            selected &= self.masks & part.bit() != 0
+
+        return np.histogram(self.lengths[selected], bins=bins)
+
+    def similar(self, key: str, n: int = 10) -> list:
+        """
+        Provides the keys of the rows most similar to a row.
+
+        :return: A list of up to n (key, cosine) tuples, most similar first
+        """
+
+        return self.neighbours([key], n)[0]
+
+    def neighbours(self, keys: list, n: int = 10) -> list:
+        """
+        Provides the keys of the rows most similar to each of several rows, by the cosine of their key counts.
+        Rows that share no key with a query are never similar to it.
+
+        :param keys: The keys of the query rows
+        :param n: The number of similar rows to provide for each query
+        :return: A list with a list of up to n (key, cosine) tuples for each query, most similar first; unknown keys
+                 have no similar rows
+        """
+
+        if self.transposed is None:
+            self.transpose()
+
+        found = [[] for _ in keys]
+        queries = [(index, self.rows[key]) for index, key in enumerate(keys) if key in self.rows]
+
+        # Queries are scored in chunks, so that only about budget key count products are held at once
+        start = 0
+        while start < len(queries):
+            end = start + 1
+            reached = self.reach[queries[start][1]]
+            while end < len(queries) and reached + self.reach[queries[end][1]] <= budget:
+                reached += self.reach[queries[end][1]]
+                end += 1
+
+            part = queries[start:end]
+            owners, others, cosines = self.score([row for index, row in part])
+            bounds = np.searchsorted(owners, np.arange(len(part) + 1))
+
+            for position, (index, row) in enumerate(part):
+                # The rows that share a key with this query, without the query itself
+                candidates = others[bounds[position]:bounds[position + 1]]
+                scores = cosines[bounds[position]:bounds[position + 1]]
+                scores = np.where((candidates != row) & (scores > 0), scores, 0.0)
+
+                count = min(n, int(np.count_nonzero(scores)))
+                if count == 0:
+                    continue
+                best = np.argpartition(-scores, count - 1)[:count]
+                best = best[np.argsort(-scores[best], kind='stable')]
+                found[index] = [(self.keys[candidates[other]], float(scores[other])) for other in best]
+
+            start = end
+
+        return found
+
+    def score(self, rows: list) -> tuple:
+        """
+        Provides the cosine of each of several rows with each row that shares a key with it.
+        Scores are only reduced over the pairs of rows that share a key, so they cost nothing for the other rows.
+
+        :return: A (queries, others, cosines) tuple of ndarrays with an entry for each pair, sorted by query and then
+                 by other row; queries holds the position of each query in rows
+        """
+
+        rows = np.asarray(rows, dtype=np.int64)
+        starts, ends = self.indptr[rows], self.indptr[rows + 1]
+
+        # The key counts of the query rows, and the query each belongs to
+        counts = ends - starts
+        queries = np.repeat(np.arange(len(rows)), counts)
+        positions = expand(starts, counts)
+        columns = self.indices[positions]
+        weights = self.data[positions]
+
+        # Every key count in the columns of the query key counts
+        column_starts, column_ends = self.transposed[0][columns], self.transposed[0][columns + 1]
+        hits = column_ends - column_starts
+        entries = expand(column_starts, hits)
+        owners = self.transposed[1][entries]
+        products = np.repeat(weights, hits) * self.transposed[2][entries]
+
+        # The products are summed for each distinct (query, row) pair
+        pairs, inverse = np.unique(np.repeat(queries, hits) * len(self) + owners, return_inverse=True)
+        totals = np.bincount(inverse.ravel(), weights=products, minlength=len(pairs))
+        queries, others = np.divmod(pairs, len(self))
+
+        with np.errstate(divide='ignore', invalid='ignore'):
+            cosines = totals / (self.norms[rows][queries] * self.norms[others])
+        return queries, others, np.nan_to_num(cosines, nan=0.0, posinf=0.0)
+
+    def transpose(self) -> None:
+        """
+        Sorts the key counts by column, so that the rows with each key can be found at once.
+        """
+
+        order = np.argsort(self.indices, kind='stable')
+        width = int(self.indices.max()) + 1 if len(self.indices) else 0
+        starts = np.zeros(width + 1, dtype=np.int64)
+        np.cumsum(np.bincount(self.indices, minlength=width), out=starts[1:])
+        self.transposed = (starts, self.owners[order], self.data[order])
+
+        # The number of key counts in the columns of each row, which is how many products scoring it takes
+        sizes = np.diff(starts)[self.indices]
+        self.reach = np.bincount(self.owners, weights=sizes, minlength=len(self)).astype(np.int64)
+
+    def save(self, file: str) -> None:
+        """
+        Writes the arrays into an .npz file, with the keys of the rows and columns, which load reads back.
+        """
+
+        np.savez_compressed(file, keys=np.array(self.keys, dtype=str), masks=self.masks, lengths=self.lengths,
+                            indptr=self.indptr, indices=self.indices, data=self.data,
+                            columns=np.array(self.columns, dtype=str))
+
+
+def expand(starts, counts):
+    """
+    Provides the positions of several ranges, each given by its start and length, one after another.
+    """
+
+    total = int(counts.sum())
+    offsets = np.repeat(np.cumsum(counts) - counts, counts)
+    return np.arange(total, dtype=np.int64) - offsets + np.repeat(starts, counts)
+
+
+def build(book) -> Features:
+    """
+    Builds the Features of every known Word in a book in a single pass.
+    The key counts of each Word are copied straight from its arrays, and definitions are measured without reading
+    them from the definitions file.
+
+    :param book: The Vocabulary to build from
+    :return: The Features, with a row for each Word in the order the book yields them
+    """
+
+    keys = []
+    masks = array('H')
+    lengths = array('I')
+    sizes = array('q', [0])
+    ids = array('I')
+    counts = array('I')
+
+    for word in book.words():
+        keys.append(book.normalize(word.word))
+        masks.append(word.mask)
+
+        text = word.text
+        if text.__class__ is int:
+            # The length is held in the handle of the definition
+            lengths.append(text & (1 << definitions.LENGTH) - 1)
+        else:
+            lengths.append(len(text.encode('utf-8')))
+
+        if word.keys is not None:
+            ids.extend(word.keys.ids)
+            counts.extend(word.keys.counts)
+        sizes.append(len(ids))
+
+    return Features(keys, np.frombuffer(masks, dtype=np.uint16), np.frombuffer(lengths, dtype=np.uint32),
+                    np.frombuffer(sizes, dtype=np.int64), np.frombuffer(ids, dtype=np.uint32),
+                    np.frombuffer(counts, dtype=np.uint32).astype(np.float64), list(symbols))
+
+
+def load(file: str) -> Features:
+    """
+    Reads Features written by Features.save.
+    """
+
+    with np.load(file) as arrays:
+        return Features(arrays["keys"].tolist(), arrays["masks"], arrays["lengths"], arrays["indptr"],
+                        arrays["indices"], arrays["data"], arrays["columns"].tolist())
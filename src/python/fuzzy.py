@@ -0,0 +1,321 @@
+"""
+Finds known words that are one typo away from unknown words.
+
+A typo is a single inserted, deleted, replaced or swapped adjacent character. Every known key is indexed under itself
+and each string made by deleting one of its characters, so two keys one typo apart always share an indexed string. The
+strings are indexed by hash in a sorted array, which takes eight bytes per string, and keys learned after the array is
+built are indexed in a dictionary. A lookup hashes the strings of the unknown word and checks the few keys found under
+them, so it takes the same time however many words are known.
+
+The index is written next to each snapshot of the book when it is compacted (see the FileStorage class), and loaded
+with the snapshot when a process starts; strings are hashed with CRC-32 rather than the hash function of the process,
+which differs between processes, so a written index stays valid. An index that was not written with the snapshot is
+built from the book when the first lookup is made instead. Either way, it is updated whenever a word is learned.
+
+Classes:
+
+    Builder
+
+Functions:
+
+    build(keys)
+    load(file) -> bool
+    revise(key, previous, word)
+    learn(key)
+    matches(word) -> list
+    near(first, second) -> bool
+
+Variables:
+
+    built
+
+Authors:
+
+    Samuel Henderson
+"""
+
+import os
+import struct
+import sys
+import zlib
+from array import array
+from bisect import bisect_left
+
+
+# Whether the index has been built from the book or loaded
+built: bool = False
+
+# Every indexed key, by position
+keys: list = []
+
+# The hashes of the indexed strings, each shifted above the position of its key, in ascending order
+codes: array = array('Q')
+
+# The positions of keys indexed since the array was built, by the hash of each of their strings
+recent: dict = {}
+
+# The number of bits that hold the position of a key
+SHIFT = 32
+
+# The number of buckets the index is sorted in
+BUCKETS = 256
+BUCKET_SHIFT = 56
+
+# The header of a written index: the number of hashes, and the size of the keys in bytes
+HEADER = struct.Struct('<QQ')
+
+
+def variants(key: str) -> list:
+    """
+    Provides a key and each string made by deleting one of its characters.
+    Deleting any one of a run of repeated characters makes the same string, which is provided once for each.
+    """
+
+    return [key] + [key[:index] + key[index + 1:] for index in range(len(key))]
+
+
+def hashed(string: str) -> int:
+    """
+    Hashes an indexed string the same way in every process.
+    """
+
+    return zlib.crc32(string.encode('utf-8'))
+
+
+class Builder:
+    """
+    An index that is written into a file, or replaces the index. Keys are either added to an empty index, or to an index
+    read from the file of an earlier snapshot.
+    The entries of added keys are bucketed by their highest bits and each bucket is sorted on its own, so that only one
+    bucket is ever held as a list; the entries of an index that was read are already sorted, so the few added since are
+    merged into them.
+
+    Functions:
+
+        add(key, word):
+            Indexes a key.
+        revise(key, previous, word):
+            Indexes the key of a changed Word, if it is new.
+        read(file) -> bool:
+            Reads the index written into a file.
+        sort() -> array:
+            Sorts the entries of the indexed strings into a single array, emptying the buckets.
+        write(file) -> int:
+            Writes the index into a file, which is flushed to disk before returning.
+
+    """
+
+    def __init__(self):
+        self.keys = []
+        self.codes = array('Q')
+        self.buckets = [array('Q') for _ in range(BUCKETS)]
+
+    def add(self, key: str, word=None) -> None:
+        """
+        Indexes a key.
+
+        :param key: The normalized key
+        :param word: The Word stored under the key, which is not needed
+        """
+
+        buckets = self.buckets
+        position = len(self.keys)
+        self.keys.append(key)
+
+        for variant in variants(key):
+            entry = hashed(variant) << SHIFT | position
+            buckets[entry >> BUCKET_SHIFT].append(entry)
+
+    def revise(self, key: str, previous, word) -> None:
+        if previous is None and word is not None:
+            self.add(key)
+
+    def read(self, file: str) -> bool:
+        """
+        Reads the index written into a file: the hashes are read into the array as they are, and the keys split into a
+        list.
+
+        :return: Whether the file holds a complete index
+        """
+
+        if not os.path.exists(file):
+            return False
+
+        with open(file, 'rb') as source:
+            data = source.read()
+
+        if len(data) < HEADER.size:
+            return False
+        count, size = HEADER.unpack_from(data)
+        if len(data) != HEADER.size + count * self.codes.itemsize + size:
+            # The file was not completely written
+            return False
+
+        end = HEADER.size + count * self.codes.itemsize
+        self.codes = array('Q')
+        self.codes.frombytes(memoryview(data)[HEADER.size:end])
+        if sys.byteorder == 'big':
+            self.codes.byteswap()
+        self.keys = data[end:].decode('utf-8').split("\n") if 0 < size else []
+        return True
+
+    def sort(self) -> array:
+        added = array('Q')
+        for index in range(BUCKETS):
+            added.extend(sorted(self.buckets[index]))
+            self.buckets[index] = array('Q')
+
+        if len(self.codes) == 0:
+            return added
+
+        # Copy the runs of entries that were read between the added entries
+        entries = array('Q')
+        start = 0
+        for entry in added:
+            end = bisect_left(self.codes, entry, start)
+            entries.extend(self.codes[start:end])
+            entries.append(entry)
+            start = end
+        entries.extend(self.codes[start:])
+
+        return entries
+
+    def write(self, file: str) -> int:
+        """
+        Writes the index into a file: the header, the hashes in little-endian order, and the keys separated by newlines.
+
+        :return: The size of the file in bytes
+        """
+
+        entries = self.sort()
+        if sys.byteorder == 'big':
+            entries.byteswap()
+        data = "\n".join(self.keys).encode('utf-8')
+
+        with open(file, 'wb') as out:
+            out.write(HEADER.pack(len(entries), len(data)))
+            out.write(entries.tobytes())
+            out.write(data)
+            out.flush()
+            os.fsync(out.fileno())
+
+        return HEADER.size + len(entries) * entries.itemsize + len(data)
+
+
+def build(known) -> None:
+    """
+    Indexes every known key.
+    The index is only built once; later keys are indexed incrementally.
+
+    :param known: Every known normalized key
+    """
+
+    global built, keys, codes
+
+    if built:
+        return
+
+    builder = Builder()
+    for key in known:
+        builder.add(key)
+
+    keys = builder.keys
+    codes = builder.sort()
+    built = True
+
+
+def load(file: str) -> bool:
+    """
+    Replaces the index with an index written into a file (see the Builder class).
+
+    :return: Whether the file holds a complete index; if not, the index is emptied, to be built from the book
+    """
+
+    global built, keys, codes
+
+    loaded = Builder()
+    built = loaded.read(file)
+
+    keys = loaded.keys
+    codes = loaded.codes
+    recent.clear()
+
+    return built
+
+
+def revise(key: str, previous, word) -> None:
+    """
+    Updates a loaded index with a Word that was changed after the index was written.
+
+    :param key: The normalized key of the Word
+    :param previous: The Word as the index was written with it, or None if it was not known then
+    :param word: The Word as it is now
+    """
+
+    if previous is None and word is not None:
+        learn(key)
+
+
+def learn(key: str) -> None:
+    """
+    Indexes a newly learned key.
+    Nothing is indexed before the index has been built from the book, as it will include the key.
+    """
+
+    if not built:
+        return
+
+    position = len(keys)
+    keys.append(key)
+    for variant in set(variants(key)):
+        recent.setdefault(hashed(variant), []).append(position)
+
+
+def matches(word: str) -> list:
+    """
+    Provides the known keys that are one typo away from a normalized word.
+
+    :return: A list of keys in no particular order
+    """
+
+    found = set()
+
+    for variant in set(variants(word)):
+        code = hashed(variant)
+
+        index = bisect_left(codes, code << SHIFT)
+        while index < len(codes) and codes[index] >> SHIFT == code:
+            found.add(codes[index] & ((1 << SHIFT) - 1))
+            index += 1
+
+        found.update(recent.get(code, ()))
+
+    # Hashes may collide, and two deletions from different places may coincide, so each key is checked
+    return [keys[position] for position in found if keys[position] != word and near(word, keys[position])]
+
+
+def near(first: str, second: str) -> bool:
+    """
+    Determines whether two strings differ by at most one inserted, deleted, replaced or swapped adjacent character.
+    """
+
+    if len(second) < len(first):
+        first, second = second, first
+    if 1 < len(second) - len(first):
+        return False
+
+    # Skip the common prefix
+    index = 0
+    while index < len(first) and first[index] == second[index]:
+        index += 1
+
+    if len(first) == len(second):
+        if first[index + 1:] == second[index + 1:]:
+            # Replaced, or identical
+            return True
+        # Swapped adjacent characters
+        return (index + 1 < len(first) and first[index] == second[index + 1] and first[index + 1] == second[index]
+                and first[index + 2:] == second[index + 2:])
+
+    # Inserted into the longer string
+    return first[index:] == second[index + 1:]
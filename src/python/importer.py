@@ -0,0 +1,330 @@
+"""
+Imports words into the book from large external word lists.
+
+Files are streamed in chunks of lines, so the memory used to read and parse them does not grow with the size of the
+input. Chunks can be parsed in a pool of worker processes, and the parsed records are merged into the book in the order
+they appear in the input. The book is compacted after every flush_after Words merged, and they are released from memory
+again, as the analyzer does when it learns pair counts, so the merged Words are never all held in memory however many
+are imported; larger batches make fewer rewrites of the snapshot.
+
+Records are merged through the accessor, in the same way as words that are learned interactively, so the indexes of
+the book are kept up to date. They are not tracked as changes, as the compactions persist every one of them; tracking
+them would hold a mutation for every record in memory until then. Lines that cannot be parsed are skipped, and are
+reported with their line numbers once the import has finished, and so are records whose word or keys are not single
+words as input lines are split into with the user alphabet (see the scanner module), which could never be looked up,
+or contain a separator of the words data file, which could not be saved.
+
+FORMATS:
+========= =========================================================================================
+csv       word,PARTS,DEFINITION,KEYS; the format of the words data file
+tsv       word, parts, definition and keys separated with tabs
+jsonl     one object per line with a 'word' and optional 'parts', 'defn' and 'keys'
+========= =========================================================================================
+
+Parts are given as Part indices or names separated by spaces (or as a list in jsonl), and keys as 'KEY0:V0 ... KEYN:VN'
+(or as an object of counts in jsonl).
+
+Functions:
+
+    import_files(files, form, workers) -> tuple
+    import_file(file, form, workers, batch) -> tuple
+    detect(file) -> str
+    chunks(stream, size)
+    parse_chunk(form, lines, first) -> tuple
+    parse_record(form, line) -> tuple
+    parse_parts(parts) -> list
+    check(word, defn, keys)
+    merge_records(records, batch)
+    merge(record) -> str
+
+Variables:
+
+    chunk_size
+    reported
+    flush_after
+    SEPARATORS
+
+Authors:
+
+    Samuel Henderson
+"""
+
+import json
+import multiprocessing
+import src.python.accessor as acc
+import src.python.analyzer as analyzer
+import src.python.scanner as scanner
+from src.python.data import *
+
+
+# The number of lines parsed together
+chunk_size: int = 10000
+
+# The number of skipped lines whose errors are kept to be reported; the rest are only counted
+reported: int = 10
+
+# The number of Words merged before the book is compacted and they are dropped from memory
+flush_after: int = 100000
+
+# The characters that separate the fields of the words data file and the counts of keys, which words never contain
+SEPARATORS = frozenset(",:")
+
+
+def import_files(files: list, form: str = None, workers: int = 1) -> tuple:
+    """
+    Imports every word from several files, compacting the book as they are merged and once more at the end.
+
+    :param files: The paths of the files to import
+    :param form: The format of every file, or None to detect it from each file name
+    :param workers: The number of processes to parse with; 1 parses in this process
+    :return: A (merged, skipped, errors) tuple of the number of records merged, the number of lines skipped, and a list
+             of (file, line number, error) tuples for the first reported lines skipped
+    """
+
+    merged = 0
+    skipped = 0
+    errors = []
+    batch = set()
+
+    changeset.enabled = False
+    try:
+        for file in files:
+            count, failures = import_file(file, form or detect(file), workers, batch)
+            merged += count
+            skipped += len(failures)
+            errors.extend((file, line, error) for line, error in failures[:reported - len(errors)])
+    finally:
+        changeset.enabled = True
+
+    analyzer.flush(list(batch))
+    return merged, skipped, errors
+
+
+def import_file(file: str, form: str, workers: int = 1, batch: set = None) -> tuple:
+    """
+    Merges every word in a file into the book.
+
+    :param file: The path of the file to import
+    :param form: The format of the file; one of csv, tsv or jsonl
+    :param workers: The number of processes to parse with; 1 parses in this process
+    :param batch: The keys of the Words merged since the book was last compacted (see merge_records)
+    :return: A (merged, failures) tuple of the number of records merged and a list of (line number, error) tuples for
+             the lines that could not be parsed
+    """
+
+    count = 0
+    failures = []
+    batch = set() if batch is None else batch
+
+    with open(file, encoding='utf-8') as stream:
+        if workers <= 1:
+            first = 1
+            for chunk in chunks(stream):
+                records, errors = parse_chunk(form, chunk, first)
+                merge_records(records, batch)
+                count += len(records)
+                failures.extend(errors)
+                first += len(chunk)
+            return count, failures
+
+        # Workers split words with the user alphabet too, however they are started
+        with multiprocessing.Pool(workers, scanner.use_alphabet, ("".join(acc.alpha),)) as pool:
+            jobs = []
+            first = 1
+
+            # Only a few chunks per worker are read ahead, so memory stays bounded
+            for chunk in chunks(stream):
+                jobs.append((form, chunk, first))
+                first += len(chunk)
+                if len(jobs) == workers * 2:
+                    count += merge_batch(pool, jobs, failures, batch)
+                    jobs = []
+            count += merge_batch(pool, jobs, failures, batch)
+
+    return count, failures
+
+
+def merge_batch(pool, jobs: list, failures: list, batch: set) -> int:
+    """
+    Parses a batch of chunks in a pool and merges the results in their original order.
+    The lines that could not be parsed are added to the failures.
+    """
+
+    count = 0
+    for records, errors in pool.starmap(parse_chunk, jobs):
+        merge_records(records, batch)
+        count += len(records)
+        failures.extend(errors)
+    return count
+
+
+def merge_records(records: list, batch: set) -> None:
+    """
+    Merges records into the book, adding the keys of their Words to a batch. Once the batch holds flush_after Words,
+    the book is compacted and they are released from memory (see the flush function of the analyzer).
+    """
+
+    for record in records:
+        batch.add(merge(record))
+
+    if flush_after <= len(batch):
+        analyzer.flush(list(batch))
+        batch.clear()
+
+
+def detect(file: str) -> str:
+    """
+    Determines the format of a file from its extension; csv is assumed for unrecognized extensions.
+    """
+
+    if file.endswith(".tsv"):
+        return "tsv"
+    elif file.endswith(".jsonl") or file.endswith(".json"):
+        return "jsonl"
+    return "csv"
+
+
+def chunks(stream, size: int = None):
+    """
+    Yields lists of consecutive lines from a stream.
+    """
+
+    size = size or chunk_size
+    chunk = []
+
+    for line in stream:
+        chunk.append(line)
+        if len(chunk) == size:
+            yield chunk
+            chunk = []
+
+    if 0 < len(chunk):
+        yield chunk
+
+
+def parse_chunk(form: str, lines: list, first: int = 1) -> tuple:
+    """
+    Parses each line of a chunk into a record, skipping blank lines and lines without a word.
+    Lines that cannot be parsed are skipped too, and returned with their errors.
+
+    :param first: The line number of the first line of the chunk
+    :return: A (records, errors) tuple, where errors is a list of (line number, error) tuples
+    """
+
+    records = []
+    errors = []
+    for number, line in enumerate(lines, first):
+        try:
+            record = parse_record(form, line)
+        except (ValueError, KeyError, TypeError, AttributeError) as error:
+            errors.append((number, type(error).__name__ + ": " + str(error)))
+            continue
+        if record is not None:
+            records.append(record)
+    return records, errors
+
+
+def parse_record(form: str, line: str):
+    """
+    Parses a line into a record.
+
+    :return: A (word, indices, defn, keys) tuple, where keys is a list of (key, count) tuples, or None
+    :raises ValueError: If the word or a key is not a single word, or the record could not be saved (see check)
+    """
+
+    line = line.rstrip('\r\n')
+    if line.strip() == '':
+        return None
+
+    if form == "jsonl":
+        entry = json.loads(line)
+        keys = entry.get("keys") or {}
+        record = (entry["word"], parse_parts(entry.get("parts") or []), entry.get("defn") or '',
+                  [(key, int(count)) for key, count in keys.items()])
+        check(record[0], record[2], record[3])
+        return record
+
+    if form == "tsv":
+        fields = line.split('\t')
+        defn = fields[2] if 2 < len(fields) else ''
+        keys = fields[3] if 3 < len(fields) else ''
+    else:
+        # The definition may contain commas; only the word, parts and keys are delimited
+        fields = line.split(',', 2)
+        rest = fields[2].rsplit(',', 1) if 2 < len(fields) else ['']
+        defn = rest[0]
+        keys = rest[1] if 1 < len(rest) else ''
+
+    if fields[0] == '':
+        return None
+
+    parts = fields[1] if 1 < len(fields) else ''
+    pairs = [entry.rsplit(':', 1) for entry in keys.split(' ') if entry != '']
+
+    pairs = [(key, int(count)) for key, count in pairs]
+    check(fields[0], defn, pairs)
+    return fields[0], parse_parts(parts), defn, pairs
+
+
+def check(word: str, defn: str, keys: list) -> None:
+    """
+    Checks that the word and keys of a record are single words, as input lines are split into with the user alphabet,
+    and that none of them contains a separator of the words data file; nor may the definition break a line.
+
+    :raises ValueError: If the record could not be looked up or saved
+    """
+
+    for text in [word] + [key for key, count in keys]:
+        if scanner.tokenize(text) != [text] or not SEPARATORS.isdisjoint(text):
+            raise ValueError("'" + text + "' is not a single word")
+
+    if "\n" in defn or "\r" in defn:
+        raise ValueError("the definition of '" + word + "' breaks a line")
+
+
+def parse_parts(parts) -> list:
+    """
+    Parses Part indices or names into a list of Part indices; unrecognized parts are ignored.
+    """
+
+    if isinstance(parts, str):
+        parts = parts.split(' ')
+
+    indices = []
+    for part in parts:
+        part = str(part).strip().lower()
+        if part.isdigit():
+            indices.append(int(part))
+        elif part in by_name:
+            indices.append(by_name[part].indx())
+    return indices
+
+
+def merge(record: tuple) -> None:
+    """
+    Merges a record into the book through the accessor.
+    New words are added; known words are assigned to any new parts, defined if they have no definition, and their key
+    counts are incremented.
+
+    :return: The key of the merged Word
+    """
+
+    word, indices, defn, keys = record
+    parts = [part for part in map(get_part, indices) if part is not None]
+    obj = acc.book.get(word)
+
+    if obj is None:
+        acc.add_word(word, parts[0] if parts else None)
+        obj = acc.book.get(word)
+
+    for part in parts:
+        if not obj.has_part(part):
+            acc.add_part(obj, part)
+
+    if defn != '' and obj.defn == '':
+        acc.define(obj, defn)
+
+    for key, count in keys:
+        acc.add_key(obj, key, count)
+
+    return acc.book.normalize(word)
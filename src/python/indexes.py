@@ -0,0 +1,380 @@
+"""
+Maintains secondary indexes over the book for queries.
+
+The words of each part of speech are kept in a posting set, and the words whose definitions contain each term in an
+inverted index, so that queries take time in proportion to the size of their results rather than the size of the book.
+The indexes are updated whenever a word is assigned to a part of speech or defined.
+
+The indexes are written next to each snapshot of the book when it is compacted (see the FileStorage class), and loaded
+with the snapshot when a process starts, so definitions are not read from the whole book again. Indexes that were not
+written with the snapshot are built from the book when the first query is made instead.
+
+FILE:
+========= =========================================================================================
+Header    the sizes of the keys and of the terms in bytes, and the number of sets and of entries
+Offsets   the offset of each set in the entries; the sets of the Parts by index come first, then those of the terms
+Entries   the positions of the keys in each set, in order of the sets
+Keys      every key in a set, by position, separated by newlines
+Terms     the term of each set after those of the Parts, separated by newlines
+========= =========================================================================================
+
+Numbers are little-endian. Reading the file only splits the keys and terms, and the set of a Part or term is only made
+when it is first used or changed, so reading and writing indexes costs little more than the file itself.
+
+Classes:
+
+    Builder
+
+Functions:
+
+    build(words, normalize)
+    load(file) -> bool
+    revise(key, previous, word)
+    add_part(key, part)
+    define(key, previous, defn)
+    with_part(part) -> set
+    defined_with(query) -> set
+    counts() -> list
+    terms(text) -> list
+
+Variables:
+
+    built
+    index
+
+Authors:
+
+    Samuel Henderson
+"""
+
+import os
+import re
+import struct
+import sys
+from array import array
+from src.python.data import *
+
+
+# Whether the indexes have been built from the book or loaded
+built: bool = False
+
+# Matches the terms of a definition
+TERM = re.compile(r"\w+")
+
+# The header of a written file: the sizes of the keys and terms in bytes, and the numbers of sets and entries
+HEADER = struct.Struct('<QQQQ')
+
+
+def terms(text: str) -> list:
+    """
+    Splits text into the case folded terms that definitions are indexed by.
+    """
+
+    return TERM.findall(text.casefold())
+
+
+class Builder:
+    """
+    The posting sets of each part of speech and the inverted index of definitions, which are built from Words, or read
+    from the file of an earlier snapshot and revised with the Words that have changed since, and written into a file.
+    The indexes of the book are kept in a Builder too.
+
+    Attributes:
+
+        postings : list
+            The keys of the words assigned to each Part, by index, or None where the set has not been made yet;
+            position 0 is unused.
+        definitions : dict
+            The keys of the words whose definitions contain each term, for the terms whose sets have been made.
+        keys : list
+            The keys of the file that was read, by position.
+        entries : array
+            The positions of the keys in each set of the file that was read.
+        ranges : dict
+            The start and end of the entries of each set that has not been made, by Part index or term.
+
+    Functions:
+
+        part(index) -> set:
+            Provides the keys of the words assigned to the Part with an index.
+        term(term) -> set:
+            Provides the keys of the words whose definitions contain a term, or None if there are none.
+        count(index) -> int:
+            Counts the words assigned to the Part with an index.
+        add(key, word):
+            Indexes a Word.
+        revise(key, previous, word):
+            Indexes a changed Word in place of what it was.
+        read(file) -> bool:
+            Reads the indexes written into a file.
+        write(file) -> int:
+            Writes the indexes into a file, which is flushed to disk before returning.
+
+    """
+
+    def __init__(self):
+        self.postings = [set() for _ in by_index]
+        self.definitions = {}
+        self.keys = []
+        self.entries = array('I')
+        self.ranges = {}
+
+    def make(self, name) -> set:
+        start, end = self.ranges.pop(name)
+        return set(map(self.keys.__getitem__, self.entries[start:end]))
+
+    def part(self, index: int) -> set:
+        if self.postings[index] is None:
+            self.postings[index] = self.make(index)
+        return self.postings[index]
+
+    def term(self, term: str):
+        keys = self.definitions.get(term)
+        if keys is None and term in self.ranges:
+            keys = self.definitions[term] = self.make(term)
+        return keys
+
+    def count(self, index: int) -> int:
+        if self.postings[index] is None:
+            start, end = self.ranges[index]
+            return end - start
+        return len(self.postings[index])
+
+    def add(self, key: str, word: Word) -> None:
+        self.revise(key, None, word)
+
+    def revise(self, key: str, previous, word) -> None:
+        """
+        Indexes a Word in place of what it was. Words are never removed from parts of speech, so only the parts of the
+        Word as it is now are added.
+
+        :param key: The normalized key of the Word
+        :param previous: The Word as it was indexed, or None if it was not
+        :param word: The Word as it is now
+        """
+
+        if word is not None:
+            for part in word.parts:
+                self.part(part.indx()).add(key)
+
+        self.define(key, '' if previous is None else previous.defn, '' if word is None else word.defn)
+
+    def define(self, key: str, previous: str, defn: str) -> None:
+        """
+        Replaces the terms a key is indexed under: those of its previous definition with those of its new definition.
+        """
+
+        if previous == defn:
+            return
+
+        for term in terms(previous):
+            keys = self.term(term)
+            if keys is not None:
+                keys.discard(key)
+                if len(keys) == 0:
+                    del self.definitions[term]
+
+        for term in terms(defn):
+            keys = self.term(term)
+            if keys is None:
+                keys = self.definitions[term] = set()
+            keys.add(key)
+
+    def read(self, file: str) -> bool:
+        """
+        Reads the indexes written into a file.
+
+        :return: Whether the file holds complete indexes
+        """
+
+        if not os.path.exists(file):
+            return False
+
+        with open(file, 'rb') as source:
+            data = source.read()
+
+        if len(data) < HEADER.size:
+            return False
+        keys_size, terms_size, sets, count = HEADER.unpack_from(data)
+
+        offsets = array('Q')
+        entries = array('I')
+        start = HEADER.size
+        middle = start + (sets + 1) * offsets.itemsize
+        end = middle + count * entries.itemsize
+        if len(data) != end + keys_size + terms_size or sets < len(by_index):
+            # The file was not completely written
+            return False
+
+        offsets.frombytes(memoryview(data)[start:middle])
+        entries.frombytes(memoryview(data)[middle:end])
+        if sys.byteorder == 'big':
+            offsets.byteswap()
+            entries.byteswap()
+
+        self.keys = data[end:end + keys_size].decode('utf-8').split("\n") if 0 < keys_size else []
+        names = list(range(len(by_index)))
+        if 0 < terms_size:
+            names.extend(data[end + keys_size:].decode('utf-8').split("\n"))
+
+        self.entries = entries
+        self.ranges = dict(zip(names, zip(offsets, offsets[1:])))
+        self.postings = [None for _ in by_index]
+        self.definitions = {}
+        return True
+
+    def write(self, file: str) -> int:
+        """
+        Writes the indexes into a file. The entries of sets that have not been made are copied as they were read, and
+        the keys of the sets that have been made are added to the keys that were read.
+
+        :return: The size of the file in bytes
+        """
+
+        positions = None
+        names = []
+        offsets = array('Q', [0])
+        entries = array('I')
+
+        for name in list(range(len(by_index))) + list(self.ranges.keys() - set(range(len(by_index)))) + \
+                list(self.definitions):
+            if name in self.ranges:
+                start, end = self.ranges[name]
+                entries.extend(self.entries[start:end])
+            else:
+                if positions is None:
+                    positions = {key: position for position, key in enumerate(self.keys)}
+                keys = self.postings[name] if name.__class__ is int else self.definitions[name]
+                for key in keys:
+                    position = positions.get(key)
+                    if position is None:
+                        position = positions[key] = len(self.keys)
+                        self.keys.append(key)
+                    entries.append(position)
+
+            if name.__class__ is not int:
+                names.append(name)
+            offsets.append(len(entries))
+
+        if sys.byteorder == 'big':
+            offsets.byteswap()
+            entries.byteswap()
+
+        keys = "\n".join(self.keys).encode('utf-8')
+        names = "\n".join(names).encode('utf-8')
+
+        with open(file, 'wb') as out:
+            out.write(HEADER.pack(len(keys), len(names), len(offsets) - 1, len(entries)))
+            out.write(offsets.tobytes())
+            out.write(entries.tobytes())
+            out.write(keys)
+            out.write(names)
+            out.flush()
+            os.fsync(out.fileno())
+
+        return HEADER.size + len(offsets) * offsets.itemsize + len(entries) * entries.itemsize + len(keys) + len(names)
+
+
+# The indexes of the book
+index: Builder = Builder()
+
+
+def build(words, normalize) -> None:
+    """
+    Indexes every known Word.
+    The indexes are only built once; later changes are indexed incrementally.
+
+    :param words: Every known Word
+    :param normalize: Provides the key a word string is stored under
+    """
+
+    global built
+
+    if built:
+        return
+
+    for word in words:
+        index.add(normalize(word.word), word)
+
+    built = True
+
+
+def load(file: str) -> bool:
+    """
+    Replaces the indexes with indexes written into a file (see the Builder class).
+
+    :return: Whether the file holds complete indexes; if not, the indexes are emptied, to be built from the book
+    """
+
+    global built, index
+
+    index = Builder()
+    built = index.read(file)
+
+    if not built:
+        index = Builder()
+    return built
+
+
+def revise(key: str, previous, word) -> None:
+    """
+    Updates loaded indexes with a Word that was changed after they were written.
+
+    :param key: The normalized key of the Word
+    :param previous: The Word as the indexes were written with it, or None if it was not known then
+    :param word: The Word as it is now
+    """
+
+    if built:
+        index.revise(key, previous, word)
+
+
+def add_part(key: str, part: Part) -> None:
+    """
+    Records that a word has been assigned to a part of speech.
+    Nothing is recorded before the indexes have been built from the book, as they will include the change.
+    """
+
+    if built:
+        index.part(part.indx()).add(key)
+
+
+def define(key: str, previous: str, defn: str) -> None:
+    """
+    Records that a word has been defined, replacing the terms of its previous definition.
+    """
+
+    if built:
+        index.define(key, previous, defn)
+
+
+def with_part(part: Part) -> set:
+    """
+    Provides the keys of the words assigned to a part of speech.
+    """
+
+    return index.part(part.indx())
+
+
+def defined_with(query: str) -> set:
+    """
+    Provides the keys of the words whose definitions contain every term of a query.
+    The posting sets are intersected from the smallest, so the cost is bounded by the rarest term.
+    """
+
+    sets = [index.term(term) or set() for term in terms(query)]
+    if len(sets) == 0:
+        return set()
+
+    sets.sort(key=len)
+    return sets[0].intersection(*sets[1:])
+
+
+def counts() -> list:
+    """
+    Provides the number of words assigned to each part of speech.
+
+    :return: A list of (Part, count) tuples in order of index
+    """
+
+    return [(part, index.count(part.indx())) for part in by_index[1:]]
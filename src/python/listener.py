@@ -4,15 +4,33 @@ Processes user input.
 Functions:
 
     wait()
+    lines() -> generator
+    read_line(query, source) -> str
+    ask(query) -> str
+    write(message)
     process_input(line)
     check_commands(line) -> bool
+    answer_query(line) -> bool
     unknown_words()
-    learn_new_word(word)
+    learn_new_word(word, previous, following) -> Word
+    correct_word(word) -> Word
     learn_new_defn(word)
     try_ask_save()
+    leave()
+    warn_unsaved()
+    count_words(count) -> str
+    count_times(times) -> str
     post_query(subject, value, mode)
     line_valid(line) -> bool
     negative(word) -> bool
+    positive(word) -> bool
+
+Variables:
+
+    stream
+    answers
+    session
+    listed
 
 Authors:
 
@@ -20,17 +38,102 @@ Authors:
 """
 
 
-import random
+import heapq
+import threading
 import src.python.accessor as acc
+import src.python.autosave as autosave
+import src.python.fuzzy as fuzzy
+import src.python.indexes as indexes
+import src.python.phrases as phrases
+import src.python.scanner as scanner
+import src.python.stats as stats
+import src.python.suggest as suggest
 from src.python.data import *
 
 
+# The stream that input lines are read from; the console is used when undefined
+stream = None
+
+# The stream that prompts are answered from; input lines are used when undefined
+answers = None
+
+# The session served on the current thread, if any; its stream and output replace the console
+# Its scan is the Scan of the last line it processed, which records how long the line took to resolve
+session = threading.local()
+
+# The number of words shown by queries that list words
+listed: int = 20
+
+
 def wait() -> None:
     """
     Wait to process the user input.
+    Lines are processed one at a time until the input is exhausted or the exit command is entered.
+    """
+
+    try:
+        # The version is announced between lines once the words have been recovered in the background
+        acc.announce()
+        for line in lines():
+            process_input(line)
+            acc.announce()
+    except EOFError:
+        # The input was exhausted while a prompt was waiting for an answer
+        return
+
+
+def lines():
+    """
+    Yields each input line in order until the input stream is exhausted.
+    """
+
+    while True:
+        try:
+            yield read_line(source=getattr(session, 'stream', stream))
+        except EOFError:
+            # No more input
+            return
+
+
+def read_line(query: str = "", source=None) -> str:
+    """
+    Reads a single line of input without its line ending.
+    The console is prompted with the query when no source stream is provided.
+
+    :param query: The query to prompt the console with
+    :param source: The stream to read from
+    :return: The line that was read
+    """
+
+    if source is None:
+        return input(query)
+
+    line = source.readline()
+    if line == '':
+        # Mirror the behaviour of input() when a stream is exhausted
+        raise EOFError
+    return line.rstrip('\r\n')
+
+
+def ask(query: str) -> str:
     """
+    Prompts for the answer to a query.
+    Scripted answers take precedence; otherwise the next input line is used as the answer.
+    Sessions are sent the query and answer it with their next line.
+    """
+
+    started = stats.start()
 
-    process_input(input())
+    if getattr(session, 'stream', None) is not None:
+        write(query)
+        answer = read_line(source=session.stream)
+    else:
+        answer = read_line(query, answers if answers is not None else stream)
+
+    if stats.enabled:
+        stats.count("prompts")
+        stats.stop("prompt", started)
+    return answer
 
 
 def process_input(line: str) -> None:
@@ -41,25 +144,44 @@ def process_input(line: str) -> None:
     processed further and the commands they match are executed.
 
     After validation, each word in a line is compared to the existing word database to verify that it is known.
-    Charm will attempt to learn what part of speech an unknown word belongs to before anything else.
+    Charm will attempt to learn what part of speech an unknown word belongs to before anything else, guided by the
+    known words on either side of it, unless the word is a misspelling of a known word.
     """
 
+    started = stats.start()
+
     # Do not lines if empty or commands
     # Built in commands take precedence to other processing
     if line_valid(line) and not check_commands(line):
 
-        # Split the line into its constituent words
-        words = line.split(' ')
+        # Split the line into its constituent words and find those that are unknown
+        scan = scanner.scan(line, acc.book)
+        session.scan = scan
 
-        while unknown_words(words) is not None:
-            # As long as any words in the last line are unknown, attempt to learn them
-            learn_new_word(unknown_words(words))
+        if stats.enabled:
+            stats.count("lines")
+            stats.observe("scan", scan.elapsed)
 
-        if len(words) == 1:
-            # Attempt to learn the definition of single-word input
-            learn_new_defn(words.pop())
+        for index in scan.positions():
+            # Attempt to learn each unknown word in the line
+            previous = acc.book.get(scan.keys[index - 1]) if 0 < index else None
+            following = acc.book.get(scan.keys[index + 1]) if index + 1 < len(scan.keys) else None
+            scan.known[scan.keys[index]] = learn_new_word(scan.tokens[index], previous, following)
 
-    wait()
+        # Associate the words of the line with each other
+        # Words learned while scanning are looked up again
+        words = [scan.known[key] or acc.book.get(key) for key in scan.keys]
+        acc.associate([word for word in words if word is not None])
+
+        with acc.lock:
+            suggest.observe(words)
+            phrases.record(scan.keys)
+
+        if len(scan.tokens) == 1 and words[0] is not None:
+            # Attempt to learn the definition of single-word input, which may have been corrected to a known word
+            learn_new_defn(words[0].word)
+
+    stats.stop("process_input", started)
 
 
 def check_commands(line: str) -> bool:
@@ -71,54 +193,265 @@ def check_commands(line: str) -> bool:
     COMMANDS:
     ===================== =================================================================
     <save_phrase>         Saves all stored content. The command itself is user-defined.
+    'stats'               Shows the collected statistics.
     'x'                   Causes the program to exit.
     ===================== =================================================================
+
+    Queries about the book (see answer_query) are answered after the commands.
     """
 
     if line == acc.savek:
-        # Save and notify
-        acc.save()
+        # Save and notify; the autosave thread saves instead when it is running, so input is not held up
+        if autosave.thread is not None:
+            autosave.request()
+        else:
+            acc.save()
         post_query("I " + line + "!")
         return True
+    elif line == 'stats':
+        if not stats.enabled:
+            post_query("I am not collecting statistics")
+        for entry in stats.summary():
+            post_query(entry)
+        return True
     elif line == 'x':
-        exit(0)
+        leave()
+
+    return answer_query(line)
+
+
+def answer_query(line: str) -> bool:
+    """
+    Answers read-only queries about the book.
+    Lists of words are answered from secondary indexes (see the indexes module), so they take time in proportion to
+    their size; only the first few words of a list are shown.
+
+    True is returned if the line was a query.
+
+    QUERIES:
+    ======================= =================================================================
+    'what is X'             Shows the parts of speech and definition of X.
+    'words seen with X'     Lists the words most often seen in the same line as X, most often first.
+    'list all PARTs'        Lists the words assigned to a part of speech, such as 'verbs'.
+    'words defined with Y'  Lists the words whose definitions contain every word of Y.
+    'words starting with P' Lists the first words that start with P, in order.
+    'how many PARTs'        Counts the words assigned to a part of speech.
+    'count parts'           Counts the words assigned to each part of speech.
+    'how often X'           Counts how often X has been entered, from the phrase index.
+    'what follows X'        Lists the words most often entered after X, from the phrase index.
+    ======================= =================================================================
+    """
+
+    query = line.strip().casefold()
+    plurals = {part.name() + "s": part for part in by_index[1:]}
+
+    if query.startswith("what is ") and query != "what is ":
+        subject = subject_of(line, "what is ")
+        word = acc.book.get(subject)
+
+        if word is None:
+            post_query("I do not know \'" + subject + "\'")
+        elif word.defn == '':
+            post_query("\'" + word.word + "\' is a " + " and a ".join(str(part) for part in word.parts))
+        else:
+            post_query("\'" + word.word + "\' is a " + " and a ".join(str(part) for part in word.parts) +
+                       ", defined as \'" + word.defn + "\'")
+        return True
+
+    if query.startswith("words seen with ") and query != "words seen with ":
+        subject = subject_of(line, "words seen with ")
+        word = acc.book.get(subject)
+
+        if word is None:
+            post_query("I do not know \'" + subject + "\'")
+        else:
+            # Only the strongest associations are found, without sorting every key; other sessions may add keys
+            with acc.lock:
+                shown = [key + " (" + str(count) + ")" for key, count in word.top_keys(listed)]
+                total = len(word.keys or ())
+            post_listing("words seen with \'" + word.word + "\'", (shown, total))
+        return True
+
+    if query.startswith("list all ") and query[len("list all "):] in plurals:
+        part = plurals[query[len("list all "):]]
+        post_listing(str(part) + "s", index(lambda: listing(indexes.with_part(part))))
+        return True
+
+    if query.startswith("words defined with ") and query != "words defined with ":
+        post_listing("words defined with \'" + query[len("words defined with "):] + "\'",
+                     index(lambda: listing(indexes.defined_with(query[len("words defined with "):]))))
+        return True
+
+    if query.startswith("words starting with ") and query != "words starting with ":
+        # One more word than is shown is found, to tell whether there are more, without finding all of them
+        prefix = line.strip()[len("words starting with "):].strip()
+        words = acc.book.prefixed(prefix, listed + 1)
+        subject = "words starting with \'" + prefix + "\'"
+
+        if len(words) == 0:
+            post_query("I know no " + subject)
+        else:
+            post_query(subject + ": " + ", ".join(word.word for word in words[:listed]) +
+                       (" and more" if listed < len(words) else ""))
+        return True
+
+    if query.startswith("how many ") and query[len("how many "):] in plurals:
+        part = plurals[query[len("how many "):]]
+        post_query("I know " + str(index(lambda: len(indexes.with_part(part)))) + " " + str(part) + "s")
+        return True
+
+    if query == "count parts":
+        counts = index(indexes.counts)
+        post_query(", ".join(str(part) + " " + str(count) for part, count in counts))
+        return True
+
+    if query.startswith("how often ") and query != "how often ":
+        phrase = subject_of(line, "how often ")
+        keys = [acc.book.normalize(token) for token in phrase.split(" ")]
+
+        # Other sessions may record lines while the index is read
+        with acc.lock:
+            if len(keys) <= phrases.max_length:
+                times = phrases.count(keys)
+            else:
+                # Longer phrases are not counted, but have been seen if all of their shorter phrases have
+                times = 1 if phrases.seen(keys) else 0
+
+        if times == 0:
+            post_query("I have not seen \'" + phrase + "\'")
+        elif len(keys) <= phrases.max_length:
+            post_query("I have seen \'" + phrase + "\' " + count_times(times))
+        else:
+            post_query("I have seen every part of \'" + phrase + "\'")
+        return True
+
+    if query.startswith("what follows ") and query != "what follows ":
+        phrase = subject_of(line, "what follows ")
+        with acc.lock:
+            following = phrases.continuations([acc.book.normalize(token) for token in phrase.split(" ")], listed)
+        post_listing("words after \'" + phrase + "\'",
+                     ([key + " (" + str(count) + ")" for key, count in following], len(following)))
+        return True
 
     return False
 
 
+def subject_of(line: str, prefix: str) -> str:
+    """
+    Provides the subject of a query that follows a prefix.
+    The subject is split as input lines are, so that punctuation such as a question mark is not part of it.
+    """
+
+    tokens = scanner.tokenize(line.strip()[len(prefix):])
+    return " ".join(tokens) if tokens else line.strip()[len(prefix):].strip()
+
+
+def index(query):
+    """
+    Runs a query against the secondary indexes, building them from the book first if they were not loaded with it.
+    """
+
+    # The indexes are loaded with the words, and must not be built from the book as well
+    acc.book.wait()
+
+    # Other sessions may change the indexes while they are read
+    with acc.lock:
+        indexes.build(acc.book.words(), acc.book.normalize)
+        return query()
+
+
+def listing(keys: set) -> tuple:
+    """
+    Provides the first listed keys of a set in order, and the number of keys in the set.
+    """
+
+    return heapq.nsmallest(listed, keys), len(keys)
+
+
+def post_listing(subject: str, result: tuple) -> None:
+    """
+    Posts a listing, followed by the number of keys that were not shown.
+    """
+
+    shown, total = result
+
+    if total == 0:
+        post_query("I know no " + subject)
+        return
+
+    message = subject + ": " + ", ".join(shown)
+    if len(shown) < total:
+        message += " and " + str(total - len(shown)) + " more"
+    post_query(message)
+
+
 def unknown_words(words: list):
     """
     Scans a list of words. If the list contains words that are not stored, the first unknown word is returned.
     """
 
+    known = acc.book.resolve([acc.book.normalize(word) for word in words])
+
     for word in words:
-        if acc.book.get(hash(word.lower())) is None:
+        if known[acc.book.normalize(word)] is None:
             # If any word is unknown, return it to be identified
             return word
 
     return None
 
 
-def learn_new_word(word: str) -> None:
+def learn_new_word(word: str, previous: Word = None, following: Word = None):
     """
     Facilitates the learning of a provided word.
 
-    The user is repeatedly prompted for the part of speech until their input contains a valid one.
+    Charm first asks whether the word is a misspelling of a known word, if it is one typo away from any. Otherwise it
+    suggests a part of speech from the words it knows. Confident suggestions are accepted without asking; otherwise the
+    user is repeatedly prompted for the part of speech until their input contains a valid one, or agrees with the
+    suggestion.
     After learning a new word, Charm will try to ask the user what to do with new information.
+
+    :param word: The word to learn
+    :param previous: The known Word before it in its line, if any
+    :param following: The known Word after it in its line, if any
+    :return: The learned Word, or the known Word that was meant instead
     """
 
     if word is None:
         # Cannot learn known words
-        return
+        return None
+
+    meant = correct_word(word)
+    if meant is not None:
+        return meant
+
+    acc.book.wait()
+    with acc.lock:
+        # Statistics that were not loaded with the book are collected from it once, before the first suggestion
+        suggest.train(acc.book.words())
+    part, confidence = suggest.best(word, previous, following)
+
+    if suggest.threshold <= confidence:
+        post_query("I think \'" + word + "\' is a " + str(part))
+        if stats.enabled:
+            stats.count("accepted")
+        acc.add_word(word, part)
+        try_ask_save()
+        return acc.book.get(word)
 
     unlearned: bool = True
 
     while unlearned:
         # Ask about the word until it has been learned - its part of speech must be identified
-        line = input("What is " + word + "?")
+        line = ask("What is " + word + "? (" + str(part) + "?)")
         # Collect a dictionary of the valid Part names for comparison to input
         valid_names = names()
 
+        if positive(line):
+            # Agree with the suggestion
+            acc.add_word(word, part)
+            try_ask_save()
+            return acc.book.get(word)
+
         # Split line by spaces to create a list of words
         line = line.split(' ')
 
@@ -127,7 +460,35 @@ def learn_new_word(word: str) -> None:
             if valid_names.__contains__(arg):
                 acc.add_word(word, valid_names[arg])
                 try_ask_save()
-                return
+                return acc.book.get(word)
+
+
+def correct_word(word: str):
+    """
+    Asks whether an unknown word is a misspelling of a known word one typo away from it.
+    When several known words are one typo away, the one associated with the most other words is offered.
+
+    :return: The known Word that was meant, or None if there is none or the user disagrees
+    """
+
+    acc.book.wait()
+    with acc.lock:
+        # An index that was not loaded with the book is built from it once, before the first lookup
+        fuzzy.build(acc.book.keys())
+    candidates = [acc.book.get(key) for key in fuzzy.matches(acc.book.normalize(word))]
+    candidates = [candidate for candidate in candidates if candidate is not None]
+
+    if len(candidates) == 0:
+        return None
+
+    # Ties are broken alphabetically so that the same word is always offered
+    meant = min(candidates, key=lambda candidate: (-len(candidate.keys or ()), candidate.word))
+
+    if positive(ask("Did you mean \'" + meant.word + "\'?")):
+        if stats.enabled:
+            stats.count("corrected")
+        return meant
+    return None
 
 
 def learn_new_defn(word: str) -> None:
@@ -138,14 +499,14 @@ def learn_new_defn(word: str) -> None:
     """
 
     # Retrieve the Word object from Charm's book
-    word = acc.book[hash(word)]
+    word = acc.book.get(word)
 
-    # Do not inherently ask to redefine
-    if word.defn != '':
+    # Do not inherently ask to redefine, and do not define words that were not learned
+    if word is None or word.defn != '':
         return
 
     # Prompt for definition
-    res = input("Define \'" + str(word) + "\'?")
+    res = ask("Define \'" + str(word) + "\'?")
 
     if negative(res):
         # Do not define if response is negative
@@ -153,7 +514,7 @@ def learn_new_defn(word: str) -> None:
 
     # Notify and define
     post_query("Defined \'" + str(word) + "\' as \'" + res + "\'")
-    word.define(res)
+    acc.define(word, res)
 
 
 def try_ask_save() -> None:
@@ -164,11 +525,13 @@ def try_ask_save() -> None:
     """
 
     if acc.savek == '':
+        import random
+
         # Do not inherently redefine save phrase
         val = random.random()
         if val < 0.95:
             # 95% chance to ask for save phrase
-            val = input("What should I do with that?")
+            val = ask("What should I do with that?")
 
             if line_valid(val):
                 # Do not use empty or single space lines as a save phrase
@@ -179,6 +542,39 @@ def try_ask_save() -> None:
                 post_query("That does not make sense")
 
 
+def leave() -> None:
+    """
+    Exits, first offering to save any unsaved changes unless the autosave thread saves them on exit.
+    """
+
+    if autosave.thread is None and 0 < acc.unsaved():
+        try:
+            if positive(ask("I have not kept changes to " + count_words(acc.unsaved()) + ". Keep them? ")):
+                acc.save()
+        except EOFError:
+            # There is nobody left to answer
+            warn_unsaved()
+
+    exit(0)
+
+
+def warn_unsaved() -> None:
+    """
+    Warns that changes will be lost, if any have not been saved and the autosave thread will not save them on exit.
+    """
+
+    if autosave.thread is None and 0 < acc.unsaved():
+        post_query("Changes to " + count_words(acc.unsaved()) + " have not been kept")
+
+
+def count_words(count: int) -> str:
+    return str(count) + (" word" if count == 1 else " words")
+
+
+def count_times(times: int) -> str:
+    return "once" if times == 1 else str(times) + " times"
+
+
 def post_query(subject: str, value="", mode='e'):
     """
     Posts a generic query to the console with a subject and optional value.
@@ -215,7 +611,20 @@ def post_query(subject: str, value="", mode='e'):
     if mode.__contains__('x'):
         message = message + "!"
 
-    print(message)
+    write(message)
+
+
+def write(message: str) -> None:
+    """
+    Writes a line of output to the session served on the current thread, or to the console.
+    """
+
+    output = getattr(session, 'output', None)
+
+    if output is None:
+        print(message)
+    else:
+        output.write(message + "\n")
 
 
 def line_valid(line: str) -> bool:
@@ -232,4 +641,13 @@ def negative(word: str) -> bool:
     """
 
     negatives = ['no', 'negative', 'nah']
-    return negatives.__contains__(word)
\ No newline at end of file
+    return negatives.__contains__(word)
+
+
+def positive(word: str) -> bool:
+    """
+    Checks a word against a set of words representing a response of 'yes'.
+    """
+
+    positives = ['yes', 'yeah', 'yep', 'y']
+    return positives.__contains__(word)
\ No newline at end of file
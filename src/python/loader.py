@@ -0,0 +1,257 @@
+"""
+Loads large text words files in parallel.
+
+A words file is split into byte ranges that end at line boundaries, which are parsed with parse_line in a pool of
+worker processes. Workers first scan the keys of their ranges, which the main process interns in file order, so that
+keys are given the same ids as in a serial load. Each range is then parsed with those ids, and its Words are sent back
+as flat arrays, which the main process only has to slice into Words. Ranges are merged into the book in file order, so
+a word that appears on several lines is left as its last line, as in a serial load.
+
+Files smaller than parallel_after bytes, or loads with a single worker, are loaded serially, as starting the workers
+would take longer than parsing the file. No more workers are started than there are processors available to this
+process, and a single processor always loads serially, as the workers would only take turns with the main process.
+
+Functions:
+
+    load(book, file, count) -> int
+    load_serial(book, file) -> int
+    processors() -> int
+    ranges(file, count) -> list
+    scan_range(file, start, end) -> list
+    parse_range(file, start, end, ids) -> tuple
+    merge(book, parsed) -> int
+
+Variables:
+
+    workers
+    parallel_after
+    range_size
+
+Authors:
+
+    Samuel Henderson
+"""
+
+import gc
+import io
+import multiprocessing
+import os
+from collections import deque
+from src.python.data import *
+
+
+# The number of processes words files are parsed with; 1 parses in this process
+workers: int = 1
+
+# The size in bytes below which words files are always loaded serially
+parallel_after: int = 1 << 24
+
+# The size in bytes of the ranges a words file is split into
+range_size: int = 1 << 24
+
+
+def load(book, file: str, count: int = None) -> int:
+    """
+    Parses each line in a text words file as a Word and adds it to the book, in parallel when the file is large.
+
+    :param book: The Vocabulary to add the Words to
+    :param file: The path of the words file
+    :param count: The number of processes to parse with, if not workers
+    :return: The number of Words added
+    """
+
+    count = min(count or workers, processors())
+    size = os.path.getsize(file)
+
+    # The loaded Words hold no reference cycles, so collecting while they are created only costs time
+    collecting = gc.isenabled()
+    gc.disable()
+
+    try:
+        if count <= 1 or size < parallel_after:
+            return load_serial(book, file)
+
+        added = 0
+        jobs = ranges(file, max(count, size // range_size))
+
+        with multiprocessing.Pool(count) as pool:
+            parsing = deque()
+
+            for job, keys in zip(jobs, pool.imap(scan_range_job, jobs)):
+                parsing.append(pool.apply_async(parse_range, job + (intern_keys(keys),)))
+
+                # Only a few parsed ranges are held at once
+                while 2 * count <= len(parsing):
+                    added += merge(book, parsing.popleft().get())
+
+            while parsing:
+                added += merge(book, parsing.popleft().get())
+
+        return added
+    finally:
+        if collecting:
+            gc.enable()
+
+
+def load_serial(book, file: str) -> int:
+    """
+    Parses each line in a text words file as a Word and adds it to the book in this process.
+
+    :return: The number of Words added
+    """
+
+    count = 0
+    for line in open(file):
+        # Attempt to parse a Word from the current line
+        word = parse_line(line)
+        if word is not None:
+            # Store Word if it has been parsed successfully
+            book.add(word)
+            count += 1
+    return count
+
+
+def processors() -> int:
+    """
+    Provides the number of processors this process may run on.
+    """
+
+    if hasattr(os, 'sched_getaffinity'):
+        return len(os.sched_getaffinity(0))
+    return os.cpu_count() or 1
+
+
+def ranges(file: str, count: int) -> list:
+    """
+    Splits a file into byte ranges of about the same size, each ending just after a line ending.
+
+    :param file: The path of the file
+    :param count: The number of ranges to split the file into
+    :return: A list of (file, start, end) tuples in file order; fewer than count if the file has too few lines
+    """
+
+    size = os.path.getsize(file)
+    bounds = [0]
+
+    with open(file, "rb") as stream:
+        for index in range(1, count):
+            target = size * index // count
+            if target < bounds[-1]:
+                continue
+
+            # The range ends after the first line ending at or after the target
+            stream.seek(target)
+            stream.readline()
+            end = stream.tell()
+            if bounds[-1] < end < size:
+                bounds.append(end)
+
+    bounds.append(size)
+    return [(file, start, end) for start, end in zip(bounds, bounds[1:])]
+
+
+def lines(file: str, start: int, end: int):
+    """
+    Reads the lines in a byte range of a file, decoded and split as when the whole file is read as text.
+    """
+
+    with open(file, "rb") as stream:
+        stream.seek(start)
+        data = stream.read(end - start)
+
+    return io.TextIOWrapper(io.BytesIO(data))
+
+
+def scan_range_job(job: tuple) -> list:
+    return scan_range(*job)
+
+
+def scan_range(file: str, start: int, end: int) -> list:
+    """
+    Finds the keys counted in a byte range of a words file, splitting lines as parse_line does.
+
+    :return: The distinct keys, in the order they first appear
+    """
+
+    keys = {}
+
+    for line in lines(file, start, end):
+        fields = line.rstrip('\n').split(',', 2)
+        if 2 < len(fields):
+            rest = fields[2].rsplit(',', 1)
+            if 1 < len(rest):
+                keys.update(dict.fromkeys(entry.rsplit(':', 1)[0] for entry in rest[1].split(' ') if entry != ''))
+
+    return list(keys)
+
+
+def parse_range(file: str, start: int, end: int, ids) -> tuple:
+    """
+    Parses each line in a byte range of a words file into flat arrays.
+
+    :param file: The path of the words file
+    :param start: The offset of the first line
+    :param end: The offset just after the last line
+    :param ids: The id of each key found by scan_range, in the same order, as interned by the main process
+    :return: A (words, masks, tops, texts, keyed, bounds, ids, counts) tuple; bounds holds the start of the keys of each
+             Word in ids and counts, followed by their end, and keyed whether each Word has keys
+    """
+
+    # Keys are only looked up while parsing, so the ids of the main process are all that is needed
+    symbols.clear()
+    interned.clear()
+    interned.update(zip(scan_range(file, start, end), ids))
+
+    words = []
+    masks = array('H')
+    tops = array('B')
+    texts = []
+    keyed = array('B')
+    bounds = array('L', [0])
+    ids = array('I')
+    counts = array('I')
+
+    for line in lines(file, start, end):
+        word = parse_line(line)
+        if word is None:
+            continue
+
+        words.append(word.word)
+        masks.append(word.mask)
+        tops.append(word.top)
+        texts.append(word.text)
+
+        keys = word.keys
+        keyed.append(keys is not None)
+        if keys is not None:
+            ids.extend(keys.ids)
+            counts.extend(keys.counts)
+        bounds.append(len(ids))
+
+    return words, masks, tops, texts, keyed, bounds, ids, counts
+
+
+def merge(book, parsed: tuple) -> int:
+    """
+    Adds the Words of a parsed range to the book.
+
+    :return: The number of Words added
+    """
+
+    words, masks, tops, texts, keyed, bounds, ids, counts = parsed
+
+    for index, word in enumerate(words):
+        obj = Word(word, ())
+        obj.mask = masks[index]
+        obj.top = tops[index]
+        obj.text = texts[index]
+
+        if keyed[index]:
+            # The keys of each Word are already in order of the ids of this process
+            obj.keys = Keys()
+            obj.keys.ids = ids[bounds[index]:bounds[index + 1]]
+            obj.keys.counts = counts[bounds[index]:bounds[index + 1]]
+
+        book.add(obj)
+
+    return len(words)
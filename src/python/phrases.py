@@ -0,0 +1,202 @@
+"""
+Indexes the phrases of processed lines.
+
+Every run of up to max_length consecutive words in a processed line is recorded as a Phrase. The occurrences of each
+Phrase are counted approximately in a count-min sketch of fixed size, which never undercounts, and exactly in a table
+of the most recently seen Phrases. The words that follow each recent Phrase are counted as well, so the most common
+continuations of a Phrase can be provided. Both tables evict their least recently seen Phrases once they reach their
+capacity, so memory stays bounded however many lines are processed.
+
+The bound is set by capacity rather than by the sketch: the sketch takes 4 MB, while each Phrase counted exactly takes
+several hundred bytes with its continuations. At the default capacity the full index holds about 75 MB, as measured by
+'python -m src.python.bench --phrases LINES', so memory can be traded for exact counts by lowering capacity.
+
+The index is queried by the listener ('how often X' and 'what follows X').
+
+Functions:
+
+    record(keys)
+    count(words) -> int
+    seen(words) -> bool
+    continuations(words, n) -> list
+
+Variables:
+
+    max_length
+    capacity
+    follower_limit
+    lines
+
+Authors:
+
+    Samuel Henderson
+"""
+
+from array import array
+from collections import OrderedDict
+from src.python.data import *
+
+
+# The number of words in the longest recorded Phrase
+max_length: int = 3
+
+# The number of Phrases counted exactly, and of Phrases whose continuations are counted; about 750 bytes each when full
+capacity: int = 100000
+
+# The number of continuations counted for each Phrase
+follower_limit: int = 16
+
+# The number of lines recorded
+lines: int = 0
+
+# The number of rows and the number of counters per row of the count-min sketch
+DEPTH = 4
+WIDTH = 1 << 18
+ROWS = range(DEPTH)
+MASK = WIDTH - 1
+
+# The largest value of a counter
+LIMIT = 0xFFFFFFFF
+
+# The counters of the count-min sketch, row after row; only allocated once the first line is recorded
+sketch: array = None
+
+# The number of occurrences of recently seen Phrases, least recently seen first
+table: OrderedDict = OrderedDict()
+
+# The number of times each word followed recently seen Phrases, least recently seen first
+followers: OrderedDict = OrderedDict()
+
+
+def record(keys: list) -> None:
+    """
+    Records every Phrase of up to max_length words in a line.
+    The hash of each Phrase is rolled on from the Phrase one word shorter, so a line of n words costs O(n * max_length).
+
+    :param keys: The normalized keys of the words of the line, in order
+    """
+
+    global lines, sketch
+
+    if sketch is None:
+        sketch = array('I', bytes(4 * DEPTH * WIDTH))
+
+    lines += 1
+
+    for start in range(len(keys)):
+        code = 0
+        end = min(start + max_length, len(keys))
+
+        for stop in range(start + 1, end + 1):
+            code = roll(code, keys[stop - 1])
+            phrase = Phrase(keys[start:stop], code)
+
+            increment(phrase)
+
+            if stop < len(keys):
+                follow(phrase, keys[stop])
+
+
+def increment(phrase: Phrase) -> None:
+    """
+    Counts one occurrence of a Phrase in the sketch and the table.
+    """
+
+    estimate = LIMIT
+    for index in cells(phrase.code):
+        if sketch[index] < LIMIT:
+            sketch[index] += 1
+        if sketch[index] < estimate:
+            estimate = sketch[index]
+
+    occurrences = table.get(phrase)
+    if occurrences is None:
+        # A Phrase that enters the table again after eviction resumes from its estimate, so it is never undercounted
+        table[phrase] = estimate
+        if capacity < len(table):
+            table.popitem(last=False)
+    else:
+        table[phrase] = occurrences + 1
+        table.move_to_end(phrase)
+
+
+def follow(phrase: Phrase, word: str) -> None:
+    """
+    Counts one occurrence of a word following a Phrase.
+    Once a Phrase has follower_limit continuations, the least common one is replaced.
+    """
+
+    counts = followers.get(phrase)
+    if counts is None:
+        counts = followers[phrase] = {}
+        if capacity < len(followers):
+            followers.popitem(last=False)
+    else:
+        followers.move_to_end(phrase)
+
+    if word not in counts and follower_limit <= len(counts):
+        del counts[min(counts, key=counts.get)]
+    counts[word] = counts.get(word, 0) + 1
+
+
+def cells(code: int) -> list:
+    """
+    Provides the index of the counter for a Phrase hash in each row of the sketch.
+    The rows are indexed by combining two halves of the hash, which is as good as independent hashes for the sketch.
+    """
+
+    low = code & 0xFFFFFFFF
+    high = (code >> 32) | 1
+    return [row * WIDTH + ((low + row * high) & MASK) for row in ROWS]
+
+
+def count(words: list) -> int:
+    """
+    Provides the number of times a Phrase has been recorded.
+    Recently seen Phrases are counted exactly since they entered the table; others are estimated from the sketch, which
+    may overcount.
+
+    :param words: The normalized keys of the words of the Phrase
+    """
+
+    phrase = Phrase(list(words))
+
+    occurrences = table.get(phrase)
+    if occurrences is not None:
+        return occurrences
+
+    if sketch is None:
+        return 0
+    return min(sketch[index] for index in cells(phrase.code))
+
+
+def seen(words: list) -> bool:
+    """
+    Determines whether a Phrase has been recorded.
+    Phrases longer than max_length have been seen if all of their n-grams have been seen.
+    """
+
+    if len(words) == 0:
+        return False
+
+    for start in range(max(len(words) - max_length, 0) + 1):
+        if count(words[start:start + max_length]) == 0:
+            return False
+    return True
+
+
+def continuations(words: list, n: int = 5) -> list:
+    """
+    Provides the words that most commonly follow a Phrase.
+    Only the last max_length words of the Phrase are considered.
+
+    :param words: The normalized keys of the words of the Phrase
+    :param n: The number of continuations to provide
+    :return: A list of (word, count) tuples, most common first
+    """
+
+    counts = followers.get(Phrase(list(words[-max_length:])))
+    if counts is None:
+        return []
+
+    return sorted(counts.items(), key=lambda item: (-item[1], item[0]))[:n]
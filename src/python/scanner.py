@@ -0,0 +1,162 @@
+"""
+Splits input lines into words and resolves them against the book in a single pass.
+
+Lines are split into words with a translation table compiled from the user alphabet, which turns every character that
+does not belong in a word into a space, so that 'dog,' and 'dog' are the same word. Letters, digits and the characters
+of the alphabet belong in words, as do apostrophes and hyphens inside them, as in "don't" or 'well-known'; those at the
+edges of a word are stripped. The alphabet only adds characters to words: letters and digits belong in words whether
+or not they are in it. The table covers the first 256 code points and the general and CJK punctuation blocks;
+any other character is kept, so words in other scripts are left whole.
+
+Classes:
+
+    Scan
+
+Functions:
+
+    compile_alphabet(alphabet) -> dict
+    use_alphabet(alphabet)
+    tokenize(line) -> list
+    scan(line, book) -> Scan
+
+Variables:
+
+    table
+    ascii_table
+    JOINERS
+
+Authors:
+
+    Samuel Henderson
+"""
+
+import time
+
+
+# The characters that join the parts of a word, which are stripped from its edges
+JOINERS = "'-\u2019"
+
+# The code points that the translation table classifies
+CLASSIFIED = [*range(256), *range(0x2000, 0x2070), *range(0x3000, 0x3040)]
+
+
+class Scan:
+    """
+    The words of a single input line, resolved against the book.
+
+    Attributes:
+
+        tokens : list
+            The words of the line, in order.
+        keys : list
+            The normalized key of each token.
+        known : dict
+            The Word stored under each distinct key, or None for unknown keys.
+        elapsed : float
+            The seconds spent tokenizing and resolving the line.
+
+    Functions:
+
+        unknown():
+            Yields each unknown word once, in order of appearance.
+        positions():
+            Yields the position of each unknown word once, in order of appearance.
+
+    """
+
+    def __init__(self, tokens: list, keys: list, known: dict, elapsed: float):
+        self.tokens = tokens
+        self.keys = keys
+        self.known = known
+        self.elapsed = elapsed
+
+    def unknown(self):
+        """
+        Yields each unknown word once, in order of appearance.
+        Repeats of a word, including differently cased ones, are only yielded the first time.
+        """
+
+        for index in self.positions():
+            yield self.tokens[index]
+
+    def positions(self):
+        """
+        Yields the position of the first appearance of each unknown word, in order.
+        """
+
+        seen = set()
+
+        for index, key in enumerate(self.keys):
+            if self.known[key] is None and key not in seen:
+                seen.add(key)
+                yield index
+
+
+def compile_alphabet(alphabet: str = "") -> dict:
+    """
+    Compiles an alphabet into a translation table that turns the characters which do not belong in words into spaces.
+
+    :param alphabet: The characters of the alphabet, which may be separated with spaces
+    :return: The translation table, for str.translate
+    """
+
+    kept = set(alphabet.replace(" ", "")) | set(JOINERS)
+    kept |= {char.upper() for char in kept} | {char.lower() for char in kept}
+
+    return {code: " " for code in CLASSIFIED if not chr(code).isalnum() and chr(code) not in kept}
+
+
+def use_alphabet(alphabet: str) -> None:
+    """
+    Tokenizes input with the translation table of an alphabet from now on.
+    """
+
+    global table, ascii_table
+
+    table = compile_alphabet(alphabet)
+    ascii_table = bytes(ord(table.get(code, chr(code))) for code in range(256))
+
+
+# The translation table of the user alphabet (see compile_alphabet)
+table: dict = {}
+
+# The same translation table for bytes, which translates ASCII lines several times faster
+ascii_table: bytes = b''
+
+use_alphabet("")
+
+
+def tokenize(line: str) -> list:
+    """
+    Splits a line into words, separating and stripping the characters that do not belong in words.
+    """
+
+    if line.isascii():
+        line = line.encode('ascii').translate(ascii_table).decode('ascii')
+    else:
+        line = line.translate(table)
+    tokens = line.split()
+
+    if "'" not in line and "-" not in line and "\u2019" not in line:
+        # Most lines have no joiners, so their words need not be stripped
+        return tokens
+
+    return [token for token in (token.strip(JOINERS) for token in tokens) if token != '']
+
+
+def scan(line: str, book) -> Scan:
+    """
+    Tokenizes a line, normalizes each token once and resolves every distinct key with a single batched lookup.
+
+    :param line: The input line to scan
+    :param book: The Vocabulary to resolve words against
+    :return: The resolved Scan of the line
+    """
+
+    start = time.perf_counter()
+
+    tokens = tokenize(line)
+    keys = [book.normalize(token) for token in tokens]
+    known = book.resolve(keys)
+
+    return Scan(tokens, keys, known, time.perf_counter() - start)
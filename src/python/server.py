@@ -0,0 +1,127 @@
+"""
+Serves many concurrent sessions from one process over a line protocol.
+
+Connections are accepted on a TCP or Unix socket by an asyncio server. Each connection is a Session with its own prompt
+state: its lines are processed by the listener on a dedicated thread, which blocks while it waits for the answer to a
+prompt without holding up any other session. All sessions share the book, whose mutations are serialized by the
+accessor lock, and with it the user profile the process was started with, if any.
+
+PROTOCOL:
+========= =========================================================================================
+client    sends one input line or prompt answer per line
+server    sends the greeting, then one line per prompt or statement
+========= =========================================================================================
+
+Classes:
+
+    Session
+
+Functions:
+
+    serve(host, port, path)
+    start(host, port, path)
+    handle(reader, writer)
+
+Authors:
+
+    Samuel Henderson
+"""
+
+import asyncio
+import queue
+import threading
+import src.python.accessor as acc
+import src.python.listener as ltr
+
+
+class Session:
+    """
+    A connection served by the listener on its own thread.
+    A Session acts as both the input stream and the output of the listener on that thread.
+
+    Functions:
+
+        readline() -> str:
+            Waits for the next line sent by the client; an empty string is returned once it disconnects.
+        write(text):
+            Sends text to the client.
+        run():
+            Processes the lines sent by the client until it disconnects or exits.
+
+    """
+
+    def __init__(self, loop: asyncio.AbstractEventLoop, writer: asyncio.StreamWriter):
+        self.loop = loop
+        self.writer = writer
+        self.lines = queue.Queue()
+
+    def readline(self) -> str:
+        line = self.lines.get()
+        return '' if line is None else line
+
+    def write(self, text: str) -> None:
+        self.loop.call_soon_threadsafe(self.writer.write, text.encode('utf-8'))
+
+    def run(self) -> None:
+        ltr.session.stream = self
+        ltr.session.output = self
+
+        try:
+            ltr.write(acc.greeting)
+            ltr.wait()
+        except SystemExit:
+            # The exit command only ends this session
+            pass
+        finally:
+            self.loop.call_soon_threadsafe(self.writer.close)
+
+
+async def handle(reader: asyncio.StreamReader, writer: asyncio.StreamWriter) -> None:
+    """
+    Serves a connection: lines are read asynchronously and handed to the thread of its Session.
+    """
+
+    session = Session(asyncio.get_running_loop(), writer)
+    threading.Thread(target=session.run, daemon=True).start()
+
+    try:
+        async for line in reader:
+            session.lines.put(line.decode('utf-8', errors='replace'))
+    except ConnectionError:
+        pass
+    finally:
+        # Wake the session so that it can finish
+        session.lines.put(None)
+
+
+async def start(host: str = "127.0.0.1", port: int = 7175, path: str = None) -> asyncio.AbstractServer:
+    """
+    Starts accepting connections.
+
+    :param host: The host to listen on
+    :param port: The TCP port to listen on
+    :param path: The path of a Unix socket to listen on instead of a TCP port
+    :return: The started server
+    """
+
+    if path is not None:
+        return await asyncio.start_unix_server(handle, path=path)
+    return await asyncio.start_server(handle, host, port)
+
+
+def serve(host: str = "127.0.0.1", port: int = 7175, path: str = None) -> None:
+    """
+    Recovers the book once and serves connections until interrupted.
+    """
+
+    acc.recover_data()
+
+    async def run():
+        server = await start(host, port, path)
+        async with server:
+            await server.serve_forever()
+
+    try:
+        asyncio.run(run())
+    except KeyboardInterrupt:
+        pass
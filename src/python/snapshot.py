@@ -0,0 +1,399 @@
+"""
+Reads and writes compact binary snapshots of the book.
+
+A snapshot is opened with mmap and Words are only materialized when they are looked up, so opening a snapshot costs the
+same regardless of how many Words it holds.
+
+LAYOUT:
+========= =========================================================================================
+Header    magic 'CHRM', format version, generation, record count, string table offset
+Records   one fixed-size record per Word, sorted by the bytes of their keys
+Strings   the string table; keys, words and keys of every Word encoded as UTF-8
+========= =========================================================================================
+
+RECORD:
+========= =========================================================================================
+key       offset and length of the key the Word is looked up by
+word      offset and length of the word string
+defn      offset and length of the definition in the definitions file (see the definitions module)
+keys      offset and length of the keys, formatted as 'KEY0:V0 ... KEYN:VN'
+parts     bitmask of the parts of speech; bit n - 1 is set for the Part with index n
+top       index of the Part the Word was first assigned to, or 0
+========= =========================================================================================
+
+The generation counts the snapshots written in place of each other, so that a journal can tell whether it was already
+compacted into a snapshot (see the FileStorage class); it wraps around at 65536. Offsets are relative to the start of
+the string table, and identical strings are only stored once. Version 1
+snapshots, which are still read, stored definitions in the string table with 32-bit offsets.
+
+A user profile layers an Overlay snapshot of the Words it has changed over the shared snapshot of the book, which it
+only ever reads, so every profile shares a single mapping of the shared snapshot.
+
+Classes:
+
+    Snapshot
+    Overlay
+
+Functions:
+
+    write(file, words, key, generation)
+
+Variables:
+
+    MAGIC
+    VERSION
+
+Authors:
+
+    Samuel Henderson
+"""
+
+import heapq
+import mmap
+import os
+import struct
+from src.python.data import *
+
+
+# Identifies snapshot files
+MAGIC = b'CHRM'
+
+# The snapshot format version written by this module
+VERSION = 2
+
+HEADER = struct.Struct('<4sHHIQ')
+RECORD = struct.Struct('<IIIIQIIIHBx')
+
+# The record format of version 1 snapshots
+RECORD_V1 = struct.Struct('<IIIIIIIIHBx')
+
+
+class Snapshot:
+    """
+    A read-only, memory-mapped snapshot of the book.
+
+    Functions:
+
+        get(key) -> Word:
+            Materializes the Word stored under a key, if any.
+        keys():
+            Yields the key of every stored Word in sorted order.
+        items():
+            Yields the key and record index of every stored Word in sorted order.
+        prefixed(prefix, limit):
+            Yields the key and record index of every stored Word whose key starts with a prefix.
+        search(keys):
+            Yields the record index of each of several keys in sorted order.
+        words():
+            Yields every stored Word in sorted order.
+        close():
+            Unmaps the snapshot file.
+
+    """
+
+    def __init__(self, file: str):
+        """
+        Opens a snapshot file.
+
+        :param file: The path of the snapshot file
+        :raises ValueError: If the file is not a snapshot of a supported version
+        """
+
+        self.file = open(file, 'rb')
+        self.map = mmap.mmap(self.file.fileno(), 0, access=mmap.ACCESS_READ)
+
+        magic, self.version, self.generation, self.count, self.strings = HEADER.unpack_from(self.map, 0)
+
+        if magic != MAGIC or self.version not in (1, VERSION):
+            self.close()
+            raise ValueError(file + " is not a version " + str(VERSION) + " snapshot")
+
+        self.layout = RECORD if self.version == VERSION else RECORD_V1
+
+    def __len__(self):
+        return self.count
+
+    def __contains__(self, key):
+        return self.find(key) != -1
+
+    def close(self) -> None:
+        self.map.close()
+        self.file.close()
+
+    def string(self, offset: int, length: int) -> str:
+        """
+        Decodes a string from the string table.
+        """
+
+        start = self.strings + offset
+        return self.map[start:start + length].decode('utf-8')
+
+    def record(self, index: int) -> tuple:
+        """
+        Unpacks the record at an index.
+        """
+
+        return self.layout.unpack_from(self.map, HEADER.size + index * self.layout.size)
+
+    def key(self, index: int) -> bytes:
+        """
+        Provides the encoded key of the record at an index.
+        """
+
+        offset, length = self.layout.unpack_from(self.map, HEADER.size + index * self.layout.size)[:2]
+        start = self.strings + offset
+        return self.map[start:start + length]
+
+    def lower(self, target: bytes, low: int = 0, high: int = None) -> int:
+        """
+        Binary searches the records for the first key that is not less than an encoded key.
+        The search can be narrowed to the records from low up to high, which must hold the result.
+        """
+
+        high = self.count if high is None else high
+
+        while low < high:
+            middle = (low + high) // 2
+            if self.key(middle) < target:
+                low = middle + 1
+            else:
+                high = middle
+
+        return low
+
+    def find(self, key: str) -> int:
+        """
+        Binary searches the records for a key.
+
+        :return: The index of the record with the key, or -1 if there is none
+        """
+
+        target = key.encode('utf-8')
+        index = self.lower(target)
+
+        if index < self.count and self.key(index) == target:
+            return index
+        return -1
+
+    def search(self, keys):
+        """
+        Yields the record index of each of several keys, which must be in sorted order, or -1 for keys that are not
+        stored. Each key is searched for from where the previous one was found, first in steps that double in size and
+        then by binary search, which only takes time in proportion to the number of keys.
+
+        :param keys: The encoded keys to search for
+        """
+
+        low = 0
+
+        for target in keys:
+            # Find a range of records that holds the key
+            step = 1
+            while low + step < self.count and self.key(low + step) < target:
+                low += step
+                step *= 2
+
+            low = self.lower(target, low, min(low + step + 1, self.count))
+            yield low if low < self.count and self.key(low) == target else -1
+
+    def get(self, key: str):
+        """
+        Materializes the Word stored under a key.
+
+        :return: A new Word, or None if the key is not stored
+        """
+
+        index = self.find(key)
+        if index == -1:
+            return None
+        return self.materialize(index)
+
+    def materialize(self, index: int) -> Word:
+        """
+        Builds a Word from the record at an index.
+        """
+
+        key_off, key_len, word_off, word_len, defn_off, defn_len, keys_off, keys_len, mask, top = self.record(index)
+
+        word = Word(self.string(word_off, word_len), ())
+        word.mask = mask
+        word.top = top
+
+        if self.version == 1:
+            word.text = self.string(defn_off, defn_len)
+        elif 0 < defn_len:
+            word.refer(defn_off << 32 | defn_len)
+
+        if 0 < keys_len:
+            word.load_keys(self.string(keys_off, keys_len))
+
+        return word
+
+    def keys(self):
+        for index in range(self.count):
+            yield self.key(index).decode('utf-8')
+
+    def items(self):
+        for index in range(self.count):
+            yield self.key(index).decode('utf-8'), index
+
+    def prefixed(self, prefix: str, limit: int = None):
+        """
+        Yields the key and record index of every stored Word whose key starts with a prefix, in key order.
+        UTF-8 preserves the order of code points, so the matching keys form a single range of records.
+        """
+
+        target = prefix.encode('utf-8')
+        index = self.lower(target)
+        found = 0
+
+        while index < self.count and (limit is None or found < limit):
+            key = self.key(index)
+            if not key.startswith(target):
+                return
+            yield key.decode('utf-8'), index
+            index += 1
+            found += 1
+
+    def words(self):
+        for index in range(self.count):
+            yield self.materialize(index)
+
+
+class Overlay:
+    """
+    A snapshot layered over a shared snapshot, read as the base of a Vocabulary in the same way as a Snapshot.
+    Words stored in the overlay replace the Words with the same keys in the shared snapshot. Records are referred to by
+    (snapshot, index) tuples.
+
+    Attributes:
+
+        top : Snapshot
+            The snapshot of the Words that have been changed.
+        shared : Snapshot
+            The snapshot that is only read.
+
+    """
+
+    def __init__(self, top: Snapshot, shared: Snapshot):
+        self.top = top
+        self.shared = shared
+        self.count = len(shared) + len(top) - self.common()
+
+    def __len__(self):
+        return self.count
+
+    def __contains__(self, key):
+        return key in self.top or key in self.shared
+
+    def close(self) -> None:
+        self.top.close()
+        self.shared.close()
+
+    def get(self, key: str):
+        word = self.top.get(key)
+        return self.shared.get(key) if word is None else word
+
+    def materialize(self, handle: tuple) -> Word:
+        return handle[0].materialize(handle[1])
+
+    def common(self) -> int:
+        """
+        Counts the keys that are in both snapshots.
+        Both are sorted, so the overlay keys are searched for in the shared snapshot together, which only takes time in
+        proportion to the size of the overlay.
+        """
+
+        keys = (self.top.key(index) for index in range(len(self.top)))
+        return sum(1 for index in self.shared.search(keys) if index != -1)
+
+    def keys(self):
+        for key, handle in self.items():
+            yield key
+
+    def items(self):
+        return self.merge(self.top.items(), self.shared.items())
+
+    def prefixed(self, prefix: str, limit: int = None):
+        found = self.merge(self.top.prefixed(prefix, limit), self.shared.prefixed(prefix, limit))
+        for count, item in enumerate(found):
+            if limit is not None and limit <= count:
+                return
+            yield item
+
+    def merge(self, top, shared):
+        """
+        Merges the keys and record indexes of both snapshots in key order, skipping the shared records of keys that
+        are in the overlay.
+        """
+
+        previous = None
+
+        # Ties are taken from the overlay first
+        for key, snapshot, index in heapq.merge(((key, self.top, index) for key, index in top),
+                                                ((key, self.shared, index) for key, index in shared),
+                                                key=lambda item: item[0]):
+            if key != previous:
+                previous = key
+                yield key, (snapshot, index)
+
+
+def write(file: str, words, defns, key=None, generation: int = 0) -> None:
+    """
+    Writes Words into a new snapshot file, which is flushed to disk before returning.
+    The definitions of the Words are written into a new definitions file, which must be installed together with the
+    snapshot, and the Words refer to them there from then on.
+
+    :param file: The path of the snapshot file to write
+    :param words: The Words to store
+    :param defns: The new definitions file (see the Rewrite class of the definitions module)
+    :param key: Provides the key each Word is stored under from its word string; the word string itself by default
+    :param generation: The generation of the snapshot
+    """
+
+    table = bytearray()
+    offsets = {}
+
+    def intern(string: str) -> tuple:
+        # Store each distinct string once
+        data = string.encode('utf-8')
+        offset = offsets.get(data)
+        if offset is None:
+            offset = len(table)
+            offsets[data] = offset
+            table.extend(data)
+        return offset, len(data)
+
+    records = []
+
+    for word in words:
+        name = word.word if key is None else key(word.word)
+
+        reference = intern(name)
+        if name != word.word:
+            reference += intern(word.word)
+        else:
+            # Most keys are the word string itself
+            reference += reference
+
+        handle = defns.write(word.text)
+        if handle != 0:
+            word.refer(handle)
+
+        reference += (handle >> 32, handle & 0xFFFFFFFF) + intern(word.format_keys())
+        records.append((name.encode('utf-8'), reference + (word.mask, word.top)))
+
+    # The definitions must be on disk before any snapshot refers to them
+    defns.flush()
+
+    # Records are sorted by key so that they can be binary searched
+    records.sort(key=lambda entry: entry[0])
+
+    out = open(file, 'wb')
+    out.write(HEADER.pack(MAGIC, VERSION, generation & 0xFFFF, len(records), HEADER.size + len(records) * RECORD.size))
+    for key, record in records:
+        out.write(RECORD.pack(*record))
+    out.write(table)
+    out.flush()
+    os.fsync(out.fileno())
+    out.close()
@@ -0,0 +1,247 @@
+"""
+Collects counters and latency histograms from the hot paths of Charm.
+
+Nothing is collected until collection is enabled; until then each instrumented call site only checks the enabled flag.
+The collected statistics are shown by the stats command, and can be written as Prometheus text or JSON on exit.
+
+METRICS:
+===================== =========================================================================================
+lines                 input lines processed
+process_input         seconds spent processing an input line, including prompts
+scan                  seconds spent tokenizing a line and resolving its words
+lookups               words looked up in the book
+lookup                seconds spent looking up a word or a batch of words
+materialized          words read from the snapshot or database
+definition_hits       definitions read from the definitions cache
+definition_misses     definitions read from the definitions file
+prompts               prompts asked
+prompt                seconds spent waiting for the answer to a prompt
+learned               words learned
+accepted              suggestions accepted without asking
+corrected             misspellings corrected to known words
+saves                 saves
+save                  seconds spent saving
+save_bytes            bytes written by saves and compactions
+recover_words         seconds spent opening the stored words
+recover_user_data     seconds spent reading the user data
+===================== =========================================================================================
+
+Classes:
+
+    Histogram
+
+Functions:
+
+    enable()
+    start() -> float
+    stop(name, started)
+    count(name, value)
+    observe(name, seconds)
+    summary() -> list
+    prometheus() -> str
+    to_json() -> str
+    dump(file)
+
+Variables:
+
+    enabled
+    counters
+    histograms
+
+Authors:
+
+    Samuel Henderson
+"""
+
+import threading
+from time import perf_counter
+
+
+# Whether statistics are being collected
+enabled: bool = False
+
+# The value of each counter, by name
+counters: dict = {}
+
+# The Histogram of each latency, by name
+histograms: dict = {}
+
+# Serializes updates from concurrent sessions
+lock = threading.Lock()
+
+# The upper bound in seconds of each histogram bucket but the last, which is unbounded
+BOUNDS = [0.000001 * 4 ** power for power in range(13)]
+
+
+class Histogram:
+    """
+    The distribution of a latency over buckets whose bounds grow by a factor of four, from a microsecond to 16 seconds.
+
+    Attributes:
+
+        buckets : list
+            The number of observations in each bucket; the last bucket holds those above the largest bound.
+        count : int
+            The number of observations.
+        total : float
+            The sum of the observations in seconds.
+
+    Functions:
+
+        add(seconds):
+            Records an observation.
+        quantile(q) -> float:
+            Estimates the latency below which a fraction of the observations fall.
+
+    """
+
+    __slots__ = ('buckets', 'count', 'total')
+
+    def __init__(self):
+        self.buckets = [0] * (len(BOUNDS) + 1)
+        self.count = 0
+        self.total = 0.0
+
+    def add(self, seconds: float) -> None:
+        index = 0
+        while index < len(BOUNDS) and BOUNDS[index] < seconds:
+            index += 1
+
+        self.buckets[index] += 1
+        self.count += 1
+        self.total += seconds
+
+    def quantile(self, q: float) -> float:
+        """
+        Estimates the latency below which a fraction of the observations fall, as the upper bound of its bucket.
+        """
+
+        rank = q * self.count
+        seen = 0
+        for index, observations in enumerate(self.buckets):
+            seen += observations
+            if rank <= seen and 0 < observations:
+                return BOUNDS[index] if index < len(BOUNDS) else float('inf')
+        return 0.0
+
+
+def enable() -> None:
+    """
+    Starts collecting statistics.
+    """
+
+    global enabled
+
+    enabled = True
+
+
+def start() -> float:
+    """
+    Provides the time that a timed section starts at, or 0 when statistics are not being collected.
+    """
+
+    return perf_counter() if enabled else 0.0
+
+
+def stop(name: str, started: float) -> None:
+    """
+    Records the latency of a timed section that started at a time provided by start.
+    """
+
+    if enabled:
+        observe(name, perf_counter() - started)
+
+
+def count(name: str, value: int = 1) -> None:
+    """
+    Increments a counter. Call sites should check that statistics are being collected first.
+    """
+
+    with lock:
+        counters[name] = counters.get(name, 0) + value
+
+
+def observe(name: str, seconds: float) -> None:
+    """
+    Records a latency. Call sites should check that statistics are being collected first.
+    """
+
+    with lock:
+        histogram = histograms.get(name)
+        if histogram is None:
+            histogram = histograms[name] = Histogram()
+        histogram.add(seconds)
+
+
+def summary() -> list:
+    """
+    Provides a line for each counter and histogram, in name order.
+    """
+
+    out = []
+
+    with lock:
+        for name in sorted(counters):
+            out.append("%s: %d" % (name, counters[name]))
+
+        for name in sorted(histograms):
+            histogram = histograms[name]
+            out.append("%s: %d, mean %.3f ms, p50 <= %.3f ms, p99 <= %.3f ms"
+                       % (name, histogram.count, histogram.total / histogram.count * 1e3,
+                          histogram.quantile(0.5) * 1e3, histogram.quantile(0.99) * 1e3))
+
+    return out
+
+
+def prometheus() -> str:
+    """
+    Formats every counter and histogram in the Prometheus text exposition format.
+    Latencies are exported in seconds with cumulative buckets.
+    """
+
+    out = []
+
+    with lock:
+        for name in sorted(counters):
+            out.append("# TYPE charm_%s_total counter" % name)
+            out.append("charm_%s_total %d" % (name, counters[name]))
+
+        for name in sorted(histograms):
+            histogram = histograms[name]
+            out.append("# TYPE charm_%s_seconds histogram" % name)
+
+            cumulative = 0
+            for index, observations in enumerate(histogram.buckets):
+                cumulative += observations
+                bound = repr(BOUNDS[index]) if index < len(BOUNDS) else "+Inf"
+                out.append("charm_%s_seconds_bucket{le=\"%s\"} %d" % (name, bound, cumulative))
+
+            out.append("charm_%s_seconds_sum %r" % (name, histogram.total))
+            out.append("charm_%s_seconds_count %d" % (name, histogram.count))
+
+    return "\n".join(out) + "\n"
+
+
+def to_json() -> str:
+    """
+    Formats every counter and histogram as a JSON object.
+    """
+
+    import json
+
+    with lock:
+        return json.dumps({
+            "counters": dict(counters),
+            "histograms": {name: {"count": histogram.count, "sum": histogram.total,
+                                  "bounds": BOUNDS, "buckets": histogram.buckets}
+                           for name, histogram in histograms.items()},
+        }, indent=2)
+
+
+def dump(file: str) -> None:
+    """
+    Writes every counter and histogram into a file; as JSON if its name ends with .json, or as Prometheus text otherwise.
+    """
+
+    with open(file, "w") as out:
+        out.write(to_json() if file.endswith(".json") else prometheus())
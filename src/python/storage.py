@@ -0,0 +1,1059 @@
+"""
+Provides the backends that the book and user data are saved in.
+
+Classes:
+
+    Storage
+    FileStorage
+    ProfileStorage
+    SQLiteStorage
+    Table
+
+Functions:
+
+    apply(book, operation, word, argument)
+    mutated(book, operation, word) -> list
+    import_words(book, file) -> int
+    write_atomic(file, lines) -> int
+    store_contents(file, create) -> list
+
+Authors:
+
+    Samuel Henderson
+"""
+
+import os
+import os.path as path
+import re
+from abc import ABC, abstractmethod
+from contextlib import nullcontext
+import src.python.definitions as definitions
+import src.python.fuzzy as fuzzy
+import src.python.indexes as indexes
+import src.python.snapshot as snapshot
+import src.python.suggest as suggest
+from src.python.data import *
+
+
+# Matches the names of user profiles, which name their directories
+PROFILE = re.compile(r"\w[\w.-]*")
+
+# The modules that derive indexes or statistics from the book, which are written next to each snapshot
+DERIVED = (suggest, fuzzy, indexes)
+
+
+class Storage(ABC):
+    """
+    A backend that the book and user data are saved in.
+
+    Functions:
+
+        recover(book):
+            Opens the stored words as the base of a Vocabulary.
+        stage(book, changes) -> object:
+            Copies the mutations made since the last save, and whatever saving them reads from the book. It is called
+            with the lock held, so it only copies, and the book can keep changing while the copies are written.
+        save(book, staged, userdata, lock) -> int:
+            Persists the staged mutations and the user data, and provides the bytes written. The lock, if any, is only
+            held while the book is updated with what was written.
+        compact(book) -> int:
+            Persists every known Word, and provides the bytes written.
+        read_user_data() -> list:
+            Provides the lines of the user data.
+
+    """
+
+    @abstractmethod
+    def recover(self, book) -> None:
+        pass
+
+    def stage(self, book, changes: list):
+        return changes
+
+    @abstractmethod
+    def save(self, book, staged, userdata: list, lock=None) -> int:
+        pass
+
+    @abstractmethod
+    def compact(self, book) -> int:
+        pass
+
+    @abstractmethod
+    def read_user_data(self) -> list:
+        pass
+
+
+class FileStorage(Storage):
+    """
+    Stores the book as a memory-mapped snapshot with a journal of the mutations made since it was written, and the user
+    data as a text file.
+
+    FILES:
+    ========= =========================================================================================
+    book      the snapshot of the book (see the snapshot module)
+    defns.N   the definitions the snapshot of generation N refers to (see the definitions module); defns for 0
+    NAME.N    the indexes derived from the snapshot of generation N by the module NAME; suggest, fuzzy and indexes
+    journal   the mutations saved since the snapshot was written
+    words     a text words file, imported when there is no snapshot
+    user_data the user data
+    ========= =========================================================================================
+
+    JOURNAL:
+    ========= ================= ========================================
+    snapshot  generation
+    add_word  word              part index
+    add_part  word              part index
+    define    word              definition
+    add_key   word              key:count
+    associate keys              window
+    ========= ================= ========================================
+
+    Fields are separated with tabs. The journal starts with the generation of the snapshot it applies to, so that a
+    journal that was compacted into a new snapshot, but not emptied before the compaction was interrupted, is ignored.
+
+    The indexes and statistics derived from the book are written next to each snapshot, revised from those of the
+    previous snapshot with the Words that changed, and loaded with it on recovery, so they are not built from the whole
+    book in every process (see the attach function).
+
+    Attributes:
+
+        root : str
+            The directory the files are stored in.
+        journaled : int
+            The number of entries in the journal file.
+        compact_after : int
+            The number of journal entries after which the journal is compacted into the snapshot.
+        generation : int
+            The generation of the snapshot (see the snapshot module), or 0 if there is none.
+        touched : set
+            The keys of the Words changed since the snapshot was written.
+
+    """
+
+    def __init__(self, root: str = "data", compact_after: int = 1000):
+        self.root = root
+        self.journaled = 0
+        self.compact_after = compact_after
+        self.generation = 0
+        self.touched = set()
+
+    def path(self, name: str) -> str:
+        return path.join(self.root, name)
+
+    def recover(self, book) -> None:
+        """
+        Opens the snapshot and replays the journal on top of it.
+        When there is no snapshot, each line in the words file is parsed as a Word instead, and the book is compacted
+        into a snapshot so that the definitions are no longer held in memory.
+        """
+
+        base = snapshot.Snapshot(self.path("book")) if path.exists(self.path("book")) else None
+        self.generation = 0 if base is None else base.generation
+        definitions.open_store(self.defns(self.generation))
+
+        imported = False
+        if base is not None:
+            book.open(base)
+        elif path.exists(self.path("words")):
+            imported = 0 < import_words(book, self.path("words"))
+        else:
+            # Create the file if it is missing
+            open(self.path("words"), "w+").close()
+
+        self.replay(book)
+
+        if imported:
+            self.compact(book)
+
+        self.attach(book, book.base, self.derived(self.generation), self.touched)
+
+    def replay(self, book) -> None:
+        """
+        Applies each mutation in the journal file to the book.
+        Entries are applied in the order they were saved. An incomplete final entry, left by an interrupted save, is
+        ignored, and so is a journal that starts with the generation of another snapshot, as it was compacted into the
+        snapshot before it could be emptied. Either way the journal is rewritten with only the entries that were
+        applied, so that later entries are appended after complete ones.
+        """
+
+        self.journaled = 0
+        self.touched.clear()
+
+        applied = []
+        current = False
+        complete = True
+
+        if path.exists(self.path("journal")):
+            for line in open(self.path("journal")):
+                if not line.endswith("\n"):
+                    # The final entry was not completely written
+                    complete = False
+                    break
+
+                entry = line[:-1].split("\t", 2)
+                if entry[0] == "snapshot":
+                    current = entry[1] == str(self.generation)
+                    if not current:
+                        break
+                elif len(entry) == 3:
+                    self.apply(book, *entry)
+                    applied.append(line)
+
+        self.journaled = len(applied)
+
+        if not current or not complete:
+            write_atomic(self.path("journal"), [self.header()] + applied)
+
+    def defns(self, generation: int) -> str:
+        """
+        Provides the path of the definitions file that the snapshot of a generation refers to.
+        """
+
+        return self.path("defns" if generation == 0 else "defns." + str(generation))
+
+    def derived(self, generation: int) -> list:
+        """
+        Provides each module that derives indexes from the book, with the path of the file of the indexes it derived
+        from the snapshot of a generation.
+        """
+
+        return [(module, self.path(module.__name__.rsplit(".", 1)[-1] + "." + str(generation))) for module in DERIVED]
+
+    def attach(self, book, written, derived: list, keys) -> None:
+        """
+        Loads the indexes derived from a snapshot, and revises them with the Words changed since it was written, so
+        that they are not built from the whole book when they are first used. Indexes that were not written with the
+        snapshot, such as those of a snapshot written before they were derived, are built from the book instead.
+
+        :param book: The Vocabulary the snapshot is part of the base of
+        :param written: The snapshot the indexes were derived from, if any
+        :param derived: Each module and the file of its indexes (see the derived function)
+        :param keys: The keys of the Words changed since the snapshot was written
+        """
+
+        changes = None
+
+        for module, file in derived:
+            if not module.load(file) or written is None:
+                continue
+
+            if changes is None:
+                changes = []
+                for key in keys:
+                    word = book.entries.get(key)
+                    changes.append((key, written.get(key), book.base.get(key) if word is None else word))
+
+            for key, previous, word in changes:
+                module.revise(key, previous, word)
+
+    def builders(self, book, words: dict) -> list:
+        """
+        Provides a builder of the indexes of each module that derives them from the book, for a new snapshot.
+        The indexes derived from the snapshot are read into the builders and revised with the changed Words, so they are
+        not derived from every Word again; builders of indexes that were not written with the snapshot are empty.
+
+        :param book: The Vocabulary the snapshot is the base of
+        :param words: Copies of the Words changed since the snapshot was written, by key
+        :return: A list of (builder, empty) tuples, where empty is whether the builder holds no indexes
+        """
+
+        builders = []
+        for module, file in self.derived(self.generation):
+            builder = module.Builder()
+            builders.append((builder, book.base is None or not builder.read(file)))
+
+        revised = [builder for builder, empty in builders if not empty]
+        if len(revised) == 0:
+            return builders
+
+        # The changed Words are found in the snapshot together, in key order
+        keys = sorted(words)
+        for key, index in zip(keys, book.base.search(key.encode('utf-8') for key in keys)):
+            word = words[key]
+            previous = None if index == -1 else book.base.materialize(index)
+
+            # Words that were only looked up since have not changed the indexes
+            if previous is None or (previous.mask, previous.text) != (word.mask, word.text):
+                for builder in revised:
+                    builder.revise(key, previous, word)
+
+        return builders
+
+    def derive(self, book, words, builders: list):
+        """
+        Yields Words, adding each of them to the empty builders first, while its definition can still be read.
+        """
+
+        for word in words:
+            key = book.normalize(word.word)
+            for builder in builders:
+                builder.add(key, word)
+            yield word
+
+    def header(self) -> str:
+        """
+        Provides the first entry of a journal that applies to the snapshot.
+        """
+
+        return "snapshot\t" + str(self.generation) + "\t\n"
+
+    def apply(self, book, operation: str, word: str, argument: str) -> None:
+        """
+        Applies a mutation replayed from the journal to the book.
+        """
+
+        self.touched.update(mutated(book, operation, word))
+        apply(book, operation, word, argument)
+
+    def stage(self, book, changes: list) -> tuple:
+        """
+        Copies the Words changed since the snapshot was written when this save compacts the journal, so that the new
+        snapshot can be written without the lock.
+
+        :return: A (changes, copies, extra) tuple; copies holds the copy of each changed Word by key, or is None when
+                 the journal is not compacted, and extra is the number of materialized Words not in the snapshot
+        """
+
+        if self.journaled + len(changes) < self.compact_after:
+            return changes, None, book.extra
+
+        keys = set(self.touched)
+        for operation, word, argument in changes:
+            keys.update(mutated(book, operation, word))
+
+        copies = {}
+        for key in keys:
+            word = book.entries.get(key)
+            if word is not None:
+                copies[key] = word.copy()
+
+        return changes, copies, book.extra
+
+    def save(self, book, staged: tuple, userdata: list, lock=None) -> int:
+        """
+        Appends the mutations to the journal, which is flushed to disk before returning.
+        Once the journal holds enough entries it is compacted into the snapshot, which is written from the copies the
+        mutations were staged with; the lock is only held while the new snapshot replaces the old one.
+        """
+
+        changes, copies, extra = staged
+        written = 0
+
+        if 0 < len(changes):
+            journal = open(self.path("journal"), "a")
+            before = journal.tell()
+            for operation, word, argument in changes:
+                journal.write(operation + "\t" + word + "\t" + argument + "\n")
+            journal.flush()
+            os.fsync(journal.fileno())
+            written += journal.tell() - before
+            journal.close()
+
+            self.journaled += len(changes)
+            for operation, word, argument in changes:
+                self.touched.update(mutated(book, operation, word))
+
+        if copies is not None:
+            written += self.rewrite(book, copies, extra, lock)
+
+        return written + write_atomic(self.path("user_data"), userdata)
+
+    def compact(self, book) -> int:
+        """
+        Compacts the journal by writing every known Word into a new snapshot and emptying the journal.
+        The materialized Words are copied at once, so the lock must be held. As nothing can change while it is, the
+        indexes derived from the book are then loaded from the files written next to the new snapshot, which take far
+        less memory than the changes indexed since the previous snapshot, as imports and corpora make many of them.
+        """
+
+        written = self.rewrite(book, {key: word.copy() for key, word in book.entries.items()}, book.extra)
+        self.attach(book, book.base, self.derived(self.generation), ())
+        return written
+
+    def rewrite(self, book, words: dict, extra: int, lock=None) -> int:
+        """
+        Writes the changed Words and the unchanged Words of the snapshot into a new snapshot of the next generation,
+        which replaces the snapshot, and empties the journal. Only replacing the snapshot holds the lock.
+        The definitions that are still referred to are written into a new definitions file of the same generation, so
+        replaced definitions are dropped, and the previous definitions file is removed once the snapshot is replaced;
+        so are the indexes derived from the previous snapshot, once those of the new snapshot have been revised from
+        them (see the builders function).
+        A crash at any point leaves either the previous snapshot and its journal or the new snapshot in place; a journal
+        that was compacted into the new snapshot starts with the previous generation, so it is not replayed again.
+
+        :param book: The Vocabulary the snapshot is the base of
+        :param words: Copies of the Words changed since the snapshot was written, by key
+        :param extra: The number of materialized Words that were not in the snapshot when the Words were collected
+        :return: The size of the new snapshot in bytes
+        """
+
+        generation = self.generation + 1 & 0xFFFF
+        temp = self.path("book.tmp")
+        previous = self.defns(self.generation)
+        stale = self.derived(self.generation)
+        builders = self.builders(book, words)
+        defns = definitions.Rewrite(self.defns(generation))
+
+        try:
+            empty = [builder for builder, blank in builders if blank]
+            snapshot.write(temp, self.derive(book, self.layered(book, words), empty), defns, book.normalize,
+                           generation)
+            for (builder, blank), (module, file) in zip(builders, self.derived(generation)):
+                builder.write(file)
+        except BaseException:
+            defns.discard()
+            raise
+
+        with lock or nullcontext():
+            with book.lock:
+                moved = {}
+                try:
+                    for key, live in book.entries.items():
+                        word = words.get(key)
+                        if word is not None and live.revision == word.revision:
+                            # Unchanged Words refer to the definitions their copies were written with
+                            moved[key] = word.text
+                        elif live.text.__class__ is int:
+                            # Other Words refer to the copies of their definitions in the new definitions file
+                            moved[key] = defns.move(live.text)
+                    defns.flush()
+                except BaseException:
+                    defns.discard()
+                    raise
+
+                self.install(book, temp, book.extra - extra)
+                defns.install([(book.entries[key], handle) for key, handle in moved.items()])
+
+        self.generation = generation
+        write_atomic(self.path("journal"), [self.header()])
+        self.journaled = 0
+        self.touched.clear()
+
+        if previous != defns.file and path.exists(previous):
+            os.remove(previous)
+        for module, file in stale:
+            if path.exists(file):
+                os.remove(file)
+
+        return path.getsize(self.path("book"))
+
+    def layered(self, book, words: dict):
+        """
+        Yields the changed Words, followed by the Words of the snapshot that have not changed.
+        """
+
+        yield from words.values()
+
+        if book.base is not None:
+            for key, handle in book.base.items():
+                if key not in words:
+                    yield book.base.materialize(handle)
+
+    def install(self, book, temp: str, extra: int) -> None:
+        """
+        Replaces the snapshot with a new snapshot file, as the base of the book.
+        """
+
+        if book.base is not None:
+            # The previous snapshot cannot be replaced while it is mapped on some platforms
+            book.base.close()
+        os.replace(temp, self.path("book"))
+        book.open(snapshot.Snapshot(self.path("book")), extra=extra)
+
+    def read_user_data(self) -> list:
+        return store_contents(self.path("user_data"), create=True)
+
+
+class ProfileStorage(FileStorage):
+    """
+    Stores the book of a user profile as an overlay of the Words that the profile has changed, layered over the shared
+    snapshot of the book, which is only ever read. Each profile keeps its own journal and user data in a directory
+    under the shared directory, so profiles only take as much space as their changes.
+
+    FILES:
+    ========= =========================================================================================
+    book      the overlay snapshot of the Words changed by the profile
+    defns.N   the definitions the overlay of generation N refers to, copied from the shared file where unchanged
+    journal   the mutations saved since the overlay was written
+    user_data the user data of the profile, copied from the shared user data when the profile is created
+    ========= =========================================================================================
+
+    When there is no shared snapshot, the shared words file is imported and compacted into one first. The Words of the
+    overlay never refer to the shared definitions file, which is replaced whenever the shared book is compacted by any
+    process; their definitions are copied into the definitions file of the overlay instead. The indexes
+    derived from the shared snapshot are loaded and revised with the Words of the overlay, so profiles do not derive
+    indexes of their own.
+
+    Attributes:
+
+        name : str
+            The name of the profile.
+        shared : str
+            The directory the shared book is stored in; the profile is stored in its users/NAME subdirectory.
+        snapshot : Snapshot
+            The shared snapshot, if any.
+        top : Snapshot
+            The overlay snapshot, if any.
+        touched : set
+            The keys of the Words changed since the overlay was written.
+        generation : int
+            The generation of the overlay, or 0 if it has not been written.
+
+    """
+
+    def __init__(self, name: str, shared: str = "data", compact_after: int = 1000):
+        """
+        :raises ValueError: If the name is not a valid profile name
+        """
+
+        if PROFILE.fullmatch(name) is None:
+            raise ValueError("'" + name + "' is not a valid profile name")
+
+        super().__init__(path.join(shared, "users", name), compact_after)
+        self.name = name
+        self.shared = shared
+        self.snapshot = None
+        self.top = None
+
+    def recover(self, book) -> None:
+        """
+        Opens the overlay over the shared snapshot and replays the journal on top of both.
+        """
+
+        os.makedirs(self.root, exist_ok=True)
+
+        shared = FileStorage(self.shared)
+        if not path.exists(shared.path("book")):
+            # Build the shared snapshot once, outside of the book of the profile
+            scratch = type(book)(book.fold, book.form)
+            shared.recover(scratch)
+            if scratch.base is not None:
+                scratch.base.close()
+
+        if path.exists(shared.path("book")):
+            self.snapshot = snapshot.Snapshot(shared.path("book"))
+
+        self.layer(book)
+        definitions.open_store(shared.defns(0 if self.snapshot is None else self.snapshot.generation),
+                               self.defns(self.generation))
+        self.replay(book)
+
+        if self.snapshot is not None:
+            keys = set(self.touched)
+            if self.top is not None:
+                keys.update(self.top.keys())
+            self.attach(book, self.snapshot, shared.derived(self.snapshot.generation), keys)
+
+    def layer(self, book, extra: int = None) -> None:
+        """
+        Opens the overlay, if it has been written, and layers it over the shared snapshot as the base of the book.
+        """
+
+        self.top = snapshot.Snapshot(self.path("book")) if path.exists(self.path("book")) else None
+        self.generation = 0 if self.top is None else self.top.generation
+
+        if self.top is None:
+            book.open(self.snapshot, extra=extra)
+        elif self.snapshot is None:
+            book.open(self.top, extra=extra)
+        else:
+            book.open(snapshot.Overlay(self.top, self.snapshot), extra=extra)
+
+    def compact(self, book) -> int:
+        """
+        Compacts the journal by writing the Words in the overlay and those changed since into a new overlay, and
+        emptying the journal. The shared snapshot is never written. The changed Words are copied at once, so the lock
+        must be held.
+
+        Materialized Words are compared with the shared snapshot, so Words changed without saving any mutations, such
+        as those merged by imports or learned from corpora, are written into the overlay too.
+        """
+
+        words = {}
+        for key, word in book.entries.items():
+            if key in self.touched or self.changed(key, word):
+                words[key] = word.copy()
+
+        return self.rewrite(book, words, book.extra)
+
+    def builders(self, book, words: dict) -> list:
+        return []
+
+    def changed(self, key: str, word) -> bool:
+        """
+        Determines whether a materialized Word belongs in the overlay: whether it is in the overlay already, or differs
+        from the shared snapshot.
+        """
+
+        if self.top is not None and key in self.top:
+            return True
+        if self.snapshot is None:
+            return True
+
+        shared = self.snapshot.get(key)
+        if shared is None:
+            return True
+        return (shared.mask, shared.top, shared.text, shared.format_keys()) != \
+            (word.mask, word.top, word.text, word.format_keys())
+
+    def layered(self, book, words: dict):
+        """
+        Yields the changed Words, followed by the Words of the overlay that have not changed.
+        """
+
+        yield from words.values()
+
+        if self.top is not None:
+            for key, index in self.top.items():
+                if key not in words:
+                    yield self.top.materialize(index)
+
+    def install(self, book, temp: str, extra: int) -> None:
+        if self.top is not None:
+            # The previous overlay cannot be replaced while it is mapped on some platforms
+            self.top.close()
+        os.replace(temp, self.path("book"))
+        self.layer(book, extra)
+
+    def read_user_data(self) -> list:
+        """
+        Provides the lines of the user data of the profile, which are first copied from the shared user data if the
+        profile has none.
+        """
+
+        if not path.exists(self.path("user_data")):
+            os.makedirs(self.root, exist_ok=True)
+            write_atomic(self.path("user_data"), store_contents(path.join(self.shared, "user_data")))
+
+        return store_contents(self.path("user_data"))
+
+
+class SQLiteStorage(Storage):
+    """
+    Stores the book and user data in an indexed SQLite database.
+
+    Words are looked up from the database as they are needed, and saves apply only the mutations made since the last
+    save inside a single transaction. The database uses write-ahead logging, so several processes can share it.
+
+    Each mutation is merged into the stored row field by field, rather than replacing the row with the Word as this
+    process last saw it, so that the changes other processes have saved to the same Word are kept: parts are added to
+    the stored parts, and associations are counted into the stored keys, which are read again inside the transaction.
+    Words that have not changed again since are then updated with their merged rows.
+
+    Other processes change the database without compacting it, so no indexes are derived from it as they are from
+    snapshots; the indexes that queries are answered from are built from the book when they are first used.
+
+    TABLES:
+    ========= =========================================================================================
+    words     key (primary), word, mask, top, defn, keys
+    user      line (primary), value
+    meta      name (primary), value; the count row holds the number of stored Words
+    ========= =========================================================================================
+
+    Attributes:
+
+        file : str
+            The path of the database.
+        root : str
+            The directory that text words and user data files are imported from into an empty database.
+
+    """
+
+    def __init__(self, file: str = None, root: str = "data"):
+        self.root = root
+        self.file = file or path.join(root, "book.db")
+        self.connection = None
+
+    def connect(self):
+        if self.connection is None:
+            # The module is only imported when a database is used, as it is slow to import
+            import sqlite3
+
+            # Sessions served on other threads share the connection
+            self.connection = sqlite3.connect(self.file, timeout=30, check_same_thread=False)
+            self.connection.execute("PRAGMA journal_mode=WAL")
+            self.connection.execute("CREATE TABLE IF NOT EXISTS words (key TEXT PRIMARY KEY, word TEXT NOT NULL, "
+                                    "mask INTEGER NOT NULL, top INTEGER NOT NULL, defn TEXT NOT NULL, "
+                                    "keys TEXT NOT NULL) WITHOUT ROWID")
+            self.connection.execute("CREATE TABLE IF NOT EXISTS user (line INTEGER PRIMARY KEY, value TEXT NOT NULL)")
+            self.connection.execute("CREATE TABLE IF NOT EXISTS meta (name TEXT PRIMARY KEY, value INTEGER NOT NULL)")
+
+            with self.connection:
+                # Databases written before the count was kept are counted once
+                self.connection.execute("INSERT OR IGNORE INTO meta SELECT 'count', COUNT(*) FROM words")
+        return self.connection
+
+    def recover(self, book) -> None:
+        """
+        Opens the database as the base of the book.
+        An empty database is first filled from the text words file, if it exists.
+        """
+
+        connection = self.connect()
+        table = Table(connection)
+
+        if len(table) == 0 and path.exists(path.join(self.root, "words")):
+            import_words(book, path.join(self.root, "words"))
+            with connection:
+                connection.execute("BEGIN IMMEDIATE")
+                self.upsert(book, book.values())
+
+        book.open(table)
+
+    def upsert(self, book, words) -> int:
+        """
+        Merges whole Words into their rows, inserting the rows of any that are not stored yet. Parts are added to the
+        stored parts, a definition replaces the stored definition unless it is empty, and each key count replaces the
+        stored count unless that is higher, so the changes saved by other processes are only lost where both changed
+        the same field. The transaction must have been begun.
+
+        :return: The number of bytes in the text of the written rows
+        """
+
+        added = 0
+        written = 0
+        for word in words:
+            key = book.normalize(word.word)
+            defn = word.defn or ''
+            inserted = self.connection.execute("INSERT OR IGNORE INTO words VALUES (?, ?, ?, ?, ?, ?)",
+                                               (key, word.word, word.mask, word.top, defn, word.format_keys()))
+
+            if inserted.rowcount == 0:
+                stored = self.read(key)
+                stored.mask |= word.mask
+                stored.top = stored.top or word.top
+                stored.text = defn or stored.text
+                if word.keys is not None:
+                    for other, count in word.keys.items():
+                        if stored.keys.get(other) < count:
+                            stored.keys.set(other, count)
+                self.write(key, stored)
+
+            added += inserted.rowcount
+            written += len(key) + len(word.word) + len(defn) + len(word.format_keys()) + 8
+
+        self.count(added)
+        return written
+
+    def stage(self, book, changes: list) -> tuple:
+        """
+        Records the revision of each Word changed by the mutations, so that the Words that have not changed again by
+        the time the mutations are merged can be updated with their merged rows.
+
+        :return: A (changes, revisions) tuple; revisions holds the revision of each changed Word by key
+        """
+
+        revisions = {}
+        for operation, word, argument in changes:
+            for key in mutated(book, operation, word):
+                obj = book.entries.get(key)
+                if obj is not None:
+                    revisions[key] = obj.revision
+
+        return changes, revisions
+
+    def save(self, book, staged: tuple, userdata: list, lock=None) -> int:
+        """
+        Merges the mutations into the stored rows and replaces the user data in a single transaction, which holds the
+        write lock of the database from the start, so that no other process can change the rows once they are read.
+        The bytes written are counted from the text of the mutations and rows, as the database does not report them.
+        """
+
+        changes, revisions = staged
+
+        with self.connection:
+            self.connection.execute("BEGIN IMMEDIATE")
+            written = self.merge(book, changes)
+            self.write_user_data(userdata)
+            merged = {key: self.read(key) for key in revisions}
+
+        with lock or nullcontext():
+            with book.lock:
+                # Every Word added by this process is stored now, even if another process stored it first
+                book.persisted(sum(1 for change in changes if change[0] == "add_word"))
+
+                for key, stored in merged.items():
+                    live = book.entries.get(key)
+                    if stored is not None and live is not None and live.revision == revisions[key]:
+                        live.mask = stored.mask
+                        live.top = stored.top
+                        live.text = stored.text
+                        live.keys = stored.keys
+
+        return written + sum(len(line) for line in userdata)
+
+    def merge(self, book, changes: list) -> int:
+        """
+        Applies saved mutations to the stored rows, field by field, in the same way as they are applied to the book.
+        The transaction must have been begun.
+
+        :return: The number of bytes in the text of the mutations and of the rows whose keys were rewritten
+        """
+
+        # The stored Words whose keys are changed, read once each; None for Words that are not stored
+        stored = {}
+        written = 0
+        added = 0
+
+        def read(key: str):
+            if key not in stored:
+                stored[key] = self.read(key)
+            return stored[key]
+
+        for operation, word, argument in changes:
+            written += len(word) + len(argument) + 8
+
+            if operation == "add_word":
+                obj = Word(word, [argument])
+                key = book.normalize(word)
+                inserted = self.connection.execute("INSERT OR IGNORE INTO words VALUES (?, ?, ?, ?, '', '')",
+                                                   (key, word, obj.mask, obj.top))
+                added += inserted.rowcount
+                if inserted.rowcount == 0:
+                    # Another process stored the Word first
+                    self.add_part(key, obj.mask, obj.top)
+                stored.pop(key, None)
+            elif operation == "add_part":
+                part = get_part(int(argument))
+                self.add_part(book.normalize(word), part.bit(), part.indx())
+            elif operation == "define":
+                self.connection.execute("UPDATE words SET defn = ? WHERE key = ?", (argument, book.normalize(word)))
+            elif operation == "add_key":
+                obj = read(book.normalize(word))
+                if obj is not None:
+                    key, count = argument.rsplit(":", 1)
+                    obj.keys.set(key, int(count))
+            elif operation == "associate":
+                # The stored Words are associated as the Words of the line were (see Vocabulary.associate)
+                keys = [key for key in word.split(" ") if read(key) is not None]
+                window = int(argument)
+                for index, key in enumerate(keys):
+                    for other in range(index + 1, min(index + 1 + window, len(keys))):
+                        stored[key].keys.add(keys[other])
+                        stored[keys[other]].keys.add(key)
+
+        for key, obj in stored.items():
+            if obj is not None:
+                # Only the keys are written, as the other fields were merged by the statements above
+                keys = obj.format_keys()
+                self.connection.execute("UPDATE words SET keys = ? WHERE key = ?", (keys, key))
+                written += len(keys)
+
+        self.count(added)
+        return written
+
+    def read(self, key: str):
+        """
+        Reads the stored Word with a key, with its keys loaded even if it has none.
+        """
+
+        row = self.connection.execute("SELECT word, mask, top, defn, keys FROM words WHERE key = ?", (key,)).fetchone()
+        return None if row is None else Table.materialize(row)
+
+    def write(self, key: str, word: Word) -> None:
+        """
+        Replaces the parts, definition and keys of a stored Word.
+        """
+
+        self.connection.execute("UPDATE words SET mask = ?, top = ?, defn = ?, keys = ? WHERE key = ?",
+                                (word.mask, word.top, word.text, word.format_keys(), key))
+
+    def add_part(self, key: str, bits: int, top: int) -> None:
+        self.connection.execute("UPDATE words SET mask = mask | ?, top = CASE WHEN top = 0 THEN ? ELSE top END "
+                                "WHERE key = ?", (bits, top, key))
+
+    def count(self, added: int) -> None:
+        if added != 0:
+            self.connection.execute("UPDATE meta SET value = value + ? WHERE name = 'count'", (added,))
+
+    def compact(self, book) -> int:
+        """
+        Merges every materialized Word into its row in a single transaction (see the upsert function).
+        """
+
+        with self.connection:
+            self.connection.execute("BEGIN IMMEDIATE")
+            written = self.upsert(book, book.values())
+
+        book.persisted(book.extra)
+        return written
+
+    def read_user_data(self) -> list:
+        """
+        Provides the lines of the user data, which are first filled from the text user data file if there are none.
+        """
+
+        connection = self.connect()
+
+        if connection.execute("SELECT COUNT(*) FROM user").fetchone()[0] == 0:
+            with connection:
+                self.write_user_data(store_contents(path.join(self.root, "user_data")))
+
+        return [row[0] for row in connection.execute("SELECT value FROM user ORDER BY line")]
+
+    def write_user_data(self, lines: list) -> None:
+        self.connection.execute("DELETE FROM user")
+        self.connection.executemany("INSERT INTO user VALUES (?, ?)", enumerate(lines))
+
+
+class Table:
+    """
+    The words table of an SQLite database, read as the base of a Vocabulary in the same way as a Snapshot.
+    The number of stored Words is read from the database each time, as other processes may have stored more.
+    """
+
+    def __init__(self, connection):
+        self.connection = connection
+
+    def __len__(self):
+        return self.connection.execute("SELECT value FROM meta WHERE name = 'count'").fetchone()[0]
+
+    def __contains__(self, key):
+        return self.connection.execute("SELECT 1 FROM words WHERE key = ?", (key,)).fetchone() is not None
+
+    def close(self) -> None:
+        pass
+
+    def get(self, key: str):
+        row = self.connection.execute("SELECT word, mask, top, defn, keys FROM words WHERE key = ?", (key,)).fetchone()
+        return None if row is None else self.materialize(row)
+
+    @staticmethod
+    def materialize(row: tuple) -> Word:
+        word, mask, top, defn, keys = row
+
+        obj = Word(word, ())
+        obj.mask = mask
+        obj.top = top
+        # Loading a Word is not a change
+        obj.text = defn
+        obj.load_keys(keys)
+        return obj
+
+    def keys(self):
+        for row in self.connection.execute("SELECT key FROM words ORDER BY key"):
+            yield row[0]
+
+    def items(self):
+        for row in self.connection.execute("SELECT key, word, mask, top, defn, keys FROM words ORDER BY key"):
+            yield row[0], row[1:]
+
+    def prefixed(self, prefix: str, limit: int = None):
+        """
+        Yields the key and row of every stored Word whose key starts with a prefix, in key order.
+        """
+
+        if prefix == '':
+            query = self.connection.execute("SELECT key, word, mask, top, defn, keys FROM words ORDER BY key "
+                                            "LIMIT ?", (-1 if limit is None else limit,))
+        else:
+            # Keys starting with the prefix sort between it and the prefix with its last character incremented
+            upper = prefix[:-1] + chr(ord(prefix[-1]) + 1)
+            query = self.connection.execute("SELECT key, word, mask, top, defn, keys FROM words WHERE key >= ? AND "
+                                            "key < ? ORDER BY key LIMIT ?",
+                                            (prefix, upper, -1 if limit is None else limit))
+
+        for row in query:
+            yield row[0], row[1:]
+
+
+def apply(book, operation: str, word: str, argument: str) -> None:
+    """
+    Applies a saved mutation to the book.
+
+    :param book: The Vocabulary to mutate
+    :param operation: The name of the mutation; one of add_word, add_part, define, add_key or associate
+    :param word: The word string of the mutated Word, or the keys of the associated Words separated by spaces
+    :param argument: The part index, definition, key count or association window of the mutation
+    """
+
+    if operation == "add_word":
+        book.add(Word(word, [argument]))
+        return
+
+    if operation == "associate":
+        # The Words are associated again as they were when the line was processed
+        words = [obj for obj in map(book.get, word.split(" ")) if obj is not None]
+        book.associate(words, int(argument))
+        return
+
+    obj = book.get(word)
+    if obj is None:
+        # Mutations of unknown words cannot be applied
+        return
+
+    if operation == "add_part":
+        obj.add_part(get_part(int(argument)))
+    elif operation == "define":
+        obj.define(argument)
+    elif operation == "add_key":
+        key, count = argument.rsplit(":", 1)
+        obj.set_key(key, int(count))
+
+
+def mutated(book, operation: str, word: str) -> list:
+    """
+    Provides the keys of the Words changed by a saved mutation.
+    """
+
+    if operation == "associate":
+        return word.split(" ")
+    return [book.normalize(word)]
+
+
+def import_words(book, file: str) -> int:
+    """
+    Parses each line in a text words file as a Word and adds it to the book.
+    Large files are parsed in worker processes (see the loader module).
+
+    :return: The number of Words added
+    """
+
+    # The loader starts multiprocessing, which is only worth importing when there is a words file to import
+    import src.python.loader as loader
+
+    return loader.load(book, file)
+
+
+def write_atomic(file: str, lines) -> int:
+    """
+    Writes lines into a temporary file and renames it over the destination once it has been flushed to disk.
+
+    :param file: The path of the file to replace
+    :param lines: The lines to write, including their line endings
+    :return: The number of bytes written
+    """
+
+    temp = file + ".tmp"
+
+    out = open(temp, "w")
+    for line in lines:
+        out.write(line)
+    out.flush()
+    os.fsync(out.fileno())
+    written = out.tell()
+    out.close()
+
+    os.replace(temp, file)
+    return written
+
+
+def store_contents(file: str, create: bool = False) -> list:
+    """
+    Reads the contents of a file into a list.
+    Each entry in the list represents a line in the provided file, if it exists.
+
+    :param file: The path of the file to read
+    :param create: Should the file be created if it does not exist
+    :return: A list containing the contents of the file
+    """
+
+    if not path.exists(file):
+        if create:
+            open(file, "w+").close()
+        return []
+    else:
+        lines = []
+        for line in open(file):
+            lines.append(line)
+        return lines
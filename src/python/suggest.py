@@ -0,0 +1,315 @@
+"""
+Suggests the part of speech of unknown words.
+
+Suggestions combine the parts of known words that share a suffix with the unknown word, and how often each part follows
+or precedes the parts of its neighbours in processed lines. The statistics are updated in constant time whenever a word
+is learned or a line is processed.
+
+The statistics are written next to each snapshot of the book when it is compacted (see the FileStorage class), and
+loaded with the snapshot when a process starts, so the parts of every word are not counted again. Statistics that
+were not written with the snapshot are collected from the book when the first suggestion is made instead. Those of
+neighbours are only ever collected from processed lines, so they are saved with the user data instead, and are kept
+from one save to the next (see the accessor module).
+
+Classes:
+
+    Builder
+
+Functions:
+
+    train(words)
+    load(file) -> bool
+    revise(key, previous, word)
+    learn(word, part)
+    observe(words)
+    format_bigrams() -> str
+    parse_bigrams(text) -> bool
+    suggest(word, previous, following) -> list
+    best(word, previous, following) -> tuple
+
+Variables:
+
+    threshold
+    suffix_lengths
+    support
+    trained
+
+Authors:
+
+    Samuel Henderson
+"""
+
+import json
+import os
+from src.python.data import *
+
+
+# The confidence at or above which a suggestion is accepted without asking
+threshold: float = 0.9
+
+# The longest suffix that statistics are collected for
+suffix_lengths: int = 3
+
+# The number of known words a suffix must have been seen in before it is used
+support: int = 3
+
+# Whether the statistics have been collected from the book
+trained: bool = False
+
+# The number of times each Part has been learned, by index; position 0 holds the total
+totals: list = [0] * 10
+
+# The number of times each Part has been learned for words with a suffix; position 0 holds the total
+suffixes: dict = {}
+
+# The number of times each Part (column) has followed each Part (row) in processed lines; row and column 0 hold totals
+bigrams: list = [[0] * 10 for _ in range(10)]
+
+# The smoothing added to every count
+ALPHA = 0.5
+
+
+class Builder:
+    """
+    Statistics of the parts of Words that are written into a file. They are either counted from every Word, or read
+    from the file of an earlier snapshot and revised with the Words that have changed since.
+
+    Functions:
+
+        add(key, word):
+            Counts the parts of a Word.
+        revise(key, previous, word):
+            Counts a changed Word in place of what it was.
+        read(file) -> bool:
+            Reads the statistics written into a file.
+        write(file) -> int:
+            Writes the statistics into a file, which is flushed to disk before returning.
+
+    """
+
+    def __init__(self):
+        self.totals = [0] * 10
+        self.suffixes = {}
+
+    def add(self, key: str, word: Word) -> None:
+        recount(None, word, self.totals, self.suffixes)
+
+    def revise(self, key: str, previous, word) -> None:
+        recount(previous, word, self.totals, self.suffixes)
+
+    def read(self, file: str) -> bool:
+        """
+        Reads the statistics written into a file.
+
+        :return: Whether the file holds complete statistics
+        """
+
+        if not os.path.exists(file):
+            return False
+
+        try:
+            with open(file, 'rb') as source:
+                data = json.loads(source.read().decode('utf-8'))
+        except ValueError:
+            # The file was not completely written
+            return False
+
+        self.totals = data["totals"]
+        self.suffixes = data["suffixes"]
+        return True
+
+    def write(self, file: str) -> int:
+        """
+        Writes the statistics into a file as a JSON object of the totals and the counts of each suffix.
+
+        :return: The size of the file in bytes
+        """
+
+        data = json.dumps({"totals": self.totals, "suffixes": self.suffixes}).encode('utf-8')
+
+        with open(file, 'wb') as out:
+            out.write(data)
+            out.flush()
+            os.fsync(out.fileno())
+
+        return len(data)
+
+
+def train(words) -> None:
+    """
+    Collects statistics from every Word in the book.
+    Statistics are only collected once; later changes are learned incrementally.
+
+    :param words: Every known Word
+    """
+
+    global trained
+
+    if trained:
+        return
+
+    for word in words:
+        recount(None, word)
+
+    trained = True
+
+
+def load(file: str) -> bool:
+    """
+    Replaces the statistics with statistics written into a file (see the Builder class).
+
+    :return: Whether the file holds complete statistics; if not, the statistics of parts are emptied, to be collected
+             from the book
+    """
+
+    global trained
+
+    loaded = Builder()
+    trained = loaded.read(file)
+
+    totals[:] = loaded.totals
+    suffixes.clear()
+    suffixes.update(loaded.suffixes)
+    return trained
+
+
+def revise(key: str, previous, word) -> None:
+    """
+    Updates loaded statistics with a Word that was changed after they were written.
+
+    :param key: The normalized key of the Word
+    :param previous: The Word as the statistics were written with it, or None if it was not known then
+    :param word: The Word as it is now
+    """
+
+    if trained:
+        recount(previous, word)
+
+
+def recount(previous, word, into: list = None, by_suffix: dict = None) -> None:
+    """
+    Counts the parts of a Word in place of the parts it had before, into the statistics of the book by default.
+    """
+
+    if previous is not None:
+        for part in previous.parts:
+            count(previous.word, part.indx(), into, by_suffix, -1)
+    if word is not None:
+        for part in word.parts:
+            count(word.word, part.indx(), into, by_suffix)
+
+
+def learn(word: str, part: Part) -> None:
+    """
+    Records that a word has been assigned to a part of speech.
+    Nothing is recorded before the statistics have been collected from the book, as they will include the word.
+    """
+
+    if trained:
+        count(word, part.indx())
+
+
+def count(word: str, index: int, into: list = None, by_suffix: dict = None, step: int = 1) -> None:
+    """
+    Counts a word as assigned to a part of speech, into the statistics of the book by default.
+    """
+
+    into = totals if into is None else into
+    by_suffix = suffixes if by_suffix is None else by_suffix
+    word = word.lower()
+
+    into[0] += step
+    into[index] += step
+
+    for length in range(1, min(suffix_lengths, len(word)) + 1):
+        counts = by_suffix.get(word[-length:])
+        if counts is None:
+            counts = by_suffix[word[-length:]] = [0] * 10
+        counts[0] += step
+        counts[index] += step
+
+
+def observe(words: list) -> None:
+    """
+    Records the parts of speech of neighbouring Words in a processed line.
+
+    :param words: The Words of a line in order, with None for words that are unknown
+    """
+
+    for previous, current in zip(words, words[1:]):
+        if previous is not None and current is not None and previous.top != 0 and current.top != 0:
+            bigrams[previous.top][current.top] += 1
+            bigrams[previous.top][0] += 1
+            bigrams[0][current.top] += 1
+
+
+def format_bigrams() -> str:
+    """
+    Formats the statistics of neighbours as the counts of each row, separated by spaces.
+    """
+
+    return " ".join(str(count) for row in bigrams for count in row)
+
+
+def parse_bigrams(text: str) -> bool:
+    """
+    Replaces the statistics of neighbours with statistics formatted by the format_bigrams function.
+
+    :return: Whether the text holds complete statistics; if not, the statistics are left as they were
+    """
+
+    counts = text.split()
+    if len(counts) != 100 or not all(count.isdigit() for count in counts):
+        return False
+
+    bigrams[:] = [[int(count) for count in counts[row:row + 10]] for row in range(0, 100, 10)]
+    return True
+
+
+def suggest(word: str, previous: Word = None, following: Word = None) -> list:
+    """
+    Ranks the parts of speech an unknown word may belong to.
+
+    :param word: The unknown word
+    :param previous: The known Word before it in its line, if any
+    :param following: The known Word after it in its line, if any
+    :return: A list of (Part, confidence) tuples, most likely first, whose confidences sum to 1
+    """
+
+    word = word.lower()
+
+    # Use the longest suffix that has been seen often enough, or the frequency of each Part otherwise
+    counts = totals
+    for length in range(min(suffix_lengths, len(word)), 0, -1):
+        candidate = suffixes.get(word[-length:])
+        if candidate is not None and support <= candidate[0]:
+            counts = candidate
+            break
+
+    scores = []
+    for index in range(1, 10):
+        score = (counts[index] + ALPHA) / (counts[0] + 9 * ALPHA)
+
+        if previous is not None and previous.top != 0:
+            row = bigrams[previous.top]
+            score *= (row[index] + ALPHA) / (row[0] + 9 * ALPHA)
+
+        if following is not None and following.top != 0:
+            score *= (bigrams[index][following.top] + ALPHA) / (bigrams[index][0] + 9 * ALPHA)
+
+        scores.append((score, index))
+
+    total = sum(score for score, index in scores)
+    scores.sort(reverse=True)
+
+    return [(by_index[index], score / total) for score, index in scores]
+
+
+def best(word: str, previous: Word = None, following: Word = None) -> tuple:
+    """
+    Provides the most likely part of speech of an unknown word.
+
+    :return: A (Part, confidence) tuple
+    """
+
+    return suggest(word, previous, following)[0]
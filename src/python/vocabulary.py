@@ -0,0 +1,422 @@
+"""
+Indexes known Words by their normalized word strings.
+
+Classes:
+
+    Vocabulary
+
+Authors:
+
+    Samuel Henderson
+"""
+
+import heapq
+import threading
+import unicodedata
+from itertools import islice
+import src.python.stats as stats
+from src.python.data import *
+
+
+class Vocabulary:
+    """
+    A book of Words keyed by normalized word strings.
+
+    Words are normalized to a Unicode normal form and optionally case folded, so that variants of the same word share a
+    single entry. Words that have not been learned or changed since the snapshot was written are materialized from the
+    snapshot when they are first looked up.
+
+    A Vocabulary can be loaded on a background thread. Lookups of Words that have already been loaded are answered
+    immediately, while lookups of any other word wait for loading to finish, as it may still be loaded or changed. If
+    loading fails, its error is raised again by every later wait, so that a partially loaded Vocabulary is not mistaken
+    for the whole book.
+
+    Attributes:
+
+        entries : dict
+            The materialized Words, keyed by normalized word strings.
+        base : Snapshot
+            The snapshot that Words are materialized from, if any. Any object with the same lookup functions, such as
+            an SQLite Table, can be used instead.
+        ready : Event
+            Set once the Vocabulary has been loaded.
+        error : Exception
+            The error that loading the Vocabulary on the background thread failed with, if any.
+        fold : bool
+            Whether word strings are case folded.
+        form : str
+            The Unicode normal form of word strings, or None to leave them unnormalized.
+
+    Functions:
+
+        normalize(word) -> str:
+            Provides the key a word string is stored under.
+        get(word) -> Word:
+            Finds the Word with a word string.
+        resolve(keys) -> dict:
+            Finds the Words stored under several normalized keys at once.
+        knows(key) -> bool:
+            Determines whether a normalized key is known, without materializing its Word.
+        add(word):
+            Stores a Word, replacing any Word with the same key.
+        associate(words, window):
+            Counts the Words of a line as keys of each other.
+        release(keys):
+            Drops persisted Words from memory, to be materialized again when they are next looked up.
+        words():
+            Yields every known Word.
+        keys():
+            Yields the key of every known Word.
+        prefixed(prefix, limit) -> list:
+            Provides the known Words whose keys start with a prefix.
+        load(function) -> Thread:
+            Loads the Vocabulary on a background thread.
+
+    """
+
+    def __init__(self, fold: bool = True, form: str = 'NFC'):
+        self.entries = {}
+        self.base = None
+        self.fold = fold
+        self.form = form
+
+        # Serializes the materialization of Words, so that concurrent lookups share a single instance
+        self.lock = threading.RLock()
+
+        # Set once the Vocabulary has been loaded on the loader thread, if any
+        self.ready = threading.Event()
+        self.ready.set()
+        self.loader = None
+        self.error = None
+
+        # The number of materialized Words that are not in the snapshot
+        self.extra = 0
+
+        # The prefix tree over materialized keys; only built once a prefix query is made
+        self.trie = None
+
+    def __len__(self):
+        if self.base is None:
+            return len(self.entries)
+        return len(self.base) + self.extra
+
+    def __contains__(self, word):
+        return self.get(word) is not None
+
+    def normalize(self, word: str) -> str:
+        """
+        Provides the key a word string is stored under.
+        """
+
+        if self.form is not None and not word.isascii():
+            word = unicodedata.normalize(self.form, word)
+        if self.fold:
+            word = word.casefold()
+        return word
+
+    def open(self, base, written: bool = False, extra: int = None) -> None:
+        """
+        Replaces the snapshot that Words are materialized from.
+        Materialized Words are kept, as they may have changed since the snapshot was written.
+
+        :param base: The snapshot to materialize Words from
+        :param written: Whether the snapshot was written from this Vocabulary, and so holds every materialized Word
+        :param extra: The number of materialized Words that are not in the snapshot, if it is known
+        """
+
+        with self.lock:
+            self.base = base
+
+            if extra is not None:
+                self.extra = extra
+            elif written:
+                self.extra = 0
+            else:
+                self.extra = sum(1 for key in self.entries if base is None or key not in base)
+
+    def persisted(self, count: int) -> None:
+        """
+        Records that a number of materialized Words which were not in the snapshot have been written into it.
+        """
+
+        self.extra -= count
+
+    def get(self, word: str):
+        """
+        Finds the Word with a word string.
+
+        :return: The Word, or None if it is unknown
+        """
+
+        started = stats.start()
+
+        key = self.normalize(word)
+        obj = self.entries.get(key)
+
+        if obj is None and (not self.ready.is_set() or self.error is not None):
+            self.wait()
+            obj = self.entries.get(key)
+
+        if obj is None and self.base is not None:
+            with self.lock:
+                obj = self.materialize(key)
+
+        if stats.enabled:
+            stats.count("lookups")
+            stats.stop("lookup", started)
+        return obj
+
+    def materialize(self, key: str):
+        """
+        Materializes the Word stored under a key in the snapshot, unless it has already been materialized.
+        """
+
+        obj = self.entries.get(key)
+
+        if obj is None:
+            obj = self.base.get(key)
+            if obj is not None:
+                if stats.enabled:
+                    stats.count("materialized")
+                # Keep the materialized Word so later lookups and changes use the same instance
+                self.entries[key] = obj
+                self.insert(key)
+
+        return obj
+
+    def resolve(self, keys) -> dict:
+        """
+        Finds the Words stored under several normalized keys at once.
+        Each distinct key is only looked up once; keys missing from the materialized Words are then searched for in the
+        snapshot together.
+
+        :param keys: The normalized keys to look up
+        :return: A dictionary of each distinct key to its Word, or None if it is unknown
+        """
+
+        started = stats.start()
+
+        found = dict.fromkeys(keys)
+        missing = []
+
+        for key in found:
+            obj = self.entries.get(key)
+            if obj is None:
+                missing.append(key)
+            else:
+                found[key] = obj
+
+        if 0 < len(missing) and (not self.ready.is_set() or self.error is not None):
+            self.wait()
+            for key in missing:
+                found[key] = self.entries.get(key)
+            missing = [key for key in missing if found[key] is None]
+
+        if self.base is not None and 0 < len(missing):
+            with self.lock:
+                for key in missing:
+                    found[key] = self.materialize(key)
+
+        if stats.enabled:
+            stats.count("lookups", len(found))
+            stats.stop("lookup", started)
+        return found
+
+    def knows(self, key: str) -> bool:
+        """
+        Determines whether a Word is stored under a normalized key, without materializing it from the snapshot.
+        """
+
+        if key in self.entries:
+            return True
+
+        self.wait()
+        return key in self.entries or (self.base is not None and key in self.base)
+
+    def add(self, word: Word) -> None:
+        """
+        Stores a Word, replacing any Word with the same key.
+        Storing a Word is a change to it (see the Changeset class).
+        """
+
+        key = self.normalize(word.word)
+
+        with self.lock:
+            if key not in self.entries:
+                if self.base is None or key not in self.base:
+                    self.extra += 1
+                self.insert(key)
+
+            self.entries[key] = word
+            changeset.touch(word)
+
+    def associate(self, words: list, window: int) -> None:
+        """
+        Counts the co-occurrences of the Words of a line as keys of each other.
+        Each Word is only associated with the window Words that follow it, so long lines cost time in proportion to
+        their length. Once a Word holds as many keys as it can, its weakest key is replaced (see the Keys class).
+
+        :param words: The distinct Words of a line, in order
+        :param window: The number of following Words that each Word is associated with
+        """
+
+        keys = [self.normalize(word.word) for word in words]
+
+        for index, word in enumerate(words):
+            for other in range(index + 1, min(index + 1 + window, len(words))):
+                word.add_key(keys[other])
+                words[other].add_key(keys[index])
+
+    def release(self, keys) -> None:
+        """
+        Drops materialized Words from memory if they are stored in the snapshot and have not changed since they were
+        persisted, so that they are materialized from the snapshot again when they are next looked up. Words that other
+        threads may still hold must not be released, as later changes to them would not reach the book.
+
+        :param keys: The normalized keys of the Words to release
+        """
+
+        with self.lock:
+            for key in keys:
+                word = self.entries.get(key)
+                if word is not None and id(word) not in changeset.words and self.base is not None and key in self.base:
+                    del self.entries[key]
+
+            # The prefix tree is rebuilt from the remaining Words by the next prefix query
+            self.trie = None
+
+    def values(self):
+        """
+        Provides the materialized Words.
+        """
+
+        self.wait()
+        return self.entries.values()
+
+    def words(self):
+        """
+        Yields every known Word, including those that have not been materialized from the snapshot.
+        """
+
+        self.wait()
+        yield from self.entries.values()
+
+        if self.base is not None:
+            for key, handle in self.base.items():
+                if key not in self.entries:
+                    yield self.base.materialize(handle)
+
+    def keys(self):
+        """
+        Yields the key of every known Word, without materializing any Words from the snapshot.
+        """
+
+        self.wait()
+        yield from self.entries.keys()
+
+        if self.base is not None:
+            for key in self.base.keys():
+                if key not in self.entries:
+                    yield key
+
+    def load(self, function) -> threading.Thread:
+        """
+        Runs a function that fills the Vocabulary on a background thread.
+        Lookups on other threads that miss the Words loaded so far wait for the function to return. An error raised by
+        the function is kept, and raised again on the threads that wait.
+
+        :param function: The function that fills the Vocabulary
+        :return: The started thread
+        """
+
+        def run():
+            try:
+                function()
+            except Exception as error:
+                self.error = error
+            finally:
+                self.ready.set()
+
+        self.error = None
+        self.ready.clear()
+        self.loader = threading.Thread(target=run, daemon=True)
+        self.loader.start()
+        return self.loader
+
+    def wait(self) -> None:
+        """
+        Waits for the Vocabulary to finish loading, unless it is being loaded on the current thread.
+
+        :raises Exception: The error that loading failed with, if it failed
+        """
+
+        if threading.current_thread() is self.loader:
+            return
+
+        self.ready.wait()
+        if self.error is not None:
+            raise self.error
+
+    def insert(self, key: str) -> None:
+        """
+        Adds a key to the prefix tree, if it has been built.
+        """
+
+        if self.trie is None:
+            return
+
+        node = self.trie
+        for char in key:
+            node = node.setdefault(char, {})
+        node[None] = key
+
+    def prefixed(self, prefix: str, limit: int = None) -> list:
+        """
+        Provides the known Words whose keys start with a prefix, in key order.
+        Materialized Words are found through a prefix tree, and the rest through a range of the sorted snapshot. Both
+        are walked in key order and merged, and the walk stops once enough keys have been found, so finding them takes
+        time in proportion to the length of the prefix and the limit rather than to the number of matching keys.
+
+        :param prefix: The prefix of the word strings to find
+        :param limit: The maximum number of Words to provide
+        :return: A list of matching Words
+        """
+
+        prefix = self.normalize(prefix)
+        self.wait()
+
+        with self.lock:
+            if self.trie is None:
+                self.trie = {}
+                for key in self.entries:
+                    self.insert(key)
+
+            node = self.trie
+            for char in prefix:
+                node = node.get(char)
+                if node is None:
+                    break
+
+            found = []
+            if node is not None:
+                found.append(self.walk(node))
+            if self.base is not None:
+                # Materialized Words are already in the prefix tree
+                found.append(key for key, handle in self.base.prefixed(prefix) if key not in self.entries)
+
+            keys = list(islice(heapq.merge(*found), limit))
+
+        return [self.get(key) for key in keys]
+
+    def walk(self, node: dict):
+        """
+        Yields the keys in the subtree of a node of the prefix tree, in key order.
+        A key comes before the keys it is a prefix of, so each node is visited before its children, smallest first.
+        """
+
+        stack = [node]
+        while stack:
+            current = stack.pop()
+            if None in current:
+                yield current[None]
+            stack.extend(current[char] for char in sorted((char for char in current if char is not None), reverse=True))